@@ -13,39 +13,32 @@
 # required for python 2.2
 from __future__ import generators
 
-from binascii import b2a_hex
-
 from BitTorrent.bitfield import Bitfield
+from BitTorrent.RawServer import FileChunk
+from BitTorrent.messages import CHOKE, UNCHOKE, INTERESTED, NOT_INTERESTED, \
+     HAVE, BITFIELD, REQUEST, PIECE, CANCEL, CHOKE_MESSAGE, UNCHOKE_MESSAGE, \
+     INTERESTED_MESSAGE, NOT_INTERESTED_MESSAGE, KEEPALIVE_MESSAGE, toint, \
+     have, haves, bitfield, request, requests, cancel, piece_header, \
+     decode_have, decode_request, decode_piece
 from BitTorrent.obsoletepythonsupport import *
 
-def toint(s):
-    return int(b2a_hex(s), 16)
-
-def tobinary(i):
-    return (chr(i >> 24) + chr((i >> 16) & 0xFF) +
-        chr((i >> 8) & 0xFF) + chr(i & 0xFF))
-
-CHOKE = chr(0)
-UNCHOKE = chr(1)
-INTERESTED = chr(2)
-NOT_INTERESTED = chr(3)
-# index
-HAVE = chr(4)
-# index, bitfield
-BITFIELD = chr(5)
-# index, begin, length
-REQUEST = chr(6)
-# index, begin, piece
-PIECE = chr(7)
-# index, begin, piece
-CANCEL = chr(8)
-
 protocol_name = 'BitTorrent protocol'
 
 #manage all the messages received and sent.
 #there is one object per connection
 class Connection(object):
 
+    __slots__ = ('encoder', 'connection', 'id', 'ip', 'locally_initiated',
+                 'complete', 'closed', 'got_anything', 'next_upload',
+                 'upload', 'download', '_partial', '_reader',
+                 '_next_len', '_message', '_owned', '_partial_message',
+                 '_partial_message_len', '_outqueue', 'choke_sent',
+                 'suppressed_haves', 'logcollector')
+
+    # RawServer hands us a memoryview of its receive buffer instead of a
+    # string, see data_came_in
+    accepts_buffer = True
+
     def __init__(self, encoder, connection, id, is_local, logcollector):
         self.encoder = encoder
         self.connection = connection
@@ -58,13 +51,16 @@ class Connection(object):
         self.next_upload = None
         self.upload = None
         self.download = None
-        self._buffer = []
-        self._buffer_len = 0
+        self._partial = None
+        self._owned = False
         self._reader = self._read_messages()
         self._next_len = self._reader.next()
         self._partial_message = None
+        self._partial_message_len = 0
         self._outqueue = []
         self.choke_sent = True
+        # HAVEs held back because the peer already had the piece
+        self.suppressed_haves = []
         self.logcollector=logcollector
         if self.locally_initiated:
             self.logcollector.log(None, 'CON L ' + str(self.ip))
@@ -83,46 +79,64 @@ class Connection(object):
 
     def send_interested(self):
         self.logcollector.log(None, 'S I ' + str(self.ip))
-        self._send_message(INTERESTED)
+        self._send_message(INTERESTED_MESSAGE)
 
     def send_not_interested(self):
         self.logcollector.log(None, 'S NI ' + str(self.ip))
-        self._send_message(NOT_INTERESTED)
+        self._send_message(NOT_INTERESTED_MESSAGE)
 
     def send_choke(self):
         if self._partial_message is None:
             self.logcollector.log(None, 'S C ' + str(self.ip))
-            self._send_message(CHOKE)
+            self._send_message(CHOKE_MESSAGE)
             self.choke_sent = True
             self.upload.sent_choke()
 
     def send_unchoke(self):
         if self._partial_message is None:
             self.logcollector.log(None, 'S UC ' + str(self.ip))
-            self._send_message(UNCHOKE)
+            self._send_message(UNCHOKE_MESSAGE)
             self.choke_sent = False
 
     def send_request(self, index, begin, length):
         self.logcollector.log(None, 'S R ' + str(self.ip) +  ' i ' + str(index) + ' b ' + str(begin) + ' l ' + str(length))
-        self._send_message(REQUEST + tobinary(index) +
-            tobinary(begin) + tobinary(length))
+        self._send_message(request(index, begin, length))
+
+    # sends all the (index, begin, length) requests in one write
+    def send_requests(self, reqs):
+        for index, begin, length in reqs:
+            self.logcollector.log(None, 'S R ' + str(self.ip) +  ' i ' + str(index) + ' b ' + str(begin) + ' l ' + str(length))
+        self._send_message(requests(reqs))
 
     def send_cancel(self, index, begin, length):
         self.logcollector.log(None, 'S CA ' + str(self.ip) +  ' i ' + str(index) + ' b ' + str(begin) + ' l ' + str(length))
-        self._send_message(CANCEL + tobinary(index) +
-            tobinary(begin) + tobinary(length))
+        self._send_message(cancel(index, begin, length))
 
-    def send_bitfield(self, bitfield):
+    def send_bitfield(self, bits):
         self.logcollector.log(None, 'S BF ' + str(self.ip))
-        self._send_message(BITFIELD + bitfield)
+        self._send_message(bitfield(bits))
 
     def send_have(self, index):
         self.logcollector.log(None, 'S H ' + str(self.ip) +  ' i ' + str(index))        
-        self._send_message(HAVE + tobinary(index))
+        self._send_message(have(index))
+
+    # sends HAVEs for all the indices in one write
+    def send_haves(self, indices):
+        for index in indices:
+            self.logcollector.log(None, 'S H ' + str(self.ip) +  ' i ' + str(index))
+        self._send_message(haves(indices))
 
     def send_keepalive(self):
         self.logcollector.log(None, 'S KA ' + str(self.ip))        
-        self._send_message('')
+        self._send_message(KEEPALIVE_MESSAGE)
+
+    # between cork() and uncork() messages are only queued, uncork() sends
+    # them together and returns the number of send() calls that took
+    def cork(self):
+        self.connection.cork()
+
+    def uncork(self):
+        return self.connection.uncork()
 
     #used by the RateLimiter to limit the upload rate
     #The RateLimiter calls send_partial each time there is a room to send
@@ -138,21 +152,30 @@ class Connection(object):
             s = self.upload.get_upload_chunk()
             if s is None:
                 return 0
-            index, begin, piece = s
+            index, begin, length, piece = s
             #when this log is sent, there is no guarantee that the block was entirely sent to the peer.
             #Indeed, if the block is too large, it will be sent in several _partial_messages
-            self.logcollector.log(None, 'S P ' + str(self.ip) +  ' i ' + str(index) + ' b ' + str(begin) + ' l ' + str(len(piece)))
-            #''.join(list) converts the list to a string
-            self._partial_message = ''.join((tobinary(len(piece) + 9), PIECE,
-                                    tobinary(index), tobinary(begin), piece))
-        if bytes < len(self._partial_message):
-            #buffer(S,b,l) returns a new buffer object containing a substring
-            #of S starting to index b finishing to b+l. l is optional
-            self.connection.write(buffer(self._partial_message, 0, bytes))
-            self._partial_message = buffer(self._partial_message, bytes)
+            self.logcollector.log(None, 'S P ' + str(self.ip) +  ' i ' + str(index) + ' b ' + str(begin) + ' l ' + str(length))
+            #the message still to be sent is kept as a list of strings and,
+            #when the block comes as file ranges, FileChunks that the socket
+            #sends with sendfile() without reading them in
+            header = piece_header(index, begin, length)
+            if type(piece) is str:
+                self._partial_message = [header + piece]
+            else:
+                self._partial_message = [header] + [FileChunk(f, pos, l)
+                                                    for f, pos, l in piece]
+            self._partial_message_len = len(header) + length
+        if bytes < self._partial_message_len:
+            self._partial_message_len -= bytes
+            self.connection.cork()
+            for part in self._split_partial(bytes):
+                self.connection.write(part)
+            self.connection.uncork()
             return bytes
 
-        queue = [str(self._partial_message)]
+        queue = self._partial_message
+        total = self._partial_message_len
         self._partial_message = None
         #when a message is still being sent (_partial_message not None),
         #CHOKE and UNCHOKE messages are delayed. They are evantually
@@ -160,47 +183,75 @@ class Connection(object):
         if self.choke_sent != self.upload.choked:
             if self.upload.choked:
                 self.logcollector.log(None, 'S C ' + str(self.ip))
-                self._outqueue.append(tobinary(1) + CHOKE)
+                self._outqueue.append(CHOKE_MESSAGE)
                 self.upload.sent_choke()
             else:
                 self.logcollector.log(None, 'S UC ' + str(self.ip))
-                self._outqueue.append(tobinary(1) + UNCHOKE)
+                self._outqueue.append(UNCHOKE_MESSAGE)
             self.choke_sent = self.upload.choked
-        queue.extend(self._outqueue)
+        for s in self._outqueue:
+            queue.append(s)
+            total += len(s)
         self._outqueue = []
-        queue = ''.join(queue)
-        self.connection.write(queue)
-        return len(queue)
+        self.connection.cork()
+        for part in queue:
+            self.connection.write(part)
+        self.connection.uncork()
+        return total
+
+    # removes and returns the parts making up the first amount bytes of
+    # _partial_message, splitting the one the cut falls in
+    def _split_partial(self, amount):
+        parts = self._partial_message
+        head = []
+        while amount:
+            part = parts[0]
+            if len(part) <= amount:
+                head.append(parts.pop(0))
+                amount -= len(part)
+                continue
+            #buffer(S,b,l) returns a new buffer object containing a substring
+            #of S starting to index b finishing to b+l. l is optional
+            if type(part) is FileChunk:
+                first, parts[0] = part.split(amount)
+            else:
+                first, parts[0] = buffer(part, 0, amount), buffer(part, amount)
+            head.append(first)
+            amount = 0
+        return head
 
     # yields the number of bytes it wants next, gets those in self._message
+    # as a memoryview that is only valid until the next yield
     def _read_messages(self):
         # First entered for a handshake message to check its correct format
         #1+19(actual header length)+8+20+20
         yield 1   # header length
-        if ord(self._message) != len(protocol_name):
+        if ord(self._message[0]) != len(protocol_name):
             return
 
         yield len(protocol_name) #should be 19
-        if self._message != protocol_name:
+        if self._message.tobytes() != protocol_name:
             return
 
         yield 8  # reserved
 
         yield 20 # download id
+        download_id = self._message.tobytes()
         if self.encoder.download_id is None:  # incoming connection
             # modifies self.encoder if successful
-            self.encoder.select_torrent(self, self._message)
+            self.encoder.select_torrent(self, download_id)
             if self.encoder.download_id is None:
                 return
-        elif self._message != self.encoder.download_id:
+        elif download_id != self.encoder.download_id:
             return
         if not self.locally_initiated:
             self.connection.write(chr(len(protocol_name)) + protocol_name +
                 (chr(0) * 8) + self.encoder.download_id + self.encoder.my_id)
 
         yield 20  # peer id
+        peer_id = self._message.tobytes()
         if not self.id:
-            self.id = self._message
+            self.id = peer_id
             if self.id == self.encoder.my_id:
                 return
             for v in self.encoder.connections.itervalues():
@@ -215,7 +266,7 @@ class Connection(object):
             else:
                 self.encoder.everinc = True
         else:
-            if self._message != self.id:
+            if peer_id != self.id:
                 return
         self.complete = True
         self.encoder.connection_completed(self)
@@ -237,6 +288,7 @@ class Connection(object):
     #The CON C in this method can only happen on a completed (i.e., handshake done)
     #connection
     #All the messages passed to this method have the length prefix (4 bytes) already removed
+    #message is a memoryview, anything kept past this call has to be copied
     def _got_message(self, message):
         #message ID is a single decimal char. 
         t = message[0]
@@ -274,7 +326,7 @@ class Connection(object):
                 self.logcollector.log(None, 'CON C ' +  str(self.connection.ip) + ' E 5')                
                 self.close()
                 return
-            i = toint(message[1:])
+            i = decode_have(message)
             if i >= self.encoder.numpieces:
                 self.logcollector.log(None, 'CON C ' +  str(self.connection.ip) + ' E 6')                
                 self.close()
@@ -284,7 +336,7 @@ class Connection(object):
             self.download.got_have(i)
         elif t == BITFIELD:
             try:
-                b = Bitfield(self.encoder.numpieces, message[1:])
+                b = Bitfield(self.encoder.numpieces, message[1:].tobytes())
             except ValueError:
                 self.logcollector.log(None, 'CON C ' +  str(self.connection.ip) + ' E 7')
                 self.close()
@@ -297,30 +349,28 @@ class Connection(object):
                 self.logcollector.log(None, 'CON C ' +  str(self.connection.ip) + ' E 8')
                 self.close()
                 return
-            i = toint(message[1:5])
+            i, begin, length = decode_request(message)
             if i >= self.encoder.numpieces:
                 self.logcollector.log(None, 'CON C ' +  str(self.connection.ip) + ' E 9')
                 self.close()
                 return
             #log set in Uploader.py in order to avoid logging duplicate messages
             #such messages are implementation error or DoS, but not part of the protocol
-            self.upload.got_request(i, toint(message[5:9]),
-                toint(message[9:]))
+            self.upload.got_request(i, begin, length)
         #the CANCEL message is 13 bytes long
         elif t == CANCEL:
             if len(message) != 13:
                 self.logcollector.log(None, 'CON C ' +  str(self.connection.ip) + ' E 10')
                 self.close()
                 return
-            i = toint(message[1:5])
+            i, begin, length = decode_request(message)
             if i >= self.encoder.numpieces:
                 self.logcollector.log(None, 'CON C ' +  str(self.connection.ip) + ' E 11')                
                 self.close()
                 return
-            self.logcollector.log(None, 'R CA ' + str(self.ip) + ' i ' + str(i) + ' b ' + str(toint(message[5:9])) + \
-                                  ' l ' + str(toint(message[9:])))
-            self.upload.got_cancel(i, toint(message[5:9]),
-                toint(message[9:]))
+            self.logcollector.log(None, 'R CA ' + str(self.ip) + ' i ' + str(i) + ' b ' + str(begin) + \
+                                  ' l ' + str(length))
+            self.upload.got_cancel(i, begin, length)
         #The PIECE message header must be 9 bytes long. Close the connection is a
         #PIECE message is sent without payload. 
         elif t == PIECE:
@@ -328,18 +378,25 @@ class Connection(object):
                 self.logcollector.log(None, 'CON C ' +  str(self.connection.ip) + ' E 12')
                 self.close()
                 return
-            i = toint(message[1:5])
+            i, begin = decode_piece(message)
             if i >= self.encoder.numpieces:
                 self.logcollector.log(None, 'CON C ' +  str(self.connection.ip) + ' E 13')
                 self.close()
                 return
-            if self.download.got_piece(i, toint(message[5:9]), message[9:]):
+            #a block still in the shared receive buffer is copied out of
+            #it, one assembled from a split message goes to storage as a
+            #view of its own buffer
+            piece = message[9:]
+            if not self._owned:
+                piece = piece.tobytes()
+            if self.download.got_piece(i, begin, piece):
                 #Log set in Downloader.py in order to avoid logging not requested messages.
                 #Send HAVE messages to all the peers for the received piece.
                 #Each received block does not trigger the sent of a HAVE message
                 #only full pieces trigger the sent of such a message.
-                for co in self.encoder.complete_connections:
-                    co.send_have(i)
+                #The encoder batches the HAVEs of all the pieces completed
+                #in the same event loop pass.
+                self.encoder.piece_completed(i)
         #message ID not recongnized.
         else:
             self.logcollector.log(None, 'CON C ' +  str(self.connection.ip) + ' E 14')
@@ -358,8 +415,8 @@ class Connection(object):
             self.encoder.choker.connection_lost(self)
             self.upload = self.download = None
 
-    def _send_message(self, message):
-        s = tobinary(len(message)) + message
+    # message is already encoded, length prefix included
+    def _send_message(self, s):
         if self._partial_message is not None:
             self._outqueue.append(s)
         else:
@@ -368,23 +425,43 @@ class Connection(object):
     #Called by the RawServer.
     #can be called before the connection is completed. Thus CON C can happen
     #if the remote peer does not complete its handshake.
+    #s is usually a memoryview of the RawServer receive buffer. Messages that
+    #are entirely inside it are handed on as slices of it; a message split
+    #across reads is assembled in its own bytearray, and _owned is set for
+    #it. Either way a block is copied once before it reaches storage: out
+    #of the receive buffer, or into the bytearray. The bytearray grows with
+    #the data that came in rather than being allocated at the length the
+    #peer announced, which can be up to max_message_length.
     def data_came_in(self, conn, s):
+        if type(s) is not memoryview:
+            s = memoryview(s)
+        pos = 0
+        end = len(s)
         while True:
             if self.closed:
                 return
-            i = self._next_len - self._buffer_len
-            if i > len(s):
-                self._buffer.append(s)
-                self._buffer_len += len(s)
-                return
-            m = s[:i]
-            if self._buffer_len > 0:
-                self._buffer.append(m)
-                m = ''.join(self._buffer)
-                self._buffer = []
-                self._buffer_len = 0
-            s = s[i:]
+            if self._partial is not None:
+                partial = self._partial
+                i = self._next_len - len(partial)
+                if i > end - pos:
+                    partial += s[pos:]
+                    return
+                partial += s[pos:pos + i]
+                pos += i
+                self._partial = None
+                m = memoryview(partial)
+                owned = True
+            else:
+                i = self._next_len
+                if i > end - pos:
+                    if pos < end:
+                        self._partial = bytearray(s[pos:])
+                    return
+                m = s[pos:pos + i]
+                pos += i
+                owned = False
             self._message = m
+            self._owned = owned
             try:
                 self._next_len = self._reader.next()
             #StopIteration is raised by the next() iterator when there is no more values
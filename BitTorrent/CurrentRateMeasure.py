@@ -15,6 +15,8 @@ from BitTorrent.platform import bttime
 
 class Measure(object):
 
+    __slots__ = ('max_rate_period', 'ratesince', 'last', 'rate', 'total')
+
     def __init__(self, max_rate_period, fudge=5):
         self.max_rate_period = max_rate_period
         self.ratesince = bttime() - fudge
@@ -0,0 +1,349 @@
+# The contents of this file are subject to the BitTorrent Open Source License
+# Version 1.0 (the License).  You may not copy or use this file, in either
+# source code or executable form, except in compliance with the License.  You
+# may obtain a copy of the License at http://www.bittorrent.com/license/.
+#
+# Software distributed under the License is distributed on an AS IS basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied.  See the License
+# for the specific language governing rights and limitations under the
+# License.
+
+from threading import Thread, Condition
+
+from BitTorrent.platform import bttime
+from BitTorrent.Storage import join_blocks
+
+READ = 0
+WRITE = 1
+CALL = 2
+
+
+def _nothing():
+    pass
+
+
+class _Job(object):
+
+    __slots__ = ('kind', 'target', 'args', 'pos', 'length', 'callback',
+                 'failed', 'submitted', 'queue')
+
+    #target is the Storage read or written, args the data written or for a
+    #read whether to get the file ranges holding the data instead, or target
+    #is a function called with args
+    def __init__(self, kind, target, args, pos, length, callback,
+                 failed = None):
+        self.kind = kind
+        self.target = target
+        self.args = args
+        self.pos = pos
+        self.length = length
+        self.callback = callback
+        self.failed = failed
+        self.submitted = bttime()
+        self.queue = None
+
+    def overlaps(self, other):
+        return self.target is other.target and \
+               self.pos < other.pos + other.length and \
+               other.pos < self.pos + self.length
+
+
+#The disk jobs of one torrent. A read always sees the writes submitted
+#before it and a function always runs after the jobs submitted before it
+#and before the ones submitted after it, its callback after theirs,
+#otherwise the jobs may be reordered. Everything but pending, running and
+#the statistics is only used from the RawServer thread.
+class DiskQueue(object):
+
+    def __init__(self, diskio, context, limit):
+        self.diskio = diskio
+        self.context = context
+        self.limit = limit
+        #jobs not scheduled yet, and how many of them are reads
+        self.jobs = []
+        self.reads = 0
+        #jobs submitted and not finished
+        self.pending = 0
+        #jobs scheduled and not finished
+        self.running = 0
+        #whether a thread runs one of them, the torrent's files are read and
+        #written by one thread at a time as they share the file handles
+        self.busy = False
+        #threads waiting for the jobs to finish
+        self.syncing = 0
+        #functions to call once the queue is no longer full
+        self.waiting = []
+        self.peak = 0
+        self.done = 0
+        self.operations = 0
+        self.latency = 0.0
+        self.max_latency = 0.0
+
+    #func(*args) is called on a disk thread, then callback with what it
+    #returned on the RawServer thread. Exceptions it raises go to the
+    #context's got_exception() instead.
+    def submit(self, func, args, callback = None):
+        self.diskio._submit(self, _Job(CALL, func, args, 0, 0, callback))
+
+    #a read a peer is waiting for, callback gets the data, or with ranges
+    #the file ranges to send it from. If the read fails, failed is called
+    #with the exception before it goes to got_exception()
+    def read(self, storage, pos, length, callback, ranges = False,
+             failed = None):
+        self.diskio._submit(self, _Job(READ, storage, ranges, pos, length,
+                                       callback, failed))
+
+    def write(self, storage, pos, data):
+        self.diskio._submit(self, _Job(WRITE, storage, data, pos, len(data),
+                                       None))
+
+    #func is called on the RawServer thread once the jobs submitted so far
+    #have run
+    def when_done(self, func):
+        def done(result):
+            func()
+        self.submit(_nothing, (), done)
+
+    def full(self):
+        return self.pending >= self.limit
+
+    def when_free(self, func):
+        if func not in self.waiting:
+            self.waiting.append(func)
+
+    #blocks until every job submitted so far has run, for closing the files
+    def wait(self):
+        self.diskio._wait(self)
+
+    def get_stats(self):
+        latency = 0.0
+        if self.done:
+            latency = self.latency / self.done
+        return {'disk_queue': self.pending,
+                'disk_queue_peak': self.peak,
+                'disk_jobs': self.done,
+                'disk_operations': self.operations,
+                'disk_latency': latency,
+                'disk_max_latency': self.max_latency}
+
+
+#Threads doing the disk I/O of all the torrents off the RawServer thread.
+#Each torrent gets a DiskQueue. The jobs of all the queues are collected
+#for up to window seconds, or less if a peer waits for a read or the
+#RawServer thread for the queue, and run as a batch: the reads first,
+#then the writes and the function calls, each in the order of their
+#position from where the previous batch left off, with reads and writes
+#of adjacent data merged into operations of up to merge bytes. The
+#threads take the operations in that order, skipping those of a torrent
+#another thread is doing one for.
+class DiskIO(object):
+
+    def __init__(self, external_add_task, threads, window = 0, merge = 0):
+        self.external_add_task = external_add_task
+        self.window = window
+        self.merge = merge
+        self.cond = Condition()
+        #queues with jobs not scheduled yet
+        self.queues = []
+        #operations of the current batch not started yet, in the order to
+        #run them. Each is a list of jobs of one queue.
+        self.batch = []
+        #(id of the storage, position) the last batch ended at
+        self.head = None
+        self.stopped = False
+        self.threads = []
+        for i in xrange(threads):
+            t = Thread(target = self._work)
+            t.setDaemon(True)
+            t.start()
+            self.threads.append(t)
+
+    #lets the threads run the jobs submitted so far, then ends them and
+    #waits until they are done. Their callbacks aren't called any more.
+    def stop(self):
+        self.cond.acquire()
+        try:
+            self.stopped = True
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
+        for t in self.threads:
+            t.join()
+
+    def queue(self, context, limit):
+        return DiskQueue(self, context, limit)
+
+    def _submit(self, queue, job):
+        self.cond.acquire()
+        try:
+            job.queue = queue
+            queue.jobs.append(job)
+            if job.kind == READ:
+                queue.reads += 1
+            queue.pending += 1
+            queue.peak = max(queue.peak, queue.pending)
+            if len(queue.jobs) == 1:
+                self.queues.append(queue)
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
+
+    def _wait(self, queue):
+        self.cond.acquire()
+        try:
+            queue.syncing += 1
+            self.cond.notifyAll()
+            while queue.pending:
+                self.cond.wait()
+            queue.syncing -= 1
+        finally:
+            self.cond.release()
+
+    #how many of the queue's first jobs can run in any order: up to the
+    #first function call, or up to a read or write of data an earlier one
+    #writes or reads, if it writes
+    def _prefix(self, queue):
+        taken = []
+        for i, job in enumerate(queue.jobs):
+            if job.kind == CALL:
+                return i or 1
+            for other in taken:
+                if (job.kind == WRITE or other.kind == WRITE) and \
+                       job.overlaps(other):
+                    return i
+            taken.append(job)
+        return len(queue.jobs)
+
+    #fills the batch from the queues whose last batch is done, or returns
+    #the seconds until it's time to
+    def _schedule(self):
+        ready = [queue for queue in self.queues if not queue.running]
+        if not ready:
+            return None
+        hurry = False
+        oldest = None
+        for queue in ready:
+            if queue.syncing or queue.reads:
+                hurry = True
+            if oldest is None or queue.jobs[0].submitted < oldest:
+                oldest = queue.jobs[0].submitted
+        wait = oldest + self.window - bttime()
+        if not hurry and wait > 0:
+            return wait
+        calls = []
+        jobs = []
+        for queue in ready:
+            n = self._prefix(queue)
+            taken = queue.jobs[:n]
+            del queue.jobs[:n]
+            if not queue.jobs:
+                self.queues.remove(queue)
+            queue.running = n
+            for job in taken:
+                if job.kind == READ:
+                    queue.reads -= 1
+            if taken[0].kind == CALL:
+                calls.append(taken)
+            else:
+                jobs.extend(taken)
+        #the positions past the head first, then the ones before it
+        head = self.head
+        def key(job):
+            where = (id(job.target), job.pos)
+            return (job.kind, head is not None and where < head, where)
+        jobs.sort(key = key)
+        batch = []
+        for job in jobs:
+            if batch:
+                last = batch[-1]
+                end = last[-1].pos + last[-1].length
+                if job.kind == last[0].kind and job.target is last[0].target \
+                       and job.args == last[0].args and job.pos == end and \
+                       end + job.length - last[0].pos <= self.merge:
+                    last.append(job)
+                    continue
+            batch.append([job])
+        if batch:
+            job = batch[-1][-1]
+            self.head = (id(job.target), job.pos + job.length)
+        self.batch = batch + calls
+        return None
+
+    def _work(self):
+        cond = self.cond
+        while True:
+            cond.acquire()
+            try:
+                op = None
+                while op is None:
+                    if self.stopped and not self.batch and not self.queues:
+                        return
+                    if not self.batch:
+                        wait = self._schedule()
+                    else:
+                        wait = None
+                    for i in xrange(len(self.batch)):
+                        if not self.batch[i][0].queue.busy:
+                            op = self.batch.pop(i)
+                            op[0].queue.busy = True
+                            break
+                    else:
+                        cond.wait(wait)
+            finally:
+                cond.release()
+            result = error = None
+            job = op[0]
+            try:
+                if job.kind == CALL:
+                    result = [job.target(*job.args)]
+                elif job.kind == READ and job.args:
+                    result = [job.target.read_ranges(j.pos, j.length)
+                              for j in op]
+                elif job.kind == READ:
+                    data = job.target.read(job.pos, op[-1].pos +
+                                           op[-1].length - job.pos)
+                    result = [data[j.pos - job.pos:j.pos - job.pos + j.length]
+                              for j in op]
+                else:
+                    job.target.write(job.pos,
+                                     join_blocks([j.args for j in op]))
+                    result = [None] * len(op)
+            except Exception, e:
+                error = e
+            now = bttime()
+            queue = job.queue
+            def finished(queue = queue, op = op, result = result,
+                         error = error):
+                self._finished(queue, op, result, error)
+            cond.acquire()
+            try:
+                queue.busy = False
+                queue.pending -= len(op)
+                queue.running -= len(op)
+                queue.done += len(op)
+                queue.operations += 1
+                for j in op:
+                    latency = now - j.submitted
+                    queue.latency += latency
+                    queue.max_latency = max(queue.max_latency, latency)
+                #added before another thread can schedule the queue's next
+                #function call, so its callback comes after these
+                self.external_add_task(finished, 0, queue.context)
+                cond.notifyAll()
+            finally:
+                cond.release()
+
+    def _finished(self, queue, op, result, error):
+        if queue.waiting and not queue.full():
+            waiting = queue.waiting
+            queue.waiting = []
+            for func in waiting:
+                func()
+        if error is not None:
+            for job in op:
+                if job.failed is not None:
+                    job.failed(error)
+            raise error
+        for job, r in zip(op, result):
+            if job.callback is not None:
+                job.callback(r)
@@ -13,11 +13,13 @@
 
 #This module contains all the machinery to download data from peers. 
 
-from random import shuffle
+from random import shuffle, choice
+from array import array
+from binascii import hexlify, unhexlify
 
 from BitTorrent.platform import bttime
 from BitTorrent.CurrentRateMeasure import Measure
-from BitTorrent.bitfield import Bitfield
+from BitTorrent.bitfield import Bitfield, counts
 
 #statistics on all the peers
 class PerIPStats(object):
@@ -31,6 +33,8 @@ class PerIPStats(object):
 
 class BadDataGuard(object):
 
+    __slots__ = ('download', 'ip', 'downloader', 'stats', 'lastindex')
+
     def __init__(self, download):
         self.download = download
         self.ip = download.connection.ip
@@ -65,65 +69,217 @@ class BadDataGuard(object):
             self.stats.numgood += 1
             self.lastindex = index
 
+#Outstanding block requests, indexed both ways: each SingleDownload keeps
+#the blocks it has asked its peer for in its active_requests dict, with the
+#time they were requested, and holders maps every requested block to the
+#downloads it was asked from.
+#Blocks are (index, begin, length) tuples.
+class RequestRegistry(object):
+
+    def __init__(self):
+        self.holders = {}
+        #once track_open is called, a BlockSet of the missing blocks that
+        #have been requested from fewer than cap downloads
+        self.cap = None
+        self.open = None
+
+    def track_open(self, cap, missing):
+        self.cap = cap
+        self.open = BlockSet([block for block in missing
+                              if len(self.holders.get(block, ())) < cap])
+
+    def add(self, download, block):
+        download.active_requests[block] = bttime()
+        h = self.holders.get(block)
+        if h is None:
+            h = self.holders[block] = {download: None}
+        else:
+            h[download] = None
+        if self.open is not None and len(h) >= self.cap:
+            self.open.discard(block)
+
+    #block came in from download, returns the time it was requested or None
+    #if it wasn't
+    def remove(self, download, block):
+        try:
+            requested = download.active_requests.pop(block)
+        except KeyError:
+            return None
+        h = self.holders[block]
+        del h[download]
+        if not h:
+            del self.holders[block]
+        if self.open is not None:
+            self.open.discard(block)
+        return requested
+
+    def holders_of(self, block):
+        return self.holders.get(block, {}).keys()
+
+    #forgets everything download has requested, returns those blocks
+    def drop(self, download):
+        blocks = download.active_requests
+        download.active_requests = {}
+        holders = self.holders
+        for block in blocks:
+            h = holders[block]
+            del h[download]
+            if not h:
+                del holders[block]
+            if self.open is not None and len(h) < self.cap:
+                self.open.add(block)
+        return blocks.keys()
+
+    #forgets block for every download that requested it, returns those
+    def cancel(self, block):
+        h = self.holders.pop(block, {})
+        for download in h:
+            del download.active_requests[block]
+        if self.open is not None:
+            self.open.discard(block)
+        return h.keys()
+
+#A set of blocks that also supports picking a random member in O(1),
+#used for the blocks still missing in endgame.
+class BlockSet(object):
+
+    def __init__(self, blocks = ()):
+        self.blocks = []
+        self.positions = {}
+        for block in blocks:
+            self.add(block)
+
+    def add(self, block):
+        if block not in self.positions:
+            self.positions[block] = len(self.blocks)
+            self.blocks.append(block)
+
+    def discard(self, block):
+        pos = self.positions.pop(block, None)
+        if pos is None:
+            return
+        last = self.blocks.pop()
+        if pos < len(self.blocks):
+            self.blocks[pos] = last
+            self.positions[last] = pos
+
+    def choice(self):
+        return choice(self.blocks)
+
+    def __contains__(self, block):
+        return block in self.positions
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def __iter__(self):
+        return iter(self.blocks)
+
 #class private to this module
 class SingleDownload(object):
 
+    __slots__ = ('downloader', 'connection', 'choked', 'interested',
+                 'active_requests', 'measure', 'peermeasure', 'have', 'last',
+                 'needed', 'backlog', 'guard', 'logcollector',
+                 'rtt', 'rtt_time', 'latency')
+
     def __init__(self, downloader, connection, logcollector):
         self.downloader = downloader
         self.connection = connection
         self.choked = True
         self.interested = False
-        self.active_requests = []
+        #{(index, begin, length): time requested}, kept up to date by
+        #RequestRegistry
+        self.active_requests = {}
         self.measure = Measure(downloader.config['max_rate_period'])
         self.peermeasure = Measure(max(downloader.storage.piece_size / 10000,
                                        20))
         #intialize a bitfield of lenght 'numpieces'
         self.have = Bitfield(downloader.numpieces)
         self.last = 0
-        self.example_interest = None
-        self.backlog = 2
+        #how many of the pieces the peer has still have blocks to request,
+        #kept up to date by Downloader.requests_exhausted/requests_refilled;
+        #in endgame, how many still have blocks missing. We are interested
+        #while this or active_requests is not empty
+        self.needed = 0
+        self.backlog = downloader.min_pipeline
         self.guard = BadDataGuard(self)
         self.logcollector=logcollector
-
+        #round trip time estimate, the shortest request to data time seen
+        #in the last rtt_window seconds, taken at rtt_time; None until a
+        #block has come in
+        self.rtt = None
+        self.rtt_time = 0
+        #smoothed request to data time, queueing at the peer included
+        self.latency = None
+
+    #the number of requests to keep outstanding: enough to cover twice the
+    #bandwidth-delay product, so the rate can keep growing, within the
+    #configured bounds
     def _backlog(self):
-        backlog = 2 + int(4 * self.measure.get_rate() /
-                          self.downloader.chunksize)
-        if backlog > 50:
-            backlog = max(50, int(.075 * backlog))
+        backlog = self.downloader.min_pipeline
+        if self.rtt is not None:
+            backlog += int(2 * self.measure.get_rate() * self.rtt /
+                           self.downloader.chunksize)
+            if backlog > self.downloader.max_pipeline:
+                backlog = self.downloader.max_pipeline
         self.backlog = backlog
         return backlog
 
+    #how long a block asked for now should take to come in: the round trip
+    #time plus the time to transfer it at the current rate. Ranks the peers
+    #in endgame, where the first copy of a block to arrive is what counts
+    def block_time(self):
+        rate = self.measure.get_rate()
+        if not rate:
+            return 2 ** 30
+        return (self.rtt or 0) + self.downloader.chunksize / rate
+
+    def _update_rtt(self, now, requested):
+        sample = now - requested
+        if self.latency is None:
+            self.latency = sample
+        else:
+            self.latency += (sample - self.latency) / 8
+        if self.rtt is None or sample <= self.rtt or \
+               now - self.rtt_time > self.downloader.rtt_window:
+            self.rtt = sample
+            self.rtt_time = now
+
     def disconnected(self):
         self.downloader.lost_peer(self)
-        for i in xrange(len(self.have)):
-            if self.have[i]:
-                self.downloader.picker.lost_have(i)
+        self.downloader.picker.lost_bitfield(self.have, self)
+        self.downloader.picker.lost_peer(self)
         self._letgo()
         self.guard.download = None
 
     def _letgo(self):
         if not self.active_requests:
             return
+        blocks = self.downloader.requests.drop(self)
         if self.downloader.storage.endgame:
-            self.active_requests = []
+            if self.downloader.endgame_capped:
+                #the blocks may be under the cap for other peers now
+                for d in self.downloader.endgame_order():
+                    if d is not self and not d.choked:
+                        d.fix_download_endgame()
             return
         lost = []
-        for index, begin, length in self.active_requests:
+        for block in blocks:
+            if block in self.downloader.requests.holders:
+                #re-requested from another peer for a streaming deadline
+                continue
+            index, begin, length = block
+            refilled = not self.downloader.storage.do_I_have_requests(index)
             self.downloader.storage.request_lost(index, begin, length)
+            if refilled:
+                self.downloader.requests_refilled(index)
             if index not in lost:
                 lost.append(index)
-        self.active_requests = []
         ds = [d for d in self.downloader.downloads if not d.choked]
         shuffle(ds)
         for d in ds:
             d._request_more(lost)
-        for d in self.downloader.downloads:
-            if d.choked and not d.interested:
-                for l in lost:
-                    if d.have[l] and self.downloader.storage.do_I_have_requests(l):
-                        d.interested = True
-                        d.connection.send_interested()
-                        break
 
     def got_choke(self):
         if not self.choked:
@@ -142,54 +298,49 @@ class SingleDownload(object):
     #false, otherwise. The result of this method is used to decide when
     #to send the HAVE message.
     def got_piece(self, index, begin, piece):        
-        try:
-            #the received block was not requested if it is not in active_requests.
-            #It is discarded
-            self.active_requests.remove((index, begin, len(piece)))
-        except ValueError:
+        block = (index, begin, len(piece))
+        #the received block was not requested if it is not in active_requests.
+        #It is discarded
+        requested = self.downloader.requests.remove(self, block)
+        if requested is None:
             self.downloader.discarded_bytes += len(piece)
+            if self.downloader.storage.endgame:
+                #a copy of a block that came in from another peer first
+                self.downloader.duplicate_bytes += len(piece)
             return False
         #count all the received packet that are requested. 
         self.logcollector.log(None, 'R P ' + str(self.connection.ip) + ' i ' + str(index) + ' b ' + str(begin))
         if self.downloader.storage.endgame:
-            self.downloader.all_requests.remove((index, begin, len(piece)))
+            self.downloader.endgame_received(block)
+        else:
+            #the other peers a block was re-requested from for a streaming
+            #deadline, done before the storage could make the piece
+            #requestable again
+            for d in self.downloader.requests.cancel(block):
+                d.connection.send_cancel(index, begin, len(piece))
         self.last = bttime()
+        self._update_rtt(self.last, requested)
         self.measure.update_rate(len(piece))
         self.downloader.measurefunc(len(piece))
         self.downloader.downmeasure.update_rate(len(piece))
         if not self.downloader.storage.piece_came_in(index, begin, piece,
                                                      self.guard):
-            if self.downloader.storage.endgame:
-                while self.downloader.storage.do_I_have_requests(index):
-                    nb, nl = self.downloader.storage.new_request(index)
-                    self.downloader.all_requests.append((index, nb, nl))
-                for d in self.downloader.downloads:
-                    d.fix_download_endgame()
-                return False
-            ds = [d for d in self.downloader.downloads if not d.choked]
-            shuffle(ds)
-            for d in ds:
-                d._request_more([index])
+            self.downloader.piece_failed(index)
             return False
         if self.downloader.storage.do_I_have(index):
             self.downloader.picker.complete(index)
         if self.downloader.storage.endgame:
-            for d in self.downloader.downloads:
+            #the other peers the block was requested from get a CANCEL
+            holders = dict.fromkeys(self.downloader.requests.cancel(block))
+            for d in self.downloader.endgame_order():
                 if d is not self and d.interested:
                     if d.choked:
                         d.fix_download_endgame()
-                    else:
-                        try:
-                            d.active_requests.remove((index, begin, len(piece)))
-                        except ValueError:
-                            continue
+                    elif d in holders:
                         d.connection.send_cancel(index, begin, len(piece))
                         d.fix_download_endgame()
         self._request_more()
-        if self.downloader.picker.am_I_complete():
-            for d in [i for i in self.downloader.downloads if i.have.numfalse == 0]:
-                self.logcollector.log(None, 'CON C ' + str(d.connection.ip) + ' S')
-                d.connection.close()
+        self.downloader.close_seeds()
         return self.downloader.storage.do_I_have(index)
 
     #return true if the remote peer has the piece and
@@ -203,13 +354,21 @@ class SingleDownload(object):
         assert not self.choked
         if len(self.active_requests) >= self._backlog():
             return
+        #the disk isn't keeping up, more is asked for once it has caught up
+        if self.downloader.storage.disk_full(self.downloader.disk_free):
+            return
         if self.downloader.storage.endgame:
             self.fix_download_endgame()
             return
-        lost_interests = []
+        # everything this pass sends goes out in one write at _uncork()
+        self.connection.cork()
         while len(self.active_requests) < self.backlog:
             if indices is None:
-                interest = self.downloader.picker.next(self._want, self.have.numfalse == 0)
+                if not self.needed:
+                    #the picker would look through everything for nothing
+                    break
+                interest = self.downloader.picker.next(self._want,
+                                        self.have.numfalse == 0, self)
             else:
                 interest = None
                 for i in indices:
@@ -221,58 +380,109 @@ class SingleDownload(object):
             if not self.interested:
                 self.interested = True
                 self.connection.send_interested()
-            self.example_interest = interest
             self.downloader.picker.requested(interest, self.have.numfalse == 0)
+            reqs = []
             while len(self.active_requests) < (self.backlog-2) * 5 + 2:
                 begin, length = self.downloader.storage.new_request(interest)
-                self.active_requests.append((interest, begin, length))
-                self.connection.send_request(interest, begin, length)
+                self.downloader.requests.add(self, (interest, begin, length))
+                reqs.append((interest, begin, length))
                 if not self.downloader.storage.do_I_have_requests(interest):
-                    lost_interests.append(interest)
+                    self.downloader.requests_exhausted(interest)
                     break
-        if not self.active_requests and self.interested:
+            if reqs:
+                self._send_requests(reqs)
+        if not self.active_requests and not self.needed and self.interested:
             self.interested = False
             self.connection.send_not_interested()
-        if lost_interests:
-            for d in self.downloader.downloads:
-                if d.active_requests or not d.interested:
-                    continue
-                if d.example_interest is not None and self.downloader.storage.do_I_have_requests(d.example_interest):
-                    continue
-                for lost in lost_interests:
-                    if d.have[lost]:
-                        break
-                else:
-                    continue
-                interest = self.downloader.picker.next(d._want, d.have.numfalse == 0)
-                if interest is None:
-                    d.interested = False
-                    d.connection.send_not_interested()
-                else:
-                    d.example_interest = interest
+        self._uncork()
         if self.downloader.storage.endgame:
-            self.downloader.all_requests = []
-            for d in self.downloader.downloads:
-                self.downloader.all_requests.extend(d.active_requests)
-            for d in self.downloader.downloads:
+            self.downloader.start_endgame()
+            for d in self.downloader.endgame_order():
                 d.fix_download_endgame()
 
     def fix_download_endgame(self):
-        want = [a for a in self.downloader.all_requests if self.have[a[0]] and a not in self.active_requests]
-        if self.interested and not self.active_requests and not want:
+        can_request = not self.choked and \
+                      len(self.active_requests) < self._backlog()
+        want = []
+        if can_request:
+            want = self._endgame_want(self.backlog - len(self.active_requests),
+                                      self.downloader.endgame_capped)
+        # interest doesn't depend on the endgame policy, only on whether
+        # there is anything to want
+        wanted = want or self.needed
+        if self.interested and not self.active_requests and not wanted:
             self.interested = False
             self.connection.send_not_interested()
             return
-        if not self.interested and want:
+        self.connection.cork()
+        if not self.interested and wanted:
             self.interested = True
             self.connection.send_interested()
-        if self.choked or len(self.active_requests) >= self._backlog():
-            return
+        if can_request:
+            for block in want:
+                self.downloader.requests.add(self, block)
+            if want:
+                self._send_requests(want)
+        self._uncork()
+
+    # up to limit random missing blocks this peer has that it hasn't been
+    # asked for yet, and that the capped policy allows if capped is set.
+    # Usually most missing blocks qualify, so random picks find them without
+    # looking at the rest; only when that fails are all of them checked.
+    def _endgame_want(self, limit, capped):
+        all_requests = self.downloader.all_requests
+        may_request = None
+        if capped:
+            # only the blocks under the cap need to be looked at
+            all_requests = self.downloader.requests.open
+            may_request = self._may_duplicate
+            times = self.downloader.block_times
+            t = times.get(self)
+            if t is None:
+                t = times[self] = self.block_time()
+        if not all_requests:
+            return []
+        have = self.have
+        active = self.active_requests
+        want = {}
+        for i in xrange(2 * limit + 4):
+            block = all_requests.choice()
+            if have[block[0]] and block not in active and \
+                   (may_request is None or may_request(block, t, times)):
+                want[block] = None
+                if len(want) == limit:
+                    return want.keys()
+        want = [block for block in all_requests
+                if have[block[0]] and block not in active and
+                (may_request is None or may_request(block, t, times))]
         shuffle(want)
-        del want[self.backlog - len(self.active_requests):]
-        self.active_requests.extend(want)
-        for piece, begin, length in want:
-            self.connection.send_request(piece, begin, length)
+        del want[limit:]
+        return want
+
+    # the capped endgame policy: a block that hasn't been requested yet can
+    # always be, one that has goes to at most endgame_max_duplicates peers
+    # (RequestRegistry.open has only those under it), each expected to
+    # deliver it sooner than all the ones already asked. t is this peer's
+    # block_time(), times is Downloader.block_times.
+    def _may_duplicate(self, block, t, times):
+        holders = self.downloader.requests.holders.get(block)
+        if not holders:
+            return True
+        for d in holders:
+            dt = times.get(d)
+            if dt is None:
+                dt = times[d] = d.block_time()
+            if dt <= t:
+                return False
+        return True
+
+    def _send_requests(self, reqs):
+        for index, begin, length in reqs:
+            self.downloader.requested_bytes += length
+        self.connection.send_requests(reqs)
+
+    def _uncork(self):
+        self.downloader.request_writes += self.connection.uncork()
 
     def got_have(self, index):
         if self.have[index]:
@@ -290,14 +500,17 @@ class SingleDownload(object):
             self.peermeasure.update_rate(self.downloader.storage.piece_size)
             
         self.have[index] = True
-        self.downloader.picker.got_have(index)
+        self.downloader.picker.got_have(index, self)
         if self.downloader.picker.am_I_complete() and self.have.numfalse == 0:
             self.logcollector.log(None, 'CON C '  + str(self.connection.ip) + ' S')
             self.connection.close()
             return
         if self.downloader.storage.endgame:
+            if index in self.downloader.endgame_pieces:
+                self.needed += 1
             self.fix_download_endgame()
         elif self.downloader.storage.do_I_have_requests(index):
+            self.needed += 1
             if not self.choked:
                 self._request_more([index])
             else:
@@ -315,28 +528,22 @@ class SingleDownload(object):
             self.connection.close()
             return
         self.have = have
+        indices = have.indices()
+        self.downloader.picker.got_bitfield(have, self)
         
         #the string bitfield is just used for logging.
-        bitfield=''
-        for i in xrange(len(self.have)):
-            if self.have[i]:
-                bitfield += str(i) + ' '
-                self.downloader.picker.got_have(i)
+        bitfield = ' '.join(map(str, indices)) + ' '
         self.logcollector.log(None, 'R BF ' + str(self.connection.ip) + ' ' + bitfield)
         #receive bitfield while in endgame mode. In this case, it sends INTERESTED
         #to the remote peer as soon as the local peer does not have
         #at least one piece advertised by the remote peer. 
         if self.downloader.storage.endgame:
-            for piece, begin, length in self.downloader.all_requests:
-                if self.have[piece]:
-                    self.interested = True
-                    self.connection.send_interested()
-                    return
-        for i in xrange(len(self.have)):
-            if self.have[i] and self.downloader.storage.do_I_have_requests(i):
-                self.interested = True
-                self.connection.send_interested()
-                return
+            self.needed = self.downloader.count_endgame_needed(have)
+        else:
+            self.needed = self.downloader.count_needed(have)
+        if self.needed:
+            self.interested = True
+            self.connection.send_interested()
 
     def get_rate(self):
         return self.measure.get_rate()
@@ -364,11 +571,80 @@ class Downloader(object):
         self.kickfunc = kickfunc
         self.banfunc = banfunc
         self.downloads = []
+        self.requests = RequestRegistry()
+        #a bit for every piece that still has blocks to request, high bit
+        #first like Bitfield
+        self.requestable = array('B', chr(0) * ((numpieces + 7) // 8))
+        for i in xrange(numpieces):
+            if storage.do_I_have_requests(i):
+                self.requestable[i >> 3] |= 128 >> (i & 7)
+        #in endgame, every block still missing, and how many of them each
+        #piece has
+        self.all_requests = BlockSet()
+        self.endgame_pieces = {}
+        #with the capped endgame policy, the block_time() of the downloads
+        #as of the last endgame_order()
+        self.block_times = {}
         self.perip = {}
         self.bad_peers = {}
         self.discarded_bytes = 0
+        #bytes of blocks received in endgame after another copy came in
+        self.duplicate_bytes = 0
+        self.endgame_capped = config['endgame_policy'] == 'capped'
+        self.endgame_max_duplicates = config['endgame_max_duplicates']
+        self.min_pipeline = config['min_request_pipeline']
+        self.max_pipeline = config['max_request_pipeline']
+        self.rtt_window = config['rtt_window']
+        self.streaming_deadline = config['streaming_deadline']
+        #blocks requested again because they missed a streaming deadline
+        self.deadline_requests = 0
+        # send() calls made flushing request passes, and bytes requested
+        self.request_writes = 0
+        self.requested_bytes = 0
         self.logcollector=logcollector
 
+    #the blocks of a piece that failed its hash check are requested again
+    def piece_failed(self, index):
+        if self.storage.endgame:
+            count = self.endgame_pieces.get(index, 0)
+            while self.storage.do_I_have_requests(index):
+                nb, nl = self.storage.new_request(index)
+                self.all_requests.add((index, nb, nl))
+                if self.requests.open is not None:
+                    self.requests.open.add((index, nb, nl))
+                count += 1
+            if count and index not in self.endgame_pieces:
+                for d in self.downloads:
+                    if d.have[index]:
+                        d.needed += 1
+            if count:
+                self.endgame_pieces[index] = count
+            for d in self.endgame_order():
+                d.fix_download_endgame()
+            return
+        self.requests_refilled(index)
+        ds = [d for d in self.downloads if not d.choked]
+        shuffle(ds)
+        for d in ds:
+            d._request_more([index])
+
+    #the hash check of a piece that StorageWrapper.piece_came_in() left to
+    #the disk I/O threads is done. Returns ok, whether the piece passed
+    def piece_checked(self, index, ok):
+        if not ok:
+            self.piece_failed(index)
+            return False
+        self.picker.complete(index)
+        self.close_seeds()
+        return True
+
+    #once we are complete, the connections to other seeds are closed
+    def close_seeds(self):
+        if self.picker.am_I_complete():
+            for d in [i for i in self.downloads if i.have.numfalse == 0]:
+                self.logcollector.log(None, 'CON C ' + str(d.connection.ip) + ' S')
+                d.connection.close()
+
     def make_download(self, connection):
         ip = connection.ip
         perip = self.perip.get(ip)
@@ -382,8 +658,142 @@ class Downloader(object):
         self.downloads.append(d)
         return d
 
+    #the order endgame offers blocks to the downloads in, the ones that
+    #deliver a block soonest first with the capped policy so they get the
+    #duplicates
+    def endgame_order(self):
+        if not self.endgame_capped:
+            return self.downloads
+        ds = [(d.block_time(), d) for d in self.downloads]
+        ds.sort()
+        #kept for the round of fix_download_endgame() calls that follows,
+        #rather than every peer working out every holder's again
+        self.block_times = dict([(d, t) for t, d in ds])
+        return [d for t, d in ds]
+
+    #the last blocks are requested, from now on every block still missing
+    #is in all_requests and the downloads need the pieces that have any
+    def start_endgame(self):
+        self.all_requests = BlockSet(self.requests.holders)
+        if self.endgame_capped:
+            self.requests.track_open(self.endgame_max_duplicates,
+                                     self.all_requests)
+        pieces = self.endgame_pieces = {}
+        for index, begin, length in self.all_requests:
+            pieces[index] = pieces.get(index, 0) + 1
+        for d in self.downloads:
+            d.needed = self.count_endgame_needed(d.have)
+
+    def count_endgame_needed(self, have):
+        needed = 0
+        for index in self.endgame_pieces:
+            if have[index]:
+                needed += 1
+        return needed
+
+    #block came in in endgame, the peers that have its piece need one piece
+    #less if it was the last one missing
+    def endgame_received(self, block):
+        if block not in self.all_requests:
+            return
+        self.all_requests.discard(block)
+        index = block[0]
+        count = self.endgame_pieces[index] - 1
+        if count:
+            self.endgame_pieces[index] = count
+            return
+        del self.endgame_pieces[index]
+        for d in self.downloads:
+            if d.have[index]:
+                d.needed -= 1
+
+    #the number of pieces in the Bitfield have that still have blocks to
+    #request
+    def count_needed(self, have):
+        if have.numfalse == 0:
+            bits = self.requestable.tostring()
+        else:
+            both = long(hexlify(have.tostring()), 16) & \
+                   long(hexlify(self.requestable.tostring()), 16)
+            bits = '%x' % both
+            if len(bits) & 1:
+                bits = '0' + bits
+            bits = unhexlify(bits)
+        return sum(array('B', bits.translate(counts)))
+
+    #the last block of index was requested, the peers that have it need one
+    #piece less. Those left with nothing to request lose our interest once
+    #their requests are done
+    def requests_exhausted(self, index):
+        self.requestable[index >> 3] &= ~(128 >> (index & 7)) & 0xFF
+        for d in self.downloads:
+            if d.have[index]:
+                d.needed -= 1
+                if not d.needed and d.interested and not d.active_requests:
+                    d.interested = False
+                    d.connection.send_not_interested()
+
+    #index has blocks to request again, after a request was lost or the
+    #piece failed its hash check
+    def requests_refilled(self, index):
+        self.requestable[index >> 3] |= 128 >> (index & 7)
+        for d in self.downloads:
+            if d.have[index]:
+                d.needed += 1
+                if not d.interested:
+                    d.interested = True
+                    d.connection.send_interested()
+
+    #in streaming, the blocks of the window pieces that are later than
+    #their deadline are requested once more from the unchoked peer that
+    #has them and should deliver them soonest, if that's sooner than the
+    #one they were asked from
+    def check_deadlines(self):
+        window = self.picker.window_pieces()
+        if not window or self.storage.endgame:
+            return
+        due = {}
+        for k, index in enumerate(window):
+            due[index] = self.streaming_deadline * (k + 1)
+        now = bttime()
+        late = []
+        for block, h in self.requests.holders.iteritems():
+            if block[0] not in due or len(h) > 1:
+                continue
+            d = h.keys()[0]
+            if now - d.active_requests[block] > due[block[0]]:
+                late.append((block, d))
+        if not late:
+            return
+        ds = [(d.block_time(), d) for d in self.downloads
+              if not d.choked and d.interested and not d.is_snubbed()]
+        ds.sort()
+        corked = {}
+        for block, holder in late:
+            t = holder.block_time()
+            for dt, d in ds:
+                if dt >= t:
+                    break
+                if d.have[block[0]]:
+                    if d not in corked:
+                        d.connection.cork()
+                        corked[d] = None
+                    self.requests.add(d, block)
+                    d._send_requests([block])
+                    self.deadline_requests += 1
+                    break
+        for d in corked:
+            d._uncork()
+
+    #the torrent's disk queue has room again after _request_more() held off
+    def disk_free(self):
+        for d in self.downloads:
+            if not d.choked:
+                d._request_more()
+
     def lost_peer(self, download):
         self.downloads.remove(download)
+        self.block_times.pop(download, None)
         ip = download.connection.ip
         self.perip[ip].numconnections -= 1
         if self.perip[ip].lastdownload == download:
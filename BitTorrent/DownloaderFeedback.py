@@ -64,6 +64,11 @@ class DownloaderFeedback(object):
                                d.interested, d.choked, d.is_snubbed())
             rec['completed'] = 1 - d.have.numfalse / len(d.have)
             rec['speed'] = d.connection.download.peermeasure.get_rate()
+            # seconds, None until a block has come in
+            rec['rtt'] = d.rtt
+            rec['latency'] = d.latency
+            # (requests to keep outstanding, outstanding now)
+            rec['pipeline'] = (d.backlog, len(d.active_requests))
             l.append(rec)
         return l
 
@@ -99,12 +104,27 @@ class DownloaderFeedback(object):
         status['numCopies'] = numCopies
         status['numCopyList'] = numCopyList
         status['discarded'] = self.downloader.discarded_bytes
+        status['duplicate'] = self.downloader.duplicate_bytes
+        status['deadline_requests'] = self.downloader.deadline_requests
+        if self.downloader.requested_bytes:
+            status['request_writes_per_mb'] = self.downloader.request_writes \
+                                    / (self.downloader.requested_bytes / 2**20)
         status['storage_numcomplete'] = self.storage.stat_numfound + \
                                         self.storage.stat_numdownloaded
         status['storage_dirty'] = len(self.storage.stat_dirty)
         status['storage_active'] = len(self.storage.stat_active)
         status['storage_new'] = len(self.storage.stat_new)
         status['storage_numflunked'] = self.storage.stat_numflunked
+        status['storage_numhashed'] = self.storage.stat_numhashed
+        if self.storage.readcache is not None:
+            hits = self.storage.stat_cache_hits
+            lookups = hits + self.storage.stat_cache_misses
+            if lookups:
+                status['read_cache_hit_rate'] = hits / lookups
+            status['read_cache_saved'] = self.storage.stat_cache_saved
+            status['read_cache_memory'] = self.storage.readcache.size
+        if self.storage.diskqueue is not None:
+            status.update(self.storage.diskqueue.get_stats())
 
         if spewflag:
             status['spew'] = self.collect_spew()
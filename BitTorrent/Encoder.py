@@ -41,7 +41,14 @@ class Encoder(object):
         self.spares = []
         self.banned = {}
         self.logcollector=logcollector
+        # pieces completed since the last HAVE broadcast
+        self.pending_haves = []
+        self.have_stats = {'sent': 0, 'suppressed': 0, 'caught_up': 0,
+                           'writes_saved': 0}
         schedulefunc(self.send_keepalives, config['keepalive_interval'])
+        if config['have_catchup_interval']:
+            schedulefunc(self.send_suppressed_haves,
+                         config['have_catchup_interval'])
 
     def send_keepalives(self):
         self.schedulefunc(self.send_keepalives,
@@ -49,6 +56,55 @@ class Encoder(object):
         for c in self.complete_connections:
             c.send_keepalive()
 
+    def piece_completed(self, index):
+        if not self.pending_haves:
+            self.schedulefunc(self.send_haves, 0)
+        self.pending_haves.append(index)
+
+    # one write per peer for all the pieces completed since the last call.
+    # Unless have_catchup_interval is 0, peers that already have a piece
+    # don't get told about it until the next send_suppressed_haves.
+    def send_haves(self):
+        pieces = self.pending_haves
+        self.pending_haves = []
+        suppress = self.config['have_catchup_interval']
+        stats = self.have_stats
+        for c in self.complete_connections:
+            if suppress:
+                have = c.download.have
+                send = []
+                for i in pieces:
+                    if have[i]:
+                        c.suppressed_haves.append(i)
+                    else:
+                        send.append(i)
+                stats['suppressed'] += len(pieces) - len(send)
+            else:
+                send = pieces
+            stats['writes_saved'] += len(pieces) - (len(send) > 0)
+            if send:
+                stats['sent'] += len(send)
+                c.send_haves(send)
+
+    def send_suppressed_haves(self):
+        self.schedulefunc(self.send_suppressed_haves,
+                          self.config['have_catchup_interval'])
+        stats = self.have_stats
+        for c in self.complete_connections:
+            if c.suppressed_haves:
+                stats['sent'] += len(c.suppressed_haves)
+                stats['caught_up'] += len(c.suppressed_haves)
+                stats['writes_saved'] += len(c.suppressed_haves) - 1
+                c.send_haves(c.suppressed_haves)
+                c.suppressed_haves = []
+
+    def get_have_stats(self):
+        stats = self.have_stats
+        saved = stats['suppressed'] - stats['caught_up']
+        return {'have_sent': stats['sent'], 'have_messages_saved': saved,
+                'have_bytes_saved': saved * 9,
+                'have_writes_saved': stats['writes_saved']}
+
     def start_connection(self, dns, id):
         if dns[0] in self.banned:
             return
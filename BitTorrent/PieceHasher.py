@@ -0,0 +1,135 @@
+# The contents of this file are subject to the BitTorrent Open Source License
+# Version 1.0 (the License).  You may not copy or use this file, in either
+# source code or executable form, except in compliance with the License.  You
+# may obtain a copy of the License at http://www.bittorrent.com/license/.
+#
+# Software distributed under the License is distributed on an AS IS basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied.  See the License
+# for the specific language governing rights and limitations under the
+# License.
+
+from threading import Thread, Event
+from Queue import Queue
+
+try:
+    from hashlib import sha1
+except ImportError:
+    # the old module hashes without releasing the GIL, so the workers take
+    # turns instead of running at once
+    from sha import sha as sha1
+
+try:
+    from multiprocessing import cpu_count
+except ImportError:
+    def cpu_count():
+        return 1
+
+
+class _Job(object):
+
+    __slots__ = ('data', 'done', 'sp', 's')
+
+    def __init__(self, data):
+        self.data = data
+        self.done = Event()
+        self.sp = None
+        self.s = None
+
+
+#Hashes the pieces at some positions of a Storage for the initial hash
+#check. The positions are read in runs of consecutive ones, as large
+#sequential reads, and their pieces hashed on worker threads while the
+#next runs are read, with at most readahead bytes read and not yet handed
+#out. results() gives them back in the order of the positions.
+class PieceHasher(object):
+
+    def __init__(self, storage, piece_size, total_length, positions,
+                 workers, readahead):
+        self.storage = storage
+        self.piece_size = piece_size
+        self.total_length = total_length
+        self.positions = positions
+        if workers <= 0:
+            workers = cpu_count()
+        self.workers = workers
+        self.readahead = max(readahead, piece_size)
+        #the length of the last piece, which the pieces are also hashed up
+        #to, to find the last piece at another position
+        self.lastlen = total_length - \
+            (total_length - 1) // piece_size * piece_size
+
+    #(first position, number of positions) of the runs, in order
+    def _runs(self):
+        most = max(self.readahead // 4 // self.piece_size, 1)
+        start = None
+        for pos in self.positions:
+            if start is not None and pos == start + count and count < most:
+                count += 1
+                continue
+            if start is not None:
+                yield start, count
+            start = pos
+            count = 1
+        if start is not None:
+            yield start, count
+
+    def _work(self, jobs):
+        lastlen = self.lastlen
+        while True:
+            job = jobs.get()
+            if job is None:
+                return
+            data = job.data
+            sh = sha1(buffer(data, 0, lastlen))
+            job.sp = sh.digest()
+            sh.update(buffer(data, lastlen))
+            job.s = sh.digest()
+            job.done.set()
+
+    #yields (data, hash of the first lastlen bytes, hash) for every position
+    def results(self):
+        jobs = Queue()
+        threads = []
+        for i in xrange(self.workers):
+            t = Thread(target = self._work, args = (jobs,))
+            t.setDaemon(True)
+            t.start()
+            threads.append(t)
+        try:
+            runs = self._runs()
+            pending = []
+            first = 0
+            inflight = 0
+            more = True
+            while True:
+                while more and inflight < self.readahead:
+                    try:
+                        start, count = runs.next()
+                    except StopIteration:
+                        more = False
+                        break
+                    begin = start * self.piece_size
+                    end = min(begin + count * self.piece_size,
+                              self.total_length)
+                    data = self.storage.read(begin, end - begin)
+                    inflight += end - begin
+                    for p in xrange(0, end - begin, self.piece_size):
+                        job = _Job(buffer(data, p, self.piece_size))
+                        jobs.put(job)
+                        pending.append(job)
+                if first == len(pending):
+                    return
+                job = pending[first]
+                pending[first] = None
+                first += 1
+                if first > 1000:
+                    del pending[:first]
+                    first = 0
+                job.done.wait()
+                inflight -= len(job.data)
+                yield job.data, job.sp, job.s
+        finally:
+            for t in threads:
+                jobs.put(None)
+            for t in threads:
+                t.join()
@@ -10,7 +10,9 @@
 
 # Written by Bram Cohen
 
-from random import randrange, shuffle, choice
+from random import randrange, shuffle, choice, random
+from binascii import hexlify
+from itertools import chain
 
 #One object for all the connections.
 #object that contains for each piece its status (have/not have),
@@ -36,10 +38,18 @@ class PiecePicker(object):
 
         #seems to be used only in DownloaderFeedback.py
         self.crosscount = [numpieces]
+
+        #the seeds got_bitfield was called for, as {peer: None}. Their
+        #copies are counted all at once: every piece has this many more
+        #copies than numinterests says and interests is indexed with, and
+        #crosscount starts with as many zeros.
+        self.seed_peers = {}
+        self.seeds = 0
         
-        #maintains the pieces that was requested but not yet fully received
-        self.started = []
-        self.seedstarted = []
+        #maintains the pieces that was requested but not yet fully received,
+        #as {piece: None}
+        self.started = {}
+        self.seedstarted = {}
         
         #number of different pieces the local peer has received.
         self.numgot = 0
@@ -48,16 +58,52 @@ class PiecePicker(object):
         self.scrambled = range(numpieces)
         shuffle(self.scrambled)
 
-    def got_have(self, piece):
+        #streaming: the piece a consumer reads next, None when not
+        #streaming. The window is the streaming_window pieces from the
+        #first one not had from the cursor on, window_start; next() picks
+        #from it first, in order.
+        self.cursor = None
+        self.window_start = None
+        self.window = config['streaming_window']
+
+    #moves the cursor to piece, None stops streaming
+    def set_cursor(self, piece):
+        self.cursor = piece
+        self.window_start = piece
+        self._advance_window()
+
+    def _advance_window(self):
+        if self.cursor is None:
+            return
+        i = self.window_start
+        while i < self.numpieces and self.have[i]:
+            i += 1
+        self.window_start = i
+
+    #the pieces in the window not had yet, in order
+    def window_pieces(self):
+        if self.cursor is None:
+            return []
+        return [i for i in xrange(self.window_start,
+                                  min(self.window_start + self.window,
+                                      self.numpieces))
+                if not self.have[i]]
+
+    def _next_in_window(self, havefunc):
+        if self.cursor is None:
+            return None
+        for i in xrange(self.window_start, min(self.window_start +
+                                               self.window, self.numpieces)):
+            if not self.have[i] and havefunc(i):
+                return i
+        return None
+
+    #peer, here and in lost_have and next, is the SingleDownload the event
+    #is about. PiecePicker doesn't use it, BitsetPiecePicker does.
+    def got_have(self, piece, peer = None):
         #piece is the index of the piece contained in the received
         #HAVE message
-        numint = self.numinterests[piece]
-        self.crosscount[numint + self.have[piece]] -= 1
-        self.numinterests[piece] += 1
-        try:
-            self.crosscount[numint + 1 + self.have[piece]] += 1
-        except IndexError:
-            self.crosscount.append(1)
+        numint = self._count_have(piece)
         if self.have[piece]:
             return
         #if there was still no pieces with numint copies, then increase
@@ -66,15 +112,109 @@ class PiecePicker(object):
             self.interests.append([])
         self._shift_over(piece, self.interests[numint], self.interests[numint + 1])
 
-    def lost_have(self, piece):
+    def _count_have(self, piece):
         numint = self.numinterests[piece]
-        self.crosscount[numint + self.have[piece]] -= 1
-        self.numinterests[piece] -= 1
-        self.crosscount[numint - 1 + self.have[piece]] += 1
+        c = numint + self.seeds + self.have[piece]
+        self.crosscount[c] -= 1
+        self.numinterests[piece] += 1
+        try:
+            self.crosscount[c + 1] += 1
+        except IndexError:
+            self.crosscount.append(1)
+        return numint
+
+    def lost_have(self, piece, peer = None):
+        numint = self._count_lost(piece)
         if self.have[piece]:
             return
         self._shift_over(piece, self.interests[numint], self.interests[numint - 1])
 
+    def _count_lost(self, piece):
+        numint = self.numinterests[piece]
+        c = numint + self.seeds + self.have[piece]
+        self.crosscount[c] -= 1
+        self.numinterests[piece] -= 1
+        self.crosscount[c - 1] += 1
+        return numint
+
+    #got_have for every piece in the Bitfield have of a new peer
+    def got_bitfield(self, have, peer = None):
+        if have.numfalse == 0:
+            self._got_seed(peer)
+            return
+        self._shift_all(self._count_bitfield(have.indices(), 1), 1)
+
+    #lost_have for every piece in the Bitfield have of a peer that's gone
+    def lost_bitfield(self, have, peer = None):
+        if peer in self.seed_peers:
+            self._lost_seed(peer)
+            return
+        self._shift_all(self._count_bitfield(have.indices(), -1), -1)
+
+    #_shift_over for all the pieces not had out of pieces, from the interests
+    #list delta below or above the one for their numinterests into it
+    def _shift_all(self, pieces, delta):
+        interests = self.interests
+        pos_in_interests = self.pos_in_interests
+        numinterests = self.numinterests
+        have = self.have
+        for piece in pieces:
+            if have[piece]:
+                continue
+            numint = numinterests[piece]
+            if numint == len(interests):
+                interests.append([])
+            l1 = interests[numint - delta]
+            l2 = interests[numint]
+            last = l1.pop()
+            if last != piece:
+                p = pos_in_interests[piece]
+                l1[p] = last
+                pos_in_interests[last] = p
+            newp = int(random() * (len(l2) + 1))
+            if newp == len(l2):
+                pos_in_interests[piece] = newp
+                l2.append(piece)
+            else:
+                old = l2[newp]
+                pos_in_interests[old] = len(l2)
+                l2.append(old)
+                l2[newp] = piece
+                pos_in_interests[piece] = newp
+
+    def _got_seed(self, peer):
+        self.seed_peers[peer] = None
+        self.seeds += 1
+        self.crosscount.insert(0, 0)
+
+    def _lost_seed(self, peer):
+        del self.seed_peers[peer]
+        self.seeds -= 1
+        del self.crosscount[0]
+
+    #adds delta to the number of copies of pieces and updates crosscount,
+    #returns pieces
+    def _count_bitfield(self, pieces, delta):
+        numinterests = self.numinterests
+        have = self.have
+        crosscount = self.crosscount
+        #room for the top count to go up by one
+        crosscount.append(0)
+        seeds = self.seeds
+        for piece in pieces:
+            numint = numinterests[piece]
+            numinterests[piece] = numint + delta
+            c = numint + seeds + have[piece]
+            crosscount[c] -= 1
+            crosscount[c + delta] += 1
+        if not crosscount[-1]:
+            del crosscount[-1]
+        return pieces
+
+    #called once peer is gone, after lost_have for each of its pieces
+    def lost_peer(self, peer):
+        pass
+
     def _shift_over(self, piece, l1, l2):
         p = self.pos_in_interests[piece]
         #l1[-1] is the last piece in the list
@@ -94,18 +234,18 @@ class PiecePicker(object):
             self.pos_in_interests[piece] = newp
 
     def requested(self, piece, seed = False):
-        if piece not in self.started:
-            self.started.append(piece)
-        if seed and piece not in self.seedstarted:
-            self.seedstarted.append(piece)
+        self.started[piece] = None
+        if seed:
+            self.seedstarted[piece] = None
 
     #called when the last block of a piece was just received
     def complete(self, piece):
         assert not self.have[piece]
         self.have[piece] = True
-        self.crosscount[self.numinterests[piece]] -= 1
+        c = self.numinterests[piece] + self.seeds
+        self.crosscount[c] -= 1
         try:
-            self.crosscount[self.numinterests[piece] + 1] += 1
+            self.crosscount[c + 1] += 1
         except IndexError:
             self.crosscount.append(1)
         self.numgot += 1
@@ -114,13 +254,36 @@ class PiecePicker(object):
         l[p] = l[-1]
         self.pos_in_interests[l[-1]] = p
         del l[-1]
-        try:
-            self.started.remove(piece)
-            self.seedstarted.remove(piece)
-        except ValueError:
-            pass
+        self.started.pop(piece, None)
+        self.seedstarted.pop(piece, None)
+        if piece == self.window_start:
+            self._advance_window()
 
-    def next(self, havefunc, seed = False):
+    def next(self, havefunc, seed = False, peer = None):
+        i = self._next_in_window(havefunc)
+        if i is not None:
+            return i
+        i = self._next_started(havefunc, seed)
+        if i is not None:
+            return i
+        #if less than 3 pieces downloaded, random policy
+        if self.numgot < self.config['rarest_first_cutoff']:
+            for i in self.scrambled:
+                if havefunc(i):
+                    return i
+            return None
+        #rarest first policy, skipping the pieces nobody has unless there
+        #are seeds
+        first = 1
+        if self.seeds:
+            first = 0
+        for i in xrange(first, len(self.interests)):
+            for j in self.interests[i]:
+                if havefunc(j):
+                    return j
+        return None
+
+    def _next_started(self, havefunc, seed):
         bests = None
         bestnum = 2 ** 30
         if seed:
@@ -140,31 +303,258 @@ class PiecePicker(object):
                     bests.append(i)
         if bests:
             return choice(bests)
-        #if less than 3 pieces downloaded, random policy
-        if self.numgot < self.config['rarest_first_cutoff']:
-            for i in self.scrambled:
-                if havefunc(i):
-                    return i
-            return None
-        #rarest first policy
-        for i in xrange(1, min(bestnum, len(self.interests))):
-            for j in self.interests[i]:
-                if havefunc(j):
-                    return j
         return None
 
     def am_I_complete(self):
         return self.numgot == self.numpieces
 
+    #moves piece to the end of its interests list, so it's the last one of
+    #its rarity to be picked again. The list is in random order anyway, so
+    #it just trades places with the last piece.
     def bump(self, piece):
         l = self.interests[self.numinterests[piece]]
         pos = self.pos_in_interests[piece]
-        del l[pos]
-        l.append(piece)
-        for i in range(pos,len(l)):
-            self.pos_in_interests[l[i]] = i
+        last = l[-1]
+        l[pos] = last
+        self.pos_in_interests[last] = pos
+        l[-1] = piece
+        self.pos_in_interests[piece] = len(l) - 1
+        self.started.pop(piece, None)
+        self.seedstarted.pop(piece, None)
+
+
+#pieces per int in BitsetPiecePicker's bitsets
+CHUNK = 1024
+
+#every byte with its bits reversed, turns Bitfield's first piece in the
+#high bit order into first piece in the low bit
+_reverse = ''.join([chr(sum([((i >> j) & 1) << (7 - j) for j in xrange(8)]))
+                    for i in xrange(256)])
+
+#A PiecePicker that keeps pieces in bitsets instead of lists, so next()
+#finds the pieces a peer has among the ones still to be requested and in
+#the rarest bucket with a few int ANDs instead of calling havefunc on
+#every piece. A bitset is a list of ints of CHUNK bits each, piece i is
+#bit i % CHUNK of int i // CHUNK.
+#
+#Pieces that were started are left to the started dicts, the bitsets only
+#hold pieces that nobody has asked for, so every block of them can still
+#be requested. For every peer next() has been called for, the pieces it
+#has out of those are cached and kept up to date as HAVEs come in and
+#pieces get started, completed or bumped.
+class BitsetPiecePicker(PiecePicker):
+
+    def __init__(self, numpieces, config):
+        PiecePicker.__init__(self, numpieces, config)
+        #the lists PiecePicker picks from aren't kept
+        self.interests = None
+        self.pos_in_interests = None
+        self.scrambled = None
+        self.numchunks = (numpieces + CHUNK - 1) // CHUNK
+        #pieces that are neither had nor started
+        self.unstarted = [(1 << CHUNK) - 1] * self.numchunks
+        if numpieces % CHUNK:
+            self.unstarted[-1] = (1 << (numpieces % CHUNK)) - 1
+        #buckets[k] holds the pieces not had that k peers have, not
+        #counting the seeds, see PiecePicker.seeds
+        self.buckets = [list(self.unstarted)]
+        #{peer: unstarted pieces peer has} and {peer: how many there are}
+        self.candidates = {}
+        self.numcandidates = {}
+
+    def got_have(self, piece, peer = None):
+        numint = self._count_have(piece)
+        if self.have[piece]:
+            return
+        c, bit = divmod(piece, CHUNK)
+        bit = 1 << bit
+        self.buckets[numint][c] &= ~bit
+        if numint + 1 == len(self.buckets):
+            self.buckets.append([0] * self.numchunks)
+        self.buckets[numint + 1][c] |= bit
+        cand = self.candidates.get(peer)
+        if cand is not None and self.unstarted[c] & bit and \
+               not cand[c] & bit:
+            cand[c] |= bit
+            self.numcandidates[peer] += 1
+
+    def lost_have(self, piece, peer = None):
+        numint = self._count_lost(piece)
+        if self.have[piece]:
+            return
+        c, bit = divmod(piece, CHUNK)
+        bit = 1 << bit
+        self.buckets[numint][c] &= ~bit
+        self.buckets[numint - 1][c] |= bit
+
+    def got_bitfield(self, have, peer = None):
+        #the cache, if any, is from before the bitfield
+        self.lost_peer(peer)
+        if have.numfalse == 0:
+            self._got_seed(peer)
+            return
+        self._count_bitfield(have.indices(), 1)
+        self.buckets.append([0] * self.numchunks)
+        self._move(self._bitset(have), xrange(len(self.buckets) - 2, -1, -1),
+                   1)
+        if not [x for x in self.buckets[-1] if x]:
+            del self.buckets[-1]
+
+    def lost_bitfield(self, have, peer = None):
+        if peer in self.seed_peers:
+            self._lost_seed(peer)
+            return
+        self._count_bitfield(have.indices(), -1)
+        self._move(self._bitset(have), xrange(1, len(self.buckets)), -1)
+
+    #moves the pieces in bitset from the buckets they are in, looked at in
+    #the order levels gives, delta buckets up
+    def _move(self, bitset, levels, delta):
+        buckets = self.buckets
+        for c in xrange(self.numchunks):
+            p = bitset[c]
+            for k in levels:
+                if not p:
+                    break
+                m = buckets[k][c] & p
+                if m:
+                    buckets[k][c] ^= m
+                    buckets[k + delta][c] |= m
+                    p ^= m
+
+    def lost_peer(self, peer):
+        if peer in self.candidates:
+            del self.candidates[peer]
+            del self.numcandidates[peer]
+
+    def requested(self, piece, seed = False):
+        PiecePicker.requested(self, piece, seed)
+        self._set_started(piece)
+
+    def complete(self, piece):
+        assert not self.have[piece]
+        self.have[piece] = True
+        numint = self.numinterests[piece]
+        self.crosscount[numint + self.seeds] -= 1
         try:
-            self.started.remove(piece)
-            self.seedstarted.remove(piece)
-        except ValueError:
-            pass
+            self.crosscount[numint + self.seeds + 1] += 1
+        except IndexError:
+            self.crosscount.append(1)
+        self.numgot += 1
+        self.started.pop(piece, None)
+        self.seedstarted.pop(piece, None)
+        self._set_started(piece)
+        c, bit = divmod(piece, CHUNK)
+        self.buckets[numint][c] &= ~(1 << bit)
+        if piece == self.window_start:
+            self._advance_window()
+
+    def bump(self, piece):
+        self.started.pop(piece, None)
+        self.seedstarted.pop(piece, None)
+        if self.have[piece]:
+            return
+        c, bit = divmod(piece, CHUNK)
+        bit = 1 << bit
+        if self.unstarted[c] & bit:
+            return
+        self.unstarted[c] |= bit
+        for peer, cand in self.candidates.iteritems():
+            if peer.have[piece]:
+                cand[c] |= bit
+                self.numcandidates[peer] += 1
+
+    #takes piece out of the unstarted pieces
+    def _set_started(self, piece):
+        c, bit = divmod(piece, CHUNK)
+        bit = 1 << bit
+        if not self.unstarted[c] & bit:
+            return
+        self.unstarted[c] &= ~bit
+        for peer, cand in self.candidates.iteritems():
+            if cand[c] & bit:
+                cand[c] &= ~bit
+                self.numcandidates[peer] -= 1
+
+    #the pieces in the Bitfield have as a bitset
+    def _bitset(self, have):
+        bits = have.bits
+        if bits is None:
+            bitset = [(1 << CHUNK) - 1] * self.numchunks
+            if self.numpieces % CHUNK:
+                bitset[-1] = (1 << (self.numpieces % CHUNK)) - 1
+            return bitset
+        bits = bits.tostring().translate(_reverse)
+        step = CHUNK // 8
+        return [int(hexlify(bits[i:i + step][::-1]), 16)
+                for i in xrange(0, len(bits), step)]
+
+    def _candidates(self, peer):
+        cand = self.candidates.get(peer)
+        if cand is not None:
+            return cand
+        cand = [x & u for x, u in zip(self._bitset(peer.have),
+                                      self.unstarted)]
+        self.candidates[peer] = cand
+        self.numcandidates[peer] = sum([bin(x).count('1') for x in cand])
+        return cand
+
+    def next(self, havefunc, seed = False, peer = None):
+        i = self._next_in_window(havefunc)
+        if i is not None:
+            return i
+        i = self._next_started(havefunc, seed)
+        if i is not None:
+            return i
+        cand = self._candidates(peer)
+        n = self.numcandidates[peer]
+        if n and self.numgot < self.config['rarest_first_cutoff']:
+            c = choice([c for c in xrange(self.numchunks) if cand[c]])
+            return _pick(c, cand[c])
+        if n and n <= 64:
+            return self._rarest_of(cand)
+        if n:
+            #pieces nobody has are in buckets[0] unless there are seeds
+            first = 1
+            if self.seeds:
+                first = 0
+            start = randrange(self.numchunks)
+            for k in xrange(first, len(self.buckets)):
+                bucket = self.buckets[k]
+                for c in chain(xrange(start, self.numchunks),
+                               xrange(start)):
+                    m = bucket[c] & cand[c]
+                    if m:
+                        return _pick(c, m)
+        if seed:
+            # pieces started from non-seeds, which PiecePicker would also
+            # give a seed, in order of rarity
+            return self._next_started(havefunc, False)
+        return None
+
+    #the rarest of a few candidates, without going through the buckets
+    def _rarest_of(self, cand):
+        bests = []
+        bestnum = 2 ** 30
+        for c in xrange(self.numchunks):
+            m = cand[c]
+            while m:
+                low = m & -m
+                i = c * CHUNK + low.bit_length() - 1
+                m ^= low
+                n = self.numinterests[i]
+                if n < bestnum:
+                    bests = [i]
+                    bestnum = n
+                elif n == bestnum:
+                    bests.append(i)
+        return choice(bests)
+
+
+#a set bit of m, from a random position on, as a piece index
+def _pick(c, m):
+    shift = randrange(CHUNK)
+    high = m >> shift
+    if high:
+        return c * CHUNK + shift + (high & -high).bit_length() - 1
+    return c * CHUNK + (m & -m).bit_length() - 1
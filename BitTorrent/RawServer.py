@@ -14,12 +14,14 @@ import os
 import sys
 import socket
 import struct
-from bisect import insort
+from heapq import heappush, heappop, heapify
+from collections import deque
+from itertools import islice
 from cStringIO import StringIO
 from traceback import print_exc
-from errno import EWOULDBLOCK, ENOBUFS
+from errno import EWOULDBLOCK, ENOBUFS, EIO
 
-from BitTorrent.platform import bttime
+from BitTorrent.platform import bttime, sendfile
 from BitTorrent import WARNING, CRITICAL, FAQ_URL
 
 try:
@@ -28,19 +30,284 @@ try:
 except ImportError:
     from BitTorrent.selectpoll import poll, error, POLLIN, POLLOUT, POLLERR, POLLHUP
     timemult = 1
+from BitTorrent import selectpoll
+try:
+    from select import epoll, EPOLLET
+except ImportError:
+    epoll = None
+    EPOLLET = 0
 
 NOLINGER = struct.pack('ii', 1, 0)
 
+# Queued writes shorter than this are gathered into one send() call
+SEND_BATCH = 65536
+
+
+# A range of a file queued on a SingleSocket in place of a string. It is
+# sent with sendfile() straight from the page cache. f is a file of its
+# own, see Storage.read_ranges(), so FilePool closing or reopening its
+# files doesn't affect it; it's closed when the last chunk of it is sent
+# or dropped.
+class FileChunk(object):
+
+    def __init__(self, f, offset, length):
+        self.f = f
+        self.offset = offset
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    # the first n bytes and the rest as two chunks
+    def split(self, n):
+        return (FileChunk(self.f, self.offset, n),
+                FileChunk(self.f, self.offset + n, self.length - n))
+
+    def send(self, sock, start):
+        try:
+            amount = sendfile(sock.fileno(), self.f.fileno(),
+                              self.offset + start, self.length - start)
+        except (OSError, IOError), e:
+            raise socket.error(e.errno, e.strerror)
+        except ValueError, e:
+            # the file was closed
+            raise socket.error(EIO, str(e))
+        if amount == 0:
+            # the file got shorter than the chunk
+            raise socket.error(EIO, 'end of file')
+        return amount
+
+
+#Poller machinery: one object per RawServer, wraps the OS readiness API.
+#Every poller remembers the interest mask it last gave the kernel for each
+#fd, so registering the same mask again (which try_write does after every
+#write attempt) costs a dict lookup instead of a system call.
+class PollPoller(object):
+
+    timemult = timemult
+    edge_triggered = False
+
+    def __init__(self):
+        self._poll = poll()
+        self.masks = {}
+        # number of calls that reached the underlying poll object
+        self.syscalls = 0
+        self.events = 0
+
+    def socket_mask(self, want_write):
+        if want_write:
+            return POLLIN | POLLOUT
+        return POLLIN
+
+    def register(self, fd, mask):
+        if not isinstance(fd, (int, long)):
+            fd = fd.fileno()
+        old = self.masks.get(fd)
+        if old == mask:
+            return
+        self.masks[fd] = mask
+        self.syscalls += 1
+        self._set(fd, mask, old is not None)
+
+    def _set(self, fd, mask, known):
+        self._poll.register(fd, mask)
+
+    def unregister(self, fd):
+        if not isinstance(fd, (int, long)):
+            fd = fd.fileno()
+        if fd not in self.masks:
+            return
+        del self.masks[fd]
+        self.syscalls += 1
+        try:
+            self._poll.unregister(fd)
+        except (KeyError, IOError, OSError):
+            # already gone, e.g. the fd was closed first
+            pass
+
+    def poll(self, timeout):
+        self.syscalls += 1
+        events = self._poll.poll(timeout * self.timemult)
+        self.events += len(events)
+        return events
+
+
+class SelectPoller(PollPoller):
+
+    timemult = 1
+
+    def __init__(self):
+        PollPoller.__init__(self)
+        self._poll = selectpoll.poll()
+
+    # selectpoll has its own flag values, which differ from the platform's
+    # when select.poll exists
+    def _set(self, fd, mask, known):
+        t = 0
+        if mask & POLLIN:
+            t |= selectpoll.POLLIN
+        if mask & POLLOUT:
+            t |= selectpoll.POLLOUT
+        self._poll.register(fd, t)
+
+    def poll(self, timeout):
+        events = PollPoller.poll(self, timeout)
+        r = []
+        for fd, t in events:
+            if t & selectpoll.POLLIN:
+                r.append((fd, POLLIN))
+            else:
+                r.append((fd, POLLOUT))
+        return r
+
+
+class EpollPoller(PollPoller):
+
+    timemult = 1
+
+    def __init__(self, edge_triggered=False):
+        PollPoller.__init__(self)
+        self._poll = epoll()
+        self.edge_triggered = edge_triggered
+
+    def socket_mask(self, want_write):
+        # In edge-triggered mode write interest stays on for the lifetime
+        # of the socket; the kernel only reports the transitions, so the
+        # mask never has to be changed.
+        if self.edge_triggered:
+            return POLLIN | POLLOUT | EPOLLET
+        return PollPoller.socket_mask(self, want_write)
+
+    def _set(self, fd, mask, known):
+        if known:
+            self._poll.modify(fd, mask)
+        else:
+            self._poll.register(fd, mask)
+
+    def poll(self, timeout):
+        if timeout > 1e6:
+            timeout = -1
+        return PollPoller.poll(self, timeout)
+
+
+def make_poller(backend='auto', edge_triggered=False):
+    if backend in ('auto', 'epoll') and epoll is not None:
+        return EpollPoller(edge_triggered)
+    if backend in ('auto', 'epoll', 'poll') and timemult == 1000:
+        return PollPoller()
+    return SelectPoller()
+
+
+#Idle timeout machinery. Sockets sit in the bucket of a tick (a
+#granularity-long time slot) no later than the one in which they last saw
+#activity, so expiring connections only means emptying the buckets that
+#have fallen more than timeout behind, not looking at every open socket.
+#Activity updates the socket's last_hit and only moves the socket when its
+#bucket is within one of coming due, so a busy socket is moved about once
+#per timeout and expire() mostly sees the sockets that are idle. A socket
+#that goes quiet before then still gets moved by expire(), to the bucket
+#of its last_hit. Items keep the tick of their bucket in
+#idle_tick. A single level is enough here since all sockets of a RawServer
+#share the same timeout.
+class TimeoutWheel(object):
+
+    def __init__(self, timeout, granularity):
+        self.timeout = timeout
+        self.granularity = granularity
+        # {tick: {item: None}}
+        self.buckets = {}
+        # the next bucket to come due
+        self.oldest = int(bttime() // granularity)
+        # items with an idle_tick up to this are moved on activity
+        self.soon = self.oldest + 1
+
+    # adds item, in the bucket of its last_hit
+    def add(self, item):
+        tick = int(item.last_hit // self.granularity)
+        item.idle_tick = tick
+        bucket = self.buckets.get(tick)
+        if bucket is None:
+            bucket = self.buckets[tick] = {}
+        bucket[item] = None
+
+    def remove(self, item):
+        bucket = self.buckets.get(item.idle_tick)
+        if bucket is not None and item in bucket:
+            del bucket[item]
+            if not bucket:
+                del self.buckets[item.idle_tick]
+
+    # for an item whose last_hit was updated while its idle_tick is no
+    # later than soon
+    def touch(self, item):
+        buckets = self.buckets
+        tick = item.idle_tick
+        bucket = buckets[tick]
+        del bucket[item]
+        if not bucket:
+            del buckets[tick]
+        tick = int(item.last_hit // self.granularity)
+        item.idle_tick = tick
+        bucket = buckets.get(tick)
+        if bucket is None:
+            bucket = buckets[tick] = {}
+        bucket[item] = None
+
+    # returns the items whose last_hit lies in a tick wholly before
+    # t - timeout. An item can therefore live up to one granularity longer
+    # than timeout. The others in the buckets emptied are put in the bucket
+    # of their last_hit.
+    def expire(self, t):
+        granularity = self.granularity
+        buckets = self.buckets
+        last = int((t - self.timeout) // granularity)
+        limit = last * granularity
+        r = []
+        while self.oldest < last:
+            bucket = buckets.pop(self.oldest, None)
+            self.oldest += 1
+            if bucket is None:
+                continue
+            newtick = None
+            for item in bucket:
+                hit = item.last_hit
+                if hit < limit:
+                    r.append(item)
+                    continue
+                tick = int(hit // granularity)
+                if tick != newtick:
+                    newtick = tick
+                    newer = buckets.get(tick)
+                    if newer is None:
+                        newer = buckets[tick] = {}
+                newer[item] = None
+                item.idle_tick = tick
+        self.soon = self.oldest + 1
+        return r
+
 
 #Single socket machinery: write(), close(), etc.
 class SingleSocket(object):
 
+    # there is one of these per connection, keep them small
+    __slots__ = ('raw_server', 'socket', 'handler', 'buffer', 'offset',
+                 'queued_bytes', 'sent_bytes', 'send_calls', 'corked',
+                 'last_hit', 'idle_tick', 'fileno', 'connected', 'context',
+                 'ip')
+
     def __init__(self, raw_server, sock, handler, context, ip=None):
         self.raw_server = raw_server
         self.socket = sock
         self.handler = handler
-        self.buffer = []
+        #queued writes, the first one already partially sent up to offset
+        self.buffer = deque()
+        self.offset = 0
+        self.queued_bytes = 0
+        self.sent_bytes = 0
+        self.send_calls = 0
+        self.corked = 0
         self.last_hit = bttime()
+        raw_server.idle_wheel.add(self)
         self.fileno = sock.fileno()
         self.connected = False
         self.context = context
@@ -61,8 +328,10 @@ class SingleSocket(object):
     def close(self):
         sock = self.socket
         self.socket = None
-        self.buffer = []
+        self.buffer.clear()
+        self.queued_bytes = 0
         del self.raw_server.single_sockets[self.fileno]
+        self.raw_server.idle_wheel.remove(self)
         self.raw_server.poll.unregister(sock)
         self.handler = None
         if self.raw_server.config['close_with_rst']:
@@ -73,33 +342,105 @@ class SingleSocket(object):
         self.socket.shutdown(val)
 
     def is_flushed(self):
-        return len(self.buffer) == 0
+        return not self.buffer
 
     def write(self, s):
         assert self.socket is not None
         self.buffer.append(s)
-        if len(self.buffer) == 1:
+        self.queued_bytes += len(s)
+        if len(self.buffer) == 1 and not self.corked:
             self.try_write()
 
+    # writes made while corked are queued without trying to send them;
+    # the last uncork() flushes them all at once. Returns the number of
+    # send() calls that made.
+    def cork(self):
+        self.corked += 1
+
+    def uncork(self):
+        self.corked -= 1
+        if self.corked or not self.buffer or self.socket is None:
+            return 0
+        send_calls = self.send_calls
+        self.try_write()
+        return self.send_calls - send_calls
+
+    # sends from the front of the queue without consuming it; returns the
+    # number of bytes sent, the number that were offered and the number of
+    # queued writes they came from
+    def _send(self):
+        queue = self.buffer
+        head = queue[0]
+        offset = self.offset
+        if type(head) is FileChunk:
+            return head.send(self.socket, offset), len(head) - offset, 1
+        total = len(head) - offset
+        if len(queue) == 1 or total >= SEND_BATCH:
+            if offset:
+                head = buffer(head, offset)
+            return self.socket.send(head), total, 1
+        # gather the small writes at the front into one send(), copying
+        # each once; large ones and file chunks are sent on their own
+        count = 1
+        for s in islice(queue, 1, None):
+            if type(s) is FileChunk or total + len(s) > SEND_BATCH:
+                break
+            total += len(s)
+            count += 1
+        if count == 1:
+            return self.socket.send(buffer(head, offset)), total, 1
+        data = bytearray(buffer(head, offset))
+        for s in islice(queue, 1, count):
+            data += s
+        return self.socket.send(data), total, count
+
     def try_write(self):
         if self.connected:
+            queue = self.buffer
             try:
-                while self.buffer != []:
-                    amount = self.socket.send(self.buffer[0])
-                    if amount != len(self.buffer[0]):
-                        if amount != 0:
-                            self.buffer[0] = self.buffer[0][amount:]
-                        break
-                    del self.buffer[0]
+                while queue:
+                    amount, total, count = self._send()
+                    self.send_calls += 1
+                    self.sent_bytes += amount
+                    self.queued_bytes -= amount
+                    self.raw_server.send_calls += 1
+                    if amount == total:
+                        for i in xrange(count):
+                            queue.popleft()
+                        self.offset = 0
+                        continue
+                    # drop what was fully sent, remember how far we got
+                    # into the next one instead of slicing it
+                    left = amount + self.offset
+                    while left >= len(queue[0]):
+                        left -= len(queue.popleft())
+                    self.offset = left
+                    break
             except socket.error, e:
                 code, msg = e
                 if code != EWOULDBLOCK:
                     self.raw_server.dead_from_write.append(self)
                     return
-        if self.buffer == []:
-            self.raw_server.poll.register(self.socket, POLLIN)
-        else:
-            self.raw_server.poll.register(self.socket, POLLIN | POLLOUT)
+        poll = self.raw_server.poll
+        poll.register(self.fileno, poll.socket_mask(len(self.buffer) > 0))
+
+
+#Handle returned by RawServer.add_task(). Cancelling only clears the
+#function; the dead entry is dropped when it reaches the top of the heap,
+#or earlier when dead entries make up most of the heap.
+class Task(object):
+
+    def __init__(self, func, context, token, server=None):
+        self.func = func
+        self.context = context
+        self.token = token
+        #the RawServer while the task is waiting in its heap
+        self.server = server
+
+    def cancel(self):
+        self.func = None
+        if self.server is not None:
+            self.server._task_died(self)
 
 
 def default_error_handler(level, message):
@@ -112,19 +453,38 @@ class RawServer(object):
                  errorfunc=default_error_handler, tos=0):
         self.config = config
         self.tos = tos
-        self.poll = poll()
+        self.poll = make_poller(config['poll_backend'],
+                                config['epoll_edge_triggered'])
         # {socket: SingleSocket}
         self.single_sockets = {}
         self.dead_from_write = []
         self.doneflag = doneflag
         self.noisy = noisy
         self.errorfunc = errorfunc
-        #funcs is a list
+        #funcs is a heap of (time, sequence number, Task) tuples
         self.funcs = []
+        self.task_seq = 0
+        #{context: live tasks of it in funcs}, and the dead entries in funcs
+        self.context_tasks = {}
+        self.dead_tasks = 0
+        self.task_pops = 0
+        self.task_latency = 0.0
         self.externally_added_tasks = []
         self.listening_handlers = {}
         self.serversockets = {}
-        self.live_contexts = {None : True}
+        #{context: token}, tasks carry the token of their context when
+        #they were scheduled and are skipped if it is no longer current
+        self.live_contexts = {None : object()}
+        self.send_calls = 0
+        # receive buffer shared by all sockets, see _read_socket()
+        self.readbuf = bytearray(config['read_buffer_size'])
+        self.readview = memoryview(self.readbuf)
+        self.pending_reads = []
+        self.recv_calls = 0
+        self.recv_bytes = 0
+        self.recv_copies = 0
+        self.idle_wheel = TimeoutWheel(config['socket_timeout'],
+                                       config['timeout_check_interval'])
         self.add_task(self.scan_for_timeouts, config['timeout_check_interval'])
         if sys.platform != 'win32':
             self.wakeupfds = os.pipe()
@@ -138,17 +498,79 @@ class RawServer(object):
             wakeup()
 
     def add_context(self, context):
-        self.live_contexts[context] = True
+        self.live_contexts[context] = object()
 
+    #the context's pending tasks stay in the heap, but their token no longer
+    #matches so they are discarded when they come due
     def remove_context(self, context):
         del self.live_contexts[context]
-        self.funcs = [x for x in self.funcs if x[2] != context]
+        self.dead_tasks += self.context_tasks.pop(context, 0)
+        self._compact_tasks()
 
-    #schedule tasks. insort maintains an ordered list of events.
-    #insort(list,item) inserts the item in the list so that list is still ordered
+    #schedule tasks. The heap keeps the next task to run at funcs[0].
+    #Returns a Task whose cancel() method unschedules it.
     def add_task(self, func, delay, context=None):
-        if context in self.live_contexts:
-            insort(self.funcs, (bttime() + delay, func, context))
+        token = self.live_contexts.get(context)
+        if token is None:
+            return Task(None, context, None)
+        task = Task(func, context, token, self)
+        self.task_seq += 1
+        heappush(self.funcs, (bttime() + delay, self.task_seq, task))
+        self.context_tasks[context] = self.context_tasks.get(context, 0) + 1
+        return task
+
+    def _task_is_live(self, task):
+        return task.func is not None and \
+               self.live_contexts.get(task.context) is task.token
+
+    #a task in the heap was cancelled. Tasks of removed contexts were
+    #already counted as dead by remove_context().
+    def _task_died(self, task):
+        task.server = None
+        if self.live_contexts.get(task.context) is not task.token:
+            return
+        self.context_tasks[task.context] -= 1
+        self.dead_tasks += 1
+        self._compact_tasks()
+
+    #drops the dead entries once they are more than half of the heap, so
+    #cancelled tasks and those of removed contexts don't pile up in it
+    def _compact_tasks(self):
+        funcs = self.funcs
+        if self.dead_tasks * 2 <= len(funcs):
+            return
+        funcs[:] = [x for x in funcs if self._task_is_live(x[2])]
+        heapify(funcs)
+        self.dead_tasks = 0
+
+    #takes a task popped off the heap out of the counts and returns whether
+    #it is to be run
+    def _popped(self, task):
+        if not self._task_is_live(task):
+            self.dead_tasks -= 1
+            return False
+        task.server = None
+        self.context_tasks[task.context] -= 1
+        return True
+
+    def get_stats(self):
+        latency = 0.0
+        if self.task_pops:
+            latency = self.task_latency / self.task_pops
+        # task_pop_latency: average time between a task coming due and
+        # being popped off the heap
+        # tasks: the live ones waiting, dead_tasks: cancelled ones and
+        # those of removed contexts still in the heap
+        return {'tasks': len(self.funcs) - self.dead_tasks,
+                'dead_tasks': self.dead_tasks,
+                'tasks_run': self.task_pops,
+                'task_pop_latency': latency,
+                'send_calls': self.send_calls,
+                'recv_calls': self.recv_calls,
+                'recv_bytes': self.recv_bytes,
+                'recv_copies': self.recv_copies,
+                'poll_syscalls': self.poll.syscalls,
+                'poll_events': self.poll.events}
 
     def external_add_task(self, func, delay, context=None):
         self.externally_added_tasks.append((func, delay, context))
@@ -159,11 +581,7 @@ class RawServer(object):
     def scan_for_timeouts(self):
         self.add_task(self.scan_for_timeouts,
                       self.config['timeout_check_interval'])
-        t = bttime() - self.config['socket_timeout']
-        tokill = []
-        for s in self.single_sockets.values():
-            if s.last_hit < t:
-                tokill.append(s)
+        tokill = self.idle_wheel.expire(bttime())
         for k in tokill:
             if k.socket is not None:
                 self._close_socket(k)
@@ -212,14 +630,14 @@ class RawServer(object):
         except Exception, e:
             sock.close()
             raise socket.error(str(e))
-        self.poll.register(sock, POLLIN)
+        self.poll.register(sock, self.poll.socket_mask(False))
         s = SingleSocket(self, sock, handler, context, dns[0])
         self.single_sockets[sock.fileno()] = s
         return s
 
     def wrap_socket(self, sock, handler, context=None, ip=None):
         sock.setblocking(0)
-        self.poll.register(sock, POLLIN)
+        self.poll.register(sock, self.poll.socket_mask(False))
         s = SingleSocket(self, sock, handler, context, ip)
         self.single_sockets[sock.fileno()] = s
         return s
@@ -242,7 +660,8 @@ class RawServer(object):
                         newsock.setblocking(0)
                         nss = SingleSocket(self, newsock, handler, context)
                         self.single_sockets[newsock.fileno()] = nss
-                        self.poll.register(newsock, POLLIN)
+                        self.poll.register(newsock,
+                                           self.poll.socket_mask(False))
                         self._make_wrapped_call(handler. \
                            external_connection_made, (nss,), context=context)
                     except socket.error, e:
@@ -266,47 +685,99 @@ class RawServer(object):
                 #reset last_hit in this part of the code. 
                 if event & (POLLIN | POLLHUP):
                     s.last_hit = bttime()
-                    try:
-                        data = s.socket.recv(100000)
-                    except socket.error, e:
-                        code, msg = e
-                        if code != EWOULDBLOCK:
-                            self._close_socket(s)
-                        continue
-                    if data == '':
-                        self._close_socket(s)
-                    else:
-                        self._make_wrapped_call(s.handler.data_came_in,
-                                                (s, data), s)
+                    if s.idle_tick <= self.idle_wheel.soon:
+                        self.idle_wheel.touch(s)
+                    self._read_socket(s)
                 # data_came_in could have closed the socket (s.socket = None)
-                if event & POLLOUT and s.socket is not None:
+                if event & POLLOUT and s.socket is not None and \
+                       not s.is_flushed():
                     s.try_write()
                     if s.is_flushed():
                         self._make_wrapped_call(s.handler.connection_flushed,
                                                 (s,), s)
 
+    # Reads into the shared receive buffer until the socket has no more data
+    # or max_read_per_event bytes have been read, so that one fast peer can't
+    # starve the others. Handlers with accepts_buffer set get a memoryview
+    # of the buffer that is only valid during the data_came_in call, others
+    # get a string copy as before.
+    def _read_socket(self, s):
+        edge_triggered = self.poll.edge_triggered
+        budget = self.config['max_read_per_event']
+        size = len(self.readbuf)
+        while True:
+            try:
+                n = s.socket.recv_into(self.readbuf, min(size, budget))
+            except socket.error, e:
+                code, msg = e
+                if code != EWOULDBLOCK:
+                    self._close_socket(s)
+                return
+            self.recv_calls += 1
+            if n == 0:
+                self._close_socket(s)
+                return
+            self.recv_bytes += n
+            if getattr(s.handler, 'accepts_buffer', False):
+                data = self.readview[:n]
+            else:
+                data = self.readview[:n].tobytes()
+                self.recv_copies += 1
+            self._make_wrapped_call(s.handler.data_came_in, (s, data), s)
+            if s.socket is None:
+                return
+            budget -= n
+            if budget <= 0:
+                # an edge-triggered poller won't report the rest of the
+                # data again, so come back to it on the next loop
+                if edge_triggered:
+                    self.pending_reads.append(s)
+                return
+            # a short read means the socket is most likely drained; with
+            # edge-triggered polling we have to see EWOULDBLOCK to be sure
+            if n < size and not edge_triggered:
+                return
+
     def _pop_externally_added(self):
         while self.externally_added_tasks:
             task = self.externally_added_tasks.pop(0)
             self.add_task(*task)
 
+    def _run_due_tasks(self):
+        funcs = self.funcs
+        t = bttime()
+        while funcs and funcs[0][0] <= t:
+            when, garbage, task = heappop(funcs)
+            if not self._popped(task):
+                continue
+            self.task_pops += 1
+            self.task_latency += t - when
+            self._make_wrapped_call(task.func, (), context=task.context)
+            t = bttime()
+
     #execute the tasks scheduled in the stack. 
     def listen_forever(self):
         while not self.doneflag.isSet():
             try:
                 self._pop_externally_added()
-                if not self.funcs:
+                funcs = self.funcs
+                while funcs and not self._task_is_live(funcs[0][2]):
+                    self._popped(heappop(funcs)[2])
+                if not funcs:
                     period = 1e9
                 else:
-                    period = self.funcs[0][0] - bttime()
-                if period < 0:
+                    period = funcs[0][0] - bttime()
+                if period < 0 or self.pending_reads:
                     period = 0
-                events = self.poll.poll(period * timemult)
+                events = self.poll.poll(period)
+                if self.pending_reads:
+                    for s in self.pending_reads:
+                        if s.socket is not None:
+                            events.append((s.fileno, POLLIN))
+                    self.pending_reads = []
                 if self.doneflag.isSet():
                     return
-                while self.funcs and self.funcs[0][0] <= bttime():
-                    garbage, func, context = self.funcs.pop(0)
-                    self._make_wrapped_call(func, (), context=context)
+                self._run_due_tasks()
                 self._close_dead()
                 self._handle_events(events)
                 if self.doneflag.isSet():
@@ -369,9 +840,11 @@ class RawServer(object):
         sock = s.socket.fileno()
         if self.config['close_with_rst']:
             s.socket.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, NOLINGER)
-        s.socket.close()
+        # unregister before close, epoll can't look up a closed fd
         self.poll.unregister(sock)
+        s.socket.close()
         del self.single_sockets[sock]
+        self.idle_wheel.remove(s)
         s.socket = None
         self._make_wrapped_call(s.handler.connection_lost, (s,), s)
         s.handler = None
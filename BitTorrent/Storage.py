@@ -13,12 +13,30 @@
 import os
 from bisect import bisect_right
 from array import array
+from threading import Lock
+from collections import deque
+from weakref import WeakValueDictionary
 
 from BitTorrent.obsoletepythonsupport import *
 
 from BitTorrent import BTFailure
 
 
+#joins blocks of data, copying each once. Blocks that came in split
+#across reads are memoryviews (see Connection.data_came_in), which
+#''.join() doesn't take; the result is then a bytearray.
+def join_blocks(parts):
+    for p in parts:
+        if type(p) is not str:
+            break
+    else:
+        return ''.join(parts)
+    r = bytearray()
+    for p in parts:
+        r += p
+    return r
+
+
 class FilePool(object):
 
     def __init__(self, max_files_open):
@@ -26,6 +44,14 @@ class FilePool(object):
         self.handlebuffer = None
         self.handles = {}
         self.whandles = {}
+        #the handles are shared by the disk I/O threads, which take the lock
+        #to get one and count it as in use, so it isn't closed to make room
+        #for another until they're done with it
+        self.lock = Lock()
+        self.inuse = {}
+        #{filename: file} of the duplicates Storage.read_ranges() hands
+        #out, kept while anything refers to them
+        self.sendfiles = WeakValueDictionary()
         self.set_max_files_open(max_files_open)
 
     def close_all(self):
@@ -71,6 +97,67 @@ class FilePool(object):
             self.handlebuffer = None
 
 
+#Whole pieces read for uploads, shared by all the torrents like the
+#FilePool and keyed by (torrent, piece). When the pieces take more than
+#max_bytes the ones used longest ago are dropped.
+class ReadCache(object):
+
+    def __init__(self, max_bytes):
+        self.pieces = {}
+        self.used = {}
+        #(used, key) in the order the pieces were used, with entries left
+        #behind by pieces used again or dropped since
+        self.order = deque()
+        self.clock = 0
+        self.size = 0
+        self.set_max_bytes(max_bytes)
+
+    def set_max_bytes(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._shrink()
+
+    def get(self, key):
+        data = self.pieces.get(key)
+        if data is not None:
+            self._use(key)
+        return data
+
+    def add(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+        self.discard(key)
+        self.pieces[key] = data
+        self._use(key)
+        self.size += len(data)
+        self._shrink()
+
+    def _use(self, key):
+        used = self.used
+        used[key] = self.clock
+        self.order.append((self.clock, key))
+        self.clock += 1
+        if len(self.order) > 2 * len(used) + 16:
+            self.order = deque([(u, k) for u, k in self.order
+                                if used.get(k) == u])
+
+    def discard(self, key):
+        data = self.pieces.pop(key, None)
+        if data is not None:
+            del self.used[key]
+            self.size -= len(data)
+
+    def remove_torrent(self, torrent):
+        for key in self.pieces.keys():
+            if key[0] is torrent:
+                self.discard(key)
+
+    def _shrink(self):
+        while self.size > self.max_bytes:
+            used, key = self.order.popleft()
+            if self.used.get(key) == used:
+                self.discard(key)
+
+
 # Make this a separate function because having this code in Storage.__init__()
 # would make python print a SyntaxWarning (uses builtin 'file' before 'global')
 
@@ -145,6 +232,26 @@ class Storage(object):
         return r
 
     def _get_file_handle(self, filename, for_write):
+        self.filepool.lock.acquire()
+        try:
+            h = self._open_file_handle(filename, for_write)
+            inuse = self.filepool.inuse
+            inuse[filename] = inuse.get(filename, 0) + 1
+            return h
+        finally:
+            self.filepool.lock.release()
+
+    def _release_file_handle(self, filename):
+        self.filepool.lock.acquire()
+        try:
+            inuse = self.filepool.inuse
+            inuse[filename] -= 1
+            if not inuse[filename]:
+                del inuse[filename]
+        finally:
+            self.filepool.lock.release()
+
+    def _open_file_handle(self, filename, for_write):
         handlebuffer = self.filepool.handlebuffer
         if filename in self.handles:
             if for_write and filename not in self.whandles:
@@ -162,11 +269,15 @@ class Storage(object):
                 self.handles[filename] = file(filename, 'rb', 0)
             if handlebuffer is not None:
                 if len(handlebuffer) >= self.filepool.max_files_open:
-                    oldfile = handlebuffer.pop(0)
-                    if oldfile in self.whandles:   # .pop() in python 2.3
-                        del self.whandles[oldfile]
-                    self.handles[oldfile].close()
-                    del self.handles[oldfile]
+                    #the least recently used one not in use on another thread
+                    for oldfile in handlebuffer:
+                        if oldfile not in self.filepool.inuse:
+                            handlebuffer.remove(oldfile)
+                            if oldfile in self.whandles:   # .pop() in python 2.3
+                                del self.whandles[oldfile]
+                            self.handles[oldfile].close()
+                            del self.handles[oldfile]
+                            break
                 handlebuffer.append(filename)
         return self.handles[filename]
 
@@ -174,23 +285,68 @@ class Storage(object):
         r = []
         for filename, pos, end in self._intervals(pos, amount):
             h = self._get_file_handle(filename, False)
-            h.seek(pos)
-            r.append(h.read(end - pos))
+            try:
+                h.seek(pos)
+                r.append(h.read(end - pos))
+            finally:
+                self._release_file_handle(filename)
         r = ''.join(r)
         if len(r) != amount:
             raise BTFailure('Short read - something truncated files?')
         return r
 
+    # like read(), but returns (file, offset, length) ranges for the data
+    # instead of the data itself. The files are duplicates of the pooled
+    # ones, which may be closed or reopened before the data is sent. The
+    # ranges of a file share one, which is closed once nothing refers to
+    # it any more.
+    def read_ranges(self, pos, amount):
+        r = []
+        for filename, pos, end in self._intervals(pos, amount):
+            h = self._get_file_handle(filename, False)
+            try:
+                if os.fstat(h.fileno()).st_size < end:
+                    raise BTFailure('Short read - something truncated files?')
+                f = self._send_file(filename, h)
+            finally:
+                self._release_file_handle(filename)
+            r.append((f, pos, end - pos))
+        return r
+
+    def _send_file(self, filename, h):
+        self.filepool.lock.acquire()
+        try:
+            f = self.filepool.sendfiles.get(filename)
+            if f is None:
+                f = os.fdopen(os.dup(h.fileno()), 'rb', 0)
+                self.filepool.sendfiles[filename] = f
+            return f
+        finally:
+            self.filepool.lock.release()
+
     def write(self, pos, s):
         # might raise an IOError
         total = 0
         for filename, begin, end in self._intervals(pos, len(s)):
             h = self._get_file_handle(filename, True)
-            h.seek(begin)
-            h.write(s[total: total + end - begin])
+            try:
+                h.seek(begin)
+                if end - begin == len(s):
+                    h.write(s)
+                else:
+                    h.write(s[total: total + end - begin])
+            finally:
+                self._release_file_handle(filename)
             total += end - begin
 
     def close(self):
+        self.filepool.lock.acquire()
+        try:
+            self._close()
+        finally:
+            self.filepool.lock.release()
+
+    def _close(self):
         error = None
         for filename in self.handles.keys():
             if filename in self.myfiles:
@@ -12,20 +12,20 @@
 
 from __future__ import division
 
-from sha import sha
 from array import array
-from binascii import b2a_hex
+from collections import deque
+
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import sha as sha1
 
 from BitTorrent.bitfield import Bitfield
+from BitTorrent.PieceHasher import PieceHasher
+from BitTorrent.Storage import join_blocks
+from BitTorrent.messages import toint, tobinary
 from BitTorrent import BTFailure, INFO, WARNING, ERROR, CRITICAL
 
-def toint(s):
-    return int(b2a_hex(s), 16)
-
-def tobinary(i):
-    return (chr(i >> 24) + chr((i >> 16) & 0xFF) +
-        chr((i >> 8) & 0xFF) + chr(i & 0xFF))
-
 NO_PLACE = -1
 
 ALLOCATED = -1
@@ -35,7 +35,8 @@ FASTRESUME_PARTIAL = -3
 class StorageWrapper(object):
 
     def __init__(self, storage, config, hashes, piece_size, finished,
-            statusfunc, flag, data_flunked, infohash, errorfunc, resumefile, logcollector):
+            statusfunc, flag, data_flunked, infohash, errorfunc, resumefile, logcollector,
+            readcache = None, diskqueue = None, piece_checked = None):
         self.numpieces = len(hashes)
         self.storage = storage
         self.logcollector = logcollector
@@ -80,11 +81,48 @@ class StorageWrapper(object):
         self.stat_numfound = 0
         self.stat_numflunked = 0
         self.stat_numdownloaded = 0
+        #pieces checked as they came in, without reading them back
+        self.stat_numhashed = 0
         self.stat_active = {}
         self.stat_new = {}
         self.stat_dirty = {}
         self.download_history = {}
         self.failed_pieces = {}
+        #blocks of unfinished pieces not written to disk yet, by piece and
+        #begin, and when each piece got its first one
+        self.write_cache = {}
+        self.write_cache_age = {}
+        self.write_cache_clock = 0
+        self.write_cached = 0
+        self.write_cache_size = config['write_cache_size']
+        #pieces finished in the write cache away from their place, kept as
+        #(age, data) to be moved there without reading them back
+        self.unplaced = {}
+        #(age, piece) of the cached and the unplaced pieces, oldest first,
+        #with entries left behind by pieces written or dropped since
+        self.write_cache_order = deque()
+        #pieces given a place whose partial marks aren't written there yet
+        self.unmarked = {}
+        #running hashes of pieces downloaded since they were given a place,
+        #by piece: [sha1, bytes hashed, {begin: block} of the blocks that
+        #came in past them]. A piece flushed with blocks past the hashed
+        #ones loses its entry and is read back to be checked, so these
+        #blocks are never kept longer than the write cache keeps them
+        self.hashing = {}
+        #the ReadCache shared with the other torrents, and how many blocks
+        #were found in it for uploads, how many not and their bytes found
+        self.readcache = readcache
+        self.stat_cache_hits = 0
+        self.stat_cache_misses = 0
+        self.stat_cache_saved = 0
+        #the DiskQueue the writes and the reads for uploads go through, if
+        #they are done on the disk I/O threads, and the blocks waiting for
+        #whole pieces read on them, by piece. Pieces that have to be read
+        #back to be checked are checked on them too, piece_checked is then
+        #called with the piece and whether it passed
+        self.diskqueue = diskqueue
+        self.piece_reads = {}
+        self.piece_checked = piece_checked
 
         if self.numpieces == 0:
             return
@@ -99,6 +137,11 @@ class StorageWrapper(object):
                     targets[hashes[i]] = i
         if total and check_hashes:
             statusfunc('checking existing file', 0)
+        if not fastresume:
+            hasher = PieceHasher(storage, piece_size, self.total_length,
+                [i for i in xrange(self.numpieces) if self.rplaces[i] ==
+                 ALLOCATED], config['hash_workers'],
+                config['hash_readahead']).results()
         def markgot(piece, pos):
             if self.have[piece]:
                 if piece != pos:
@@ -115,48 +158,52 @@ class StorageWrapper(object):
             if not fastresume:
                 self.waschecked[piece] = True
             self.stat_numfound += 1
-        lastlen = self._piecelen(self.numpieces - 1)
         partials = {}
-        for i in xrange(self.numpieces):
-            if not self._waspre(i):
-                if self.rplaces[i] != UNALLOCATED:
-                    raise BTFailure("--check_hashes 0 or fastresume info "
-                                    "doesn't match file state (missing data)")
-                continue
-            elif fastresume:
-                t = self.rplaces[i]
-                if t >= 0:
-                    markgot(t, i)
-                    continue
-                if t == UNALLOCATED:
-                    raise BTFailure("Bad fastresume info (files contain more "
-                                    "data)")
-                if t == ALLOCATED:
+        #the hasher's read-ahead threads are stopped even if the check
+        #fails part way
+        try:
+            for i in xrange(self.numpieces):
+                if not self._waspre(i):
+                    if self.rplaces[i] != UNALLOCATED:
+                        raise BTFailure("--check_hashes 0 or fastresume info "
+                                        "doesn't match file state "
+                                        "(missing data)")
                     continue
-                if t!= FASTRESUME_PARTIAL:
-                    raise BTFailure("Bad fastresume info (illegal value)")
-                data = self.storage.read(self.piece_size * i,
-                                         self._piecelen(i))
-                self._check_partial(i, partials, data)
-                self.rplaces[i] = ALLOCATED
-            else:
-                data = self.storage.read(piece_size * i, self._piecelen(i))
-                sh = sha(buffer(data, 0, lastlen))
-                sp = sh.digest()
-                sh.update(buffer(data, lastlen))
-                s = sh.digest()
-                if s == hashes[i]:
-                    markgot(i, i)
-                elif s in targets and self._piecelen(i) == self._piecelen(targets[s]):
-                    markgot(targets[s], i)
-                elif not self.have[self.numpieces - 1] and sp == hashes[-1] and (i == self.numpieces - 1 or not self._waspre(self.numpieces - 1)):
-                    markgot(self.numpieces - 1, i)
-                else:
+                elif fastresume:
+                    t = self.rplaces[i]
+                    if t >= 0:
+                        markgot(t, i)
+                        continue
+                    if t == UNALLOCATED:
+                        raise BTFailure("Bad fastresume info (files "
+                                        "contain more data)")
+                    if t == ALLOCATED:
+                        continue
+                    if t!= FASTRESUME_PARTIAL:
+                        raise BTFailure("Bad fastresume info (illegal value)")
+                    data = self.storage.read(self.piece_size * i,
+                                             self._piecelen(i))
                     self._check_partial(i, partials, data)
-                statusfunc(fractionDone = 1 - self.amount_left /
-                           self.total_length)
-            if flag.isSet():
-                return
+                    self.rplaces[i] = ALLOCATED
+                else:
+                    data, sp, s = hasher.next()
+                    if s == hashes[i]:
+                        markgot(i, i)
+                    elif s in targets and self._piecelen(i) == self._piecelen(targets[s]):
+                        markgot(targets[s], i)
+                    elif not self.have[self.numpieces - 1] and sp == hashes[-1] and (i == self.numpieces - 1 or not self._waspre(self.numpieces - 1)):
+                        markgot(self.numpieces - 1, i)
+                    else:
+                        self._check_partial(i, partials, data)
+                    statusfunc(fractionDone = 1 - self.amount_left /
+                               self.total_length)
+                if flag.isSet():
+                    break
+        finally:
+            if not fastresume:
+                hasher.close()
+        if flag.isSet():
+            return
         self.amount_left_with_partials = self.amount_left
         for piece in partials:
             if self.places[piece] < 0:
@@ -228,31 +275,205 @@ class StorageWrapper(object):
             self.storage.allocated(p, length)
         self.places[piece] = pos
         self.rplaces[pos] = piece
-        # "if self.rplaces[pos] != ALLOCATED:" to skip extra mark writes
+        #the marks are written with the first blocks flushed, if the piece
+        #isn't finished in memory
+        self.unmarked[piece] = None
+        self.hashing[piece] = [sha1(), 0, {}]
+
+    def _partial_marks(self, piece, length):
         mark = self.partial_mark + tobinary(piece)
         mark += chr(0xff) * (self.config['download_slice_size'] - len(mark))
         mark *= (length - 1) // len(mark) + 1
-        self.storage.write(p, buffer(mark, 0, length))
+        return mark[:length]
 
     def _move_piece(self, oldpos, newpos):
         assert self.rplaces[newpos] < 0
         assert self.rplaces[oldpos] >= 0
-        data = self.storage.read(self.piece_size * oldpos,
-                                 self._piecelen(newpos))
-        self.storage.write(self.piece_size * newpos, data)
-        if self.rplaces[newpos] == UNALLOCATED:
-            self.storage.allocated(self.piece_size * newpos, len(data))
         piece = self.rplaces[oldpos]
+        length = self._piecelen(newpos)
+        if piece in self.unplaced:
+            self._write(self.piece_size * newpos,
+                        self.unplaced[piece][1][:length])
+            if newpos == piece:
+                self._drop_unplaced(piece)
+        #nothing of an unmarked piece is on disk yet
+        elif piece not in self.unmarked:
+            check = None
+            if self.have[piece]:
+                check = piece
+            args = (oldpos, newpos, length, check)
+            if self.diskqueue is None:
+                self._copy_place(*args)
+            else:
+                self.diskqueue.submit(self._copy_place, args)
+        if self.rplaces[newpos] == UNALLOCATED:
+            self.storage.allocated(self.piece_size * newpos, length)
         self.places[piece] = newpos
         self.rplaces[oldpos] = ALLOCATED
         self.rplaces[newpos] = piece
-        if not self.have[piece]:
+
+    #copies a place to another one, checking the hash of piece if it's a
+    #complete one. This runs on the disk I/O threads if there are any.
+    def _copy_place(self, oldpos, newpos, length, piece):
+        data = self.storage.read(self.piece_size * oldpos, length)
+        self.storage.write(self.piece_size * newpos, data)
+        if piece is None:
             return
         data = data[:self._piecelen(piece)]
-        if sha(data).digest() != self.hashes[piece]:
+        if sha1(data).digest() != self.hashes[piece]:
             raise BTFailure('data corrupted on disk - '
                             'maybe you have two copies running?')
 
+    def _write(self, pos, data):
+        if self.diskqueue is None:
+            self.storage.write(pos, data)
+        else:
+            self.diskqueue.write(self.storage, pos, data)
+
+    #whether the torrent's disk I/O queue is full, func is then called once
+    #it isn't any more
+    def disk_full(self, func):
+        if self.diskqueue is None or not self.diskqueue.full():
+            return False
+        self.diskqueue.when_free(func)
+        return True
+
+    def _hash_block(self, index, begin, piece):
+        h = self.hashing.get(index)
+        if h is None:
+            return
+        if begin != h[1]:
+            h[2][begin] = piece
+            return
+        sh, x, later = h
+        sh.update(piece)
+        x += len(piece)
+        while x in later:
+            piece = later.pop(x)
+            sh.update(piece)
+            x += len(piece)
+        h[1] = x
+
+    def _cache_block(self, index, begin, piece):
+        blocks = self.write_cache.get(index)
+        if blocks is None:
+            blocks = self.write_cache[index] = {}
+            self.write_cache_age[index] = self._next_age(index)
+        blocks[begin] = piece
+        self.write_cached += len(piece)
+        self._shrink_write_cache()
+
+    def _next_age(self, index):
+        age = self.write_cache_clock
+        self.write_cache_clock += 1
+        order = self.write_cache_order
+        order.append((age, index))
+        if len(order) > 2 * (len(self.write_cache_age) +
+                             len(self.unplaced)) + 16:
+            self.write_cache_order = deque([(a, i) for a, i in order
+                                            if self._has_age(i, a)])
+        return age
+
+    def _has_age(self, index, age):
+        if self.write_cache_age.get(index) == age:
+            return True
+        u = self.unplaced.get(index)
+        return u is not None and u[0] == age
+
+    #writes out or drops the oldest pieces while the cache is too big
+    def _shrink_write_cache(self):
+        while self.write_cached > self.write_cache_size:
+            age, i = self.write_cache_order.popleft()
+            if self.write_cache_age.get(i) == age:
+                self._flush_piece(i)
+            elif self._has_age(i, age):
+                self._drop_unplaced(i)
+
+    #keeps the data of a piece checked in the write cache that's away from
+    #its place
+    def _keep_unplaced(self, index, data):
+        if data is None or self.places[index] == index or \
+               len(data) > self.write_cache_size:
+            return
+        self.unplaced[index] = (self._next_age(index), data)
+        self.write_cached += len(data)
+        self._shrink_write_cache()
+
+    def _drop_unplaced(self, index):
+        age, data = self.unplaced.pop(index)
+        self.write_cached -= len(data)
+
+    #the piece from the write cache, if all of it is there
+    def _cached_data(self, index):
+        blocks = self.write_cache.get(index)
+        if blocks is None:
+            return None
+        begins = blocks.keys()
+        begins.sort()
+        r = []
+        x = 0
+        for b in begins:
+            if b != x:
+                return None
+            r.append(blocks[b])
+            x += len(blocks[b])
+        if x != self._piecelen(index):
+            return None
+        return join_blocks(r)
+
+    def _uncache(self, index):
+        blocks = self.write_cache.pop(index, None)
+        if blocks is not None:
+            del self.write_cache_age[index]
+            for piece in blocks.itervalues():
+                self.write_cached -= len(piece)
+        if index in self.unmarked:
+            del self.unmarked[index]
+
+    #writes the cached blocks of a piece, runs of adjacent ones at once, and
+    #the partial marks around them if they aren't on disk yet. The marks
+    #fill the whole place, which is longer than the last piece elsewhere
+    def _flush_piece(self, index):
+        blocks = self.write_cache.get(index)
+        if blocks is None:
+            return
+        pos = self.piece_size * self.places[index]
+        begins = blocks.keys()
+        begins.sort()
+        if index in self.unmarked:
+            marks = self._partial_marks(index,
+                                        self._piecelen(self.places[index]))
+            r = []
+            x = 0
+            for b in begins:
+                r.append(marks[x:b])
+                r.append(blocks[b])
+                x = b + len(blocks[b])
+            r.append(marks[x:])
+            self._write(pos, join_blocks(r))
+        else:
+            run = []
+            start = end = None
+            for b in begins:
+                if b != end and run:
+                    self._write(pos + start, join_blocks(run))
+                    run = []
+                if not run:
+                    start = b
+                run.append(blocks[b])
+                end = b + len(blocks[b])
+            self._write(pos + start, join_blocks(run))
+        h = self.hashing.get(index)
+        if h is not None and h[2]:
+            del self.hashing[index]
+        self._uncache(index)
+
+    #writes out all the blocks in the write cache. With disk I/O threads
+    #the writes are only queued, see DiskQueue.wait() and when_done()
+    def flush(self):
+        for index in self.write_cache.keys():
+            self._flush_piece(index)
+
     def _get_free_place(self):
         while self.rplaces[self.holepos] >= 0:
             self.holepos += 1
@@ -287,6 +508,7 @@ class StorageWrapper(object):
         return None
 
     def write_fastresume(self, resumefile):
+        self.flush()
         for i in xrange(self.numpieces):
             if self.rplaces[i] >= 0 and not self.have[self.rplaces[i]]:
                 self.rplaces[i] = FASTRESUME_PARTIAL
@@ -324,8 +546,13 @@ class StorageWrapper(object):
         return r
 
     def piece_came_in(self, index, begin, piece, source = None):
+        #pieces are strings, or memoryviews of the bytearray Connecter put
+        #together a message split across reads in
         if self.places[index] < 0:
-            if self.rplaces[index] == ALLOCATED:
+            #when streaming, pieces go straight to where they belong so the
+            #file can be read while it's downloaded
+            if self.rplaces[index] == ALLOCATED or \
+                   (self.config['streaming'] and self.rplaces[index] < 0):
                 self._initalloc(index, index)
             else:
                 n = self._get_free_place()
@@ -340,15 +567,22 @@ class StorageWrapper(object):
                     self._initalloc(index, index)
 
         if index in self.failed_pieces:
-            old = self.storage.read(self.places[index] * self.piece_size +
-                                    begin, len(piece))
-            if old != piece:
-                self.failed_pieces[index][self.download_history[index][begin]]\
-                    = None
+            #the block is compared with the one it replaces, which is read
+            #before the new one is written
+            sender = self.download_history[index][begin]
+            def compare(old, index = index, piece = piece, sender = sender):
+                if old != piece and index in self.failed_pieces:
+                    self.failed_pieces[index][sender] = None
+            pos = self.places[index] * self.piece_size + begin
+            if self.diskqueue is None:
+                compare(self.storage.read(pos, len(piece)))
+            else:
+                self.diskqueue.read(self.storage, pos, len(piece), compare)
         self.download_history.setdefault(index, {})
         self.download_history[index][begin] = source
 
-        self.storage.write(self.places[index] * self.piece_size + begin, piece)
+        self._hash_block(index, begin, piece)
+        self._cache_block(index, begin, piece)
         self.stat_dirty[index] = 1
         self.numactive[index] -= 1
         if self.numactive[index] == 0:
@@ -357,41 +591,83 @@ class StorageWrapper(object):
             del self.stat_new[index]
         if not self.inactive_requests[index] and not self.numactive[index]:
             del self.stat_dirty[index]
-            if sha(self.storage.read(self.piece_size * self.places[index], self._piecelen(index))).digest() == self.hashes[index]:
-                self.have[index] = True
-                self.storage.downloaded(index * self.piece_size,
-                                        self._piecelen(index))
-                self.inactive_requests[index] = None
-                self.waschecked[index] = True
-                self.amount_left -= self._piecelen(index)
-                self.stat_numdownloaded += 1
-                for d in self.download_history[index].itervalues():
+            data = None
+            if self.places[index] != index:
+                data = self._cached_data(index)
+            #written even if it fails the check, for the comparisons with
+            #the blocks that come in instead
+            self._flush_piece(index)
+            #pieces that failed a check or were found partial on start-up
+            #are read back
+            h = self.hashing.pop(index, None)
+            if h is not None:
+                assert h[1] == self._piecelen(index)
+                self.stat_numhashed += 1
+            args = (h, self.piece_size * self.places[index],
+                    self._piecelen(index))
+            #with disk I/O threads, also after the comparisons with the
+            #blocks that failed
+            if self.diskqueue is not None and \
+                   (h is None or index in self.failed_pieces):
+                def checked(digest, index = index, data = data):
+                    ok = self._check_piece(index, digest, data)
+                    if self.piece_checked is not None:
+                        self.piece_checked(index, ok)
+                self.diskqueue.submit(self._digest, args, checked)
+                return True
+            return self._check_piece(index, self._digest(*args), data)
+        return True
+
+    #the digest of a piece hashed as it came in, or read back from pos.
+    #This runs on the disk I/O threads if there are any.
+    def _digest(self, h, pos, length):
+        if h is not None:
+            return h[0].digest()
+        return sha1(self.storage.read(pos, length)).digest()
+
+    #finishes a piece after its hash check, returns whether it passed. data
+    #is the piece if it was all in the write cache
+    def _check_piece(self, index, digest, data):
+        if digest == self.hashes[index]:
+            self.have[index] = True
+            self.storage.downloaded(index * self.piece_size,
+                                    self._piecelen(index))
+            self.inactive_requests[index] = None
+            self.waschecked[index] = True
+            self.amount_left -= self._piecelen(index)
+            self.stat_numdownloaded += 1
+            self._keep_unplaced(index, data)
+            for d in self.download_history[index].itervalues():
+                if d is not None:
+                    d.good(index)
+            del self.download_history[index]
+            if index in self.failed_pieces:
+                for d in self.failed_pieces[index]:
                     if d is not None:
-                        d.good(index)
-                del self.download_history[index]
-                if index in self.failed_pieces:
-                    for d in self.failed_pieces[index]:
-                        if d is not None:
-                            d.bad(index)
-                    del self.failed_pieces[index]
-                if self.amount_left == 0:
+                        d.bad(index)
+                del self.failed_pieces[index]
+            if self.amount_left == 0:
+                #finished() reopens the files, after the writes
+                if self.diskqueue is None:
                     self.finished()
-            else:
-                self.data_flunked(self._piecelen(index), index)
-                self.inactive_requests[index] = 1
-                self.amount_inactive += self._piecelen(index)
-                self.stat_numflunked += 1
-
-                self.failed_pieces[index] = {}
-                allsenders = {}
-                for d in self.download_history[index].itervalues():
-                    allsenders[d] = None
-                if len(allsenders) == 1:
-                    culprit = allsenders.keys()[0]
-                    if culprit is not None:
-                        culprit.bad(index, bump = True)
-                    del self.failed_pieces[index] # found the culprit already
-                return False
+                else:
+                    self.diskqueue.when_done(self.finished)
+        else:
+            self.data_flunked(self._piecelen(index), index)
+            self.inactive_requests[index] = 1
+            self.amount_inactive += self._piecelen(index)
+            self.stat_numflunked += 1
+
+            self.failed_pieces[index] = {}
+            allsenders = {}
+            for d in self.download_history[index].itervalues():
+                allsenders[d] = None
+            if len(allsenders) == 1:
+                culprit = allsenders.keys()[0]
+                if culprit is not None:
+                    culprit.bad(index, bump = True)
+                del self.failed_pieces[index] # found the culprit already
+            return False
         return True
 
     def request_lost(self, index, begin, length):
@@ -403,13 +679,102 @@ class StorageWrapper(object):
             if index in self.stat_new:
                 del self.stat_new[index]
 
+    #without disk I/O threads, read_piece() otherwise
     def get_piece(self, index, begin, length):
-        if not self.have[index]:
+        if not self._can_send(index, begin, length):
             return None
+        data = self._cached_piece(index, length)
+        if data is not None:
+            return data[begin:begin + length]
+        pos = self.piece_size * self.places[index]
+        if self.readcache is None or \
+               self._piecelen(index) > self.readcache.max_bytes:
+            return self.storage.read(pos + begin, length)
+        #the whole piece is read for the requests for its other blocks
+        data = self.storage.read(pos, self._piecelen(index))
+        self.readcache.add((self, index), data)
+        return data[begin:begin + length]
+
+    # like get_piece(), but returns the (file, offset, length) ranges the
+    # block is stored in, for sending it with sendfile()
+    def get_piece_ranges(self, index, begin, length):
+        if not self._can_send(index, begin, length):
+            return None
+        data = self._cached_piece(index, length)
+        if data is not None:
+            return data[begin:begin + length]
+        return self.storage.read_ranges(self.piece_size * self.places[index] + begin, length)
+
+    #like get_piece(), but reads on the disk I/O threads and gives the block
+    #to callback once it's read, or right away from the read cache. With
+    #ranges, a block of a checked piece that isn't in the read cache is
+    #given as the file ranges of get_piece_ranges() instead, looked up after
+    #the writes before it. Returns False for a block that can't be
+    #sent
+    def read_piece(self, index, begin, length, callback, ranges = False):
+        if not self.have[index] or begin + length > self._piecelen(index):
+            return False
+        data = self._cached_piece(index, length)
+        if data is not None:
+            callback(data[begin:begin + length])
+            return True
+        pos = self.piece_size * self.places[index]
+        piecelen = self._piecelen(index)
+        if self.waschecked[index] and ranges:
+            self.diskqueue.read(self.storage, pos + begin, length, callback,
+                                True)
+            return True
+        if self.waschecked[index] and (self.readcache is None or
+                                       piecelen > self.readcache.max_bytes):
+            self.diskqueue.read(self.storage, pos + begin, length, callback)
+            return True
+        #the whole piece is read once for all the blocks asked for meanwhile
+        waiting = self.piece_reads.get(index)
+        if waiting is None:
+            waiting = self.piece_reads[index] = []
+            def done(data):
+                self._got_piece_read(index, data)
+            #the blocks waiting are dropped, the torrent stops on the error
+            def failed(e):
+                del self.piece_reads[index]
+            self.diskqueue.read(self.storage, pos, piecelen, done, False,
+                                failed)
+        waiting.append((begin, length, callback))
+        return True
+
+    def _got_piece_read(self, index, data):
+        waiting = self.piece_reads.pop(index)
         if not self.waschecked[index]:
-            if sha(self.storage.read(self.piece_size * self.places[index], self._piecelen(index))).digest() != self.hashes[index]:
+            if sha1(data).digest() != self.hashes[index]:
                 raise BTFailure, 'told file complete on start-up, but piece failed hash check'
             self.waschecked[index] = True
-        if begin + length > self._piecelen(index):
+        if self.readcache is not None:
+            self.readcache.add((self, index), data)
+        for begin, length, callback in waiting:
+            callback(data[begin:begin + length])
+
+    #the piece from the read cache, if it's there, counting the block of
+    #length asked for as a hit or a miss
+    def _cached_piece(self, index, length):
+        if self.readcache is None:
             return None
-        return self.storage.read(self.piece_size * self.places[index] + begin, length)
+        data = self.readcache.get((self, index))
+        if data is None:
+            self.stat_cache_misses += 1
+        else:
+            self.stat_cache_hits += 1
+            self.stat_cache_saved += length
+        return data
+
+    def _can_send(self, index, begin, length):
+        if not self.have[index]:
+            return False
+        if not self.waschecked[index]:
+            data = self.storage.read(self.piece_size * self.places[index],
+                                     self._piecelen(index))
+            if sha1(data).digest() != self.hashes[index]:
+                raise BTFailure, 'told file complete on start-up, but piece failed hash check'
+            self.waschecked[index] = True
+            if self.readcache is not None:
+                self.readcache.add((self, index), data)
+        return begin + length <= self._piecelen(index)
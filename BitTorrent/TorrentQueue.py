@@ -146,6 +146,7 @@ class TorrentQueue(Feedback):
                 totals = t.dl.get_total_transfer()
                 t.uptotal = t.uptotal_old + totals[0]
                 t.downtotal = t.downtotal_old + totals[1]
+        self.multitorrent.shutdown()
         self._dump_state()
 
     def _check_version(self):
@@ -11,7 +11,7 @@
 # Written by Bram Cohen
 
 from BitTorrent.CurrentRateMeasure import Measure
-from BitTorrent.platform import bttime
+from BitTorrent.platform import bttime, sendfile
 
 #There is one object per remote peer. 
 #This class manage the machinery to upload to peers.
@@ -20,6 +20,12 @@ from BitTorrent.platform import bttime
 #from the peers in the buffer[] list.
 class Upload(object):
 
+    __slots__ = ('connection', 'ratelimiter', 'totalup', 'totalup2', 'choker',
+                 'storage', 'max_slice_length', 'max_rate_period', 'choked',
+                 'unchoke_time', 'interested', 'buffer', 'config', 'I', 'r',
+                 'use_sendfile', 'use_diskio', 'ready', 'measure',
+                 'logcollector')
+
     def __init__(self, connection, ratelimiter, totalup, totalup2, choker,
                  storage, max_slice_length, max_rate_period, logcollector):
         self.connection = connection
@@ -40,9 +46,21 @@ class Upload(object):
         self.buffer = []
         #PFS begin
         self.config = choker.config
-        self.I = {}     # I[piece id] = block uploaded count in the piece id
-        self.r = {}     # r[piece_id] = block requested count in the piece id
+        #only PFS and EPFS use these, leave them out for plain BT
+        if self.config['scheduling_algorithm'] != 'BT':
+            self.I = {}     # I[piece id] = block uploaded count in the piece id
+            self.r = {}     # r[piece_id] = block requested count in the piece id
+        else:
+            self.I = self.r = None
         #PFS end
+        #with disk I/O threads the blocks in the buffer are read ahead on
+        #them, ready[block] is the data once it's read and None until then
+        self.use_diskio = storage.diskqueue is not None
+        self.ready = {}
+        # hand out blocks as file ranges to be sent with sendfile(); with
+        # disk I/O threads only those not in the read cache
+        self.use_sendfile = self.config['sendfile_upload'] and \
+                            sendfile is not None
         self.measure = Measure(max_rate_period)
         #send the bittfield of the peer the first time it connects to the peers. 
         if storage.do_I_have_anything():
@@ -54,6 +72,7 @@ class Upload(object):
             self.logcollector.log(None, 'R NI ' + str(self.connection.ip))
             self.interested = False
             del self.buffer[:]
+            self.ready.clear()
             self.choker.not_interested(self.connection)
 
     def got_interested(self):
@@ -65,12 +84,14 @@ class Upload(object):
     def get_upload_chunk(self):
         if not self.buffer:
             return None
+        if self.use_diskio and self.ready.get(self.buffer[0]) is None:
+            return None
         #buffer.pop(0) return the element with index 0 and remove
         #this element from buffer.
         index, begin, length = self.buffer.pop(0)
 
         #PFS begin
-        if self.choker.done():
+        if self.I is not None and self.choker.done():
             if index in self.I:
                 self.I[index] += 1
             else:
@@ -85,15 +106,26 @@ class Upload(object):
                 self.choker.theta[index] = 1.0
         #PFS end
 
-        piece = self.storage.get_piece(index, begin, length)
+        #piece is either the block as a string or, with use_sendfile, a list
+        #of (file, offset, length) ranges holding it
+        if self.use_diskio:
+            block = (index, begin, length)
+            piece = self.ready[block]
+            #the same block may be asked for again while it's in the buffer
+            if block not in self.buffer:
+                del self.ready[block]
+        elif self.use_sendfile:
+            piece = self.storage.get_piece_ranges(index, begin, length)
+        else:
+            piece = self.storage.get_piece(index, begin, length)
         if piece is None:
             self.logcollector.log(None, 'CON C ' + str(self.connection.ip) +  ' E 1')
             self.connection.close()
             return None
-        self.measure.update_rate(len(piece))
-        self.totalup.update_rate(len(piece))
-        self.totalup2.update_rate(len(piece))
-        return (index, begin, piece)
+        self.measure.update_rate(length)
+        self.totalup.update_rate(length)
+        self.totalup2.update_rate(length)
+        return (index, begin, length, piece)
 
     def got_request(self, index, begin, length):
         if not self.interested or length > self.max_slice_length:
@@ -104,7 +136,9 @@ class Upload(object):
                               ' l ' + str(length))            
         if not self.connection.choke_sent:
             self.buffer.append((index, begin, length))
-            if self.connection.next_upload is None and \
+            if self.use_diskio:
+                self._read_ahead()
+            elif self.connection.next_upload is None and \
                    self.connection.connection.is_flushed():
                 self.ratelimiter.queue(self.connection)
 
@@ -115,6 +149,41 @@ class Upload(object):
             # EPFS end
 
 
+    #starts reading the blocks in the buffer that aren't read yet, as far as
+    #the torrent's disk queue takes them
+    def _read_ahead(self):
+        if self.connection.closed:
+            return
+        for block in self.buffer[:]:
+            if block in self.ready:
+                continue
+            if block not in self.buffer:
+                return
+            if self.storage.disk_full(self._read_ahead):
+                return
+            self.ready[block] = None
+            def got(data, block = block):
+                self._got_block(block, data)
+            if not self.storage.read_piece(block[0], block[1], block[2], got,
+                                           self.use_sendfile):
+                self.logcollector.log(None, 'CON C ' + str(self.connection.ip) +  ' E 1')
+                self.connection.close()
+                return
+
+    def _got_block(self, block, data):
+        if block not in self.ready:
+            return
+        self.ready[block] = data
+        self._kick()
+
+    def _kick(self):
+        if self.connection.closed or not self.buffer or \
+               self.ready.get(self.buffer[0]) is None:
+            return
+        if self.connection.next_upload is None and \
+               self.connection.connection.is_flushed():
+            self.ratelimiter.queue(self.connection)
+
     # EPFS step 5: Seed updates his data structure when receiving REQUEST from leechers
     def PFS_update_r(self, index):
         if self.config['scheduling_algorithm'] == 'BT':
@@ -139,6 +208,8 @@ class Upload(object):
             self.buffer.remove((index, begin, length))
         except ValueError:
             pass
+        if (index, begin, length) not in self.buffer:
+            self.ready.pop((index, begin, length), None)
 
     def choke(self):
         if not self.choked:
@@ -148,6 +219,7 @@ class Upload(object):
     def sent_choke(self):
         assert self.choked
         del self.buffer[:]
+        self.ready.clear()
 
     def unchoke(self, time):
         if self.choked:
@@ -17,9 +17,15 @@ from BitTorrent.obsoletepythonsupport import *
 counts = [chr(sum([(i >> j) & 1 for j in xrange(8)])) for i in xrange(256)]
 counts = ''.join(counts)
 
+#the positions of the set bits of every byte, first piece in the high bit
+positions = [tuple([j for j in xrange(8) if i & (128 >> j)])
+             for i in xrange(256)]
 
 
-class Bitfield:
+
+class Bitfield(object):
+
+    __slots__ = ('length', 'numfalse', 'bits')
 
     def __init__(self, length, bitstring=None):
         self.length = length
@@ -68,6 +74,14 @@ class Bitfield:
     def __len__(self):
         return self.length
 
+    #the indices of the true bits, in order
+    def indices(self):
+        if self.bits is None:
+            return xrange(self.length)
+        p = positions
+        return [i + j for i, b in zip(xrange(0, len(self.bits) * 8, 8),
+                                      self.bits) if b for j in p[b]]
+
     def tostring(self):
         if self.bits is None:
             rlen, extra = divmod(self.length, 8)
@@ -14,18 +14,10 @@ import os
 import socket
 import sys
 
-from binascii import b2a_hex
-
 from BitTorrent.RawServer import RawServer
+from BitTorrent.messages import toint, tobinary
 from BitTorrent import BTFailure
 
-def toint(s):
-    return int(b2a_hex(s), 16)
-
-def tobinary(i):
-    return (chr(i >> 24) + chr((i >> 16) & 0xFF) +
-        chr((i >> 8) & 0xFF) + chr(i & 0xFF))
-
 
 class ControlsocketListener(object):
 
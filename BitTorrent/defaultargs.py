@@ -40,20 +40,43 @@ common_options = [
          "bittorrent config directory."),
     ('max_files_open', 50,
      'the maximum number of files in a multifile torrent to keep open at a time, 0 means no limit. Used to avoid running out of file descriptors.'),
+    ('read_cache_size', 16 * 2 ** 20,
+     'bytes of pieces read for uploading kept in memory for the next requests for them, shared by all torrents. 0 means blocks are read one at a time'),
+    ('disk_io_threads', 2,
+     'number of threads reading and writing torrent data, so a slow disk does not hold up the network. 0 means it is done on the main thread'),
     ]
 
 
 rare_options = [
     ('keepalive_interval', 120.0,
         'number of seconds to pause between sending keepalives'),
+    ('have_catchup_interval', 300.0,
+        'HAVEs for pieces a peer already has are held back and sent every '
+        'this many seconds, 0 to always send them right away'),
     ('download_slice_size', 2 ** 14,
         "how many bytes to query for per request."),
+    ('min_request_pipeline', 4,
+        'fewest requests to keep outstanding to a peer'),
+    ('max_request_pipeline', 250,
+        'most requests to keep outstanding to a peer, otherwise twice what '
+        "covers the peer's download rate times its round trip time"),
+    ('rtt_window', 10.0,
+        'seconds a round trip time measurement to a peer is kept before a '
+        'longer one may replace it'),
     ('max_message_length', 2 ** 23,
         "maximum length prefix encoding you'll accept over the wire - larger values get the connection dropped."),
     ('socket_timeout', 300.0,
         'seconds to wait between closing sockets which nothing has been received on'),
     ('timeout_check_interval', 60.0,
         'seconds to wait between checking if any connections have timed out'),
+    ('poll_backend', 'auto',
+        "socket readiness mechanism to use: 'epoll' (Linux), 'poll' or 'select'. 'auto' picks the best one available"),
+    ('epoll_edge_triggered', 1,
+        'use edge-triggered notification with the epoll backend so write interest never has to be toggled'),
+    ('read_buffer_size', 65536,
+        'size of the buffer that data is received into, the most that is read from a connection in one call'),
+    ('max_read_per_event', 262144,
+        'maximum number of bytes to read from one connection before serving the others'),
     ('max_slice_length', 16384,
         "maximum length slice to send to peers, close connection if a larger request is received"),
     ('max_rate_period', 20.0,
@@ -66,8 +89,56 @@ rare_options = [
         "seconds to wait for data to come in over a connection before assuming it's semi-permanently choked"),
     ('rarest_first_cutoff', 4,
         "number of downloads at which to switch from random to rarest first"),
+    ('piece_picker', 'list',
+        "how pieces to request are found: 'list' checks them one by one, "
+        "'bitset' keeps them in bitsets, which is faster for torrents with "
+        "many pieces"),
+    ('streaming', 0,
+        'download the pieces just ahead of a read cursor first, for '
+        'consumers that read the data while it is downloaded. The cursor '
+        "starts at the beginning and is moved with the 'set_cursor' "
+        'control socket command'),
+    ('streaming_window', 8,
+        'how many pieces from the read cursor on streaming downloads first, '
+        'in order'),
+    ('streaming_deadline', 1.0,
+        'seconds the blocks of the first piece in the streaming window may '
+        'take to come in, and as many more for each next piece, before '
+        'they are also requested from a faster peer'),
+    ('endgame_policy', 'all',
+        "how blocks are requested in endgame: 'all' asks every peer that has "
+        "a missing block for it, 'capped' asks at most endgame_max_duplicates "
+        "peers and only duplicates to peers faster than the ones asked"),
+    ('endgame_max_duplicates', 2,
+        "most peers a block is requested from at once with the 'capped' "
+        "endgame policy"),
     ('upload_unit_size', 1380,
         'how many bytes to write into network buffers at once.'),
+    ('sendfile_upload', 1,
+        'send uploaded data from files with sendfile() instead of reading it '
+        'in first, where the platform supports it. With disk_io_threads, '
+        'pieces in the read cache are still sent from memory'),
+    ('disk_io_queue', 64,
+        'most reads and writes a torrent has waiting for the disk I/O threads '
+        'before it holds off reading the blocks peers asked for and asking '
+        'peers for more data'),
+    ('disk_io_window', 0.01,
+        'seconds writes are held back to be put in order of their position '
+        'on disk and merged with the reads and writes of all torrents that '
+        'come in meanwhile. Reads peers wait for are not held back'),
+    ('disk_io_merge', 2 ** 20,
+        'largest read or write that reads or writes of adjacent data are '
+        'merged into, 0 means they are not merged'),
+    ('write_cache_size', 4 * 2 ** 20,
+        'bytes of downloaded blocks each torrent keeps in memory until their '
+        'piece is complete, to check it and write it to disk at once. Room '
+        'left over keeps finished pieces that will be moved on disk later'),
+    ('hash_workers', 0,
+        'number of threads hashing the existing data when a torrent is '
+        'started, 0 means one per processor'),
+    ('hash_readahead', 16 * 2 ** 20,
+        'bytes of existing data read ahead of the hashing when a torrent is '
+        'started'),
     ('retaliate_to_garbled_data', 1,
      'refuse further connections from addresses with broken or intentionally '
      'hostile peers that send incorrect data'),
@@ -34,7 +34,8 @@ except AttributeError:
 
 from BitTorrent.btformats import check_message
 from BitTorrent.Choker import Choker
-from BitTorrent.Storage import Storage, FilePool
+from BitTorrent.Storage import Storage, FilePool, ReadCache
+from BitTorrent.DiskIO import DiskIO
 from BitTorrent.StorageWrapper import StorageWrapper
 from BitTorrent.Uploader import Upload
 from BitTorrent.Downloader import Downloader
@@ -45,7 +46,7 @@ from BitTorrent.Rerequester import Rerequester
 from BitTorrent.DownloaderFeedback import DownloaderFeedback
 from BitTorrent.RateMeasure import RateMeasure
 from BitTorrent.CurrentRateMeasure import Measure
-from BitTorrent.PiecePicker import PiecePicker
+from BitTorrent.PiecePicker import PiecePicker, BitsetPiecePicker
 from BitTorrent.ConvertedMetainfo import set_filesystem_encoding
 from BitTorrent import version
 from BitTorrent import BTFailure, BTShutdown, INFO, WARNING, ERROR, CRITICAL
@@ -81,6 +82,14 @@ class Multitorrent(object):
         self.singleport_listener = SingleportListener(self.rawserver, self.logcollector)
         self._find_port(listen_fail_ok)
         self.filepool = FilePool(config['max_files_open'])
+        self.readcache = ReadCache(config['read_cache_size'])
+        if config['disk_io_threads'] > 0:
+            self.diskio = DiskIO(self.rawserver.external_add_task,
+                                 config['disk_io_threads'],
+                                 config['disk_io_window'],
+                                 config['disk_io_merge'])
+        else:
+            self.diskio = None
         self.ratelimiter = RateLimiter(self.rawserver.add_task)
         self.ratelimiter.set_parameters(config['max_upload_rate'],
                                         config['upload_unit_size'])
@@ -106,9 +115,16 @@ class Multitorrent(object):
     def close_listening_socket(self):
         self.singleport_listener.close_sockets()
 
+    #once the torrents are shut down, stops the disk I/O threads
+    def shutdown(self):
+        if self.diskio is not None:
+            self.diskio.stop()
+
     def start_torrent(self, metainfo, config, feedback, filename):
         torrent = _SingleTorrent(self.rawserver, self.singleport_listener,
-                                 self.ratelimiter, self.filepool, config, self.logcollector)
+                                 self.ratelimiter, self.filepool,
+                                 self.readcache, self.diskio, config,
+                                 self.logcollector)
         self.rawserver.add_context(torrent)
 
         #function called by the scheduler in RawServer when it the time for this torrent to start
@@ -123,11 +139,13 @@ class Multitorrent(object):
         if option not in self.config or self.config[option] == value:
             return
         if option not in 'max_upload_rate upload_unit_size '\
-               'max_files_open minport maxport'.split():
+               'max_files_open read_cache_size minport maxport'.split():
             return
         self.config[option] = value
         if option == 'max_files_open':
             self.filepool.set_max_files_open(value)
+        elif option == 'read_cache_size':
+            self.readcache.set_max_bytes(value)
         elif option == 'max_upload_rate':
             self.ratelimiter.set_parameters(value,
                                             self.config['upload_unit_size'])
@@ -180,11 +198,15 @@ class Multitorrent(object):
 class _SingleTorrent(object):
 
     def __init__(self, rawserver, singleport_listener, ratelimiter, filepool,
-                 config, logcollector):
+                 readcache, diskio, config, logcollector):
         self._rawserver = rawserver
         self._singleport_listener = singleport_listener
         self._ratelimiter = ratelimiter
         self._filepool = filepool
+        self._readcache = readcache
+        self._diskqueue = None
+        if diskio is not None:
+            self._diskqueue = diskio.queue(self, config['disk_io_queue'])
         self.config = dict(config)
         self._storage = None
         self._storagewrapper = None
@@ -192,6 +214,13 @@ class _SingleTorrent(object):
         self._upmeasure = None
         self._downmeasure = None
         self._encoder = None
+        self._picker = None
+        self._deadline_task = None
+        self._downloader = None
+        #streaming read cursor as a byte offset, None when not streaming
+        self._cursor = None
+        if config['streaming']:
+            self._cursor = 0
         self._rerequest = None
         self._statuscollecter = None
         self._announced = False
@@ -245,7 +274,7 @@ class _SingleTorrent(object):
         seed(myid)
         
         def schedfunc(func, delay):
-            self._rawserver.add_task(func, delay, self)
+            return self._rawserver.add_task(func, delay, self)
         def externalsched(func, delay):
             self._rawserver.external_add_task(func, delay, self)
         if metainfo.is_batch:
@@ -276,6 +305,9 @@ class _SingleTorrent(object):
             self._ratemeasure.data_rejected(amount)
             self._error(INFO, 'piece %d failed hash check, '
                         're-downloading it' % index)
+        def piece_checked(index, ok):
+            if self._downloader.piece_checked(index, ok):
+                self._encoder.piece_completed(index)
         backthread_exception = []
         def errorfunc(level, text):
             def e():
@@ -290,7 +322,8 @@ class _SingleTorrent(object):
                 self._storagewrapper = StorageWrapper(self._storage,
                      config, metainfo.hashes, metainfo.piece_length,
                      self._finished, statusfunc, self._doneflag, data_flunked,
-                     self.infohash, errorfunc, resumefile, self.logcollector)
+                     self.infohash, errorfunc, resumefile, self.logcollector,
+                     self._readcache, self._diskqueue, piece_checked)
             except:
                 backthread_exception.append(sys.exc_info())
             self._contfunc()
@@ -316,7 +349,10 @@ class _SingleTorrent(object):
         self._downmeasure = downmeasure
         self._ratemeasure = RateMeasure(self._storagewrapper.
                                         amount_left_with_partials)
-        picker = PiecePicker(len(metainfo.hashes), config)
+        if config['piece_picker'] == 'bitset':
+            picker = BitsetPiecePicker(len(metainfo.hashes), config)
+        else:
+            picker = PiecePicker(len(metainfo.hashes), config)
 
         #initialize the PiecePicker object 
         for i in xrange(len(metainfo.hashes)):
@@ -324,6 +360,8 @@ class _SingleTorrent(object):
                 picker.complete(i)
         for i in self._storagewrapper.stat_dirty:
             picker.requested(i)
+        self._picker = picker
+        self._set_picker_cursor()
             
         def kickpeer(connection):
             def kick():
@@ -334,6 +372,12 @@ class _SingleTorrent(object):
         downloader = Downloader(config, self._storagewrapper, picker,
             len(metainfo.hashes), downmeasure, self._ratemeasure.data_came_in,
                                 kickpeer, banpeer, self.logcollector)
+        self._downloader = downloader
+        def check_deadlines():
+            self._deadline_task = schedfunc(check_deadlines, 1)
+            downloader.check_deadlines()
+        if not self.finflag.isSet():
+            self._deadline_task = schedfunc(check_deadlines, 1)
         def make_upload(connection):
             return Upload(connection, self._ratelimiter, upmeasure,
                         upmeasure_seedtime, choker, self._storagewrapper,
@@ -415,11 +459,19 @@ class _SingleTorrent(object):
     def _finished(self):
         self.logcollector.log(None, 'P SM')
         self.finflag.set()
+        # nothing is downloaded any more, so no deadlines can be missed
+        if self._deadline_task is not None:
+            self._deadline_task.cancel()
+            self._deadline_task = None
         # Call self._storage.close() to flush buffers and change files to
         # read-only mode (when they're possibly reopened). Let exceptions
         # from self._storage.close() kill the torrent since files might not
-        # be correct on disk if file.close() failed.
-        self._storage.close()
+        # be correct on disk if file.close() failed. With disk I/O threads
+        # it's done on them, between the reads for uploads.
+        if self._diskqueue is None:
+            self._storage.close()
+        else:
+            self._diskqueue.submit(self._storage.close, ())
         # If we haven't announced yet, normal first announce done later will
         # tell the tracker about seed status.
         self.is_seed = True
@@ -447,6 +499,9 @@ class _SingleTorrent(object):
         resumefile = None
         try:
             resumefile = file(filename, 'wb')
+            #the file sizes and times recorded are the ones with the data
+            #written out
+            self._storagewrapper.flush()
             self._storage.write_fastresume(resumefile, amount_done)
             self._storagewrapper.write_fastresume(resumefile)
             resumefile.close()
@@ -485,6 +540,18 @@ class _SingleTorrent(object):
             self._rerequest.cleanup()
         if self._hashcheck_thread is not None:
             self._hashcheck_thread.join() # should die soon after doneflag set
+        if self._storagewrapper is not None:
+            try:
+                self._storagewrapper.flush()
+                #the files are closed once the disk I/O threads are done
+                #with them
+                if self._diskqueue is not None:
+                    self._diskqueue.wait()
+            except Exception, e:
+                self._error(WARNING, 'Could not write out downloaded data: ' +
+                            str(e))
+        if self._storagewrapper is not None:
+            self._readcache.remove_torrent(self._storagewrapper)
         if self._myfiles is not None:
             self._filepool.remove_files(self._myfiles)
         if self._listening:
@@ -501,6 +568,7 @@ class _SingleTorrent(object):
     def get_status(self, spew = False, fileinfo=False):
         if self.started and not self.closed:
             r = self._statuscollecter.get_statistics(spew, fileinfo)
+            r.update(self._encoder.get_have_stats())
             r['activity'] = self._activity[0]
         else:
             r = dict(zip(('activity', 'fractionDone'), self._activity))
@@ -523,6 +591,26 @@ class _SingleTorrent(object):
         self.config[option] = value
         self._set_auto_uploads()
 
+    #moves the streaming read cursor to byte pos of the torrent, a negative
+    #pos stops streaming. Before the download has started it's kept for
+    #when it does.
+    def set_cursor(self, pos):
+        if self.closed:
+            return
+        self._cursor = None
+        if pos >= 0:
+            self._cursor = pos
+        if self.started:
+            self._set_picker_cursor()
+            self._downloader.check_deadlines()
+
+    def _set_picker_cursor(self):
+        piece = None
+        if self._cursor is not None:
+            piece = min(self._cursor // self._storagewrapper.piece_size,
+                        self._picker.numpieces - 1)
+        self._picker.set_cursor(piece)
+
     def change_port(self):
         if not self._listening:
             return
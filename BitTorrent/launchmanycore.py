@@ -71,6 +71,7 @@ class LaunchMany(Feedback):
                 torrent = self.downloads[infohash]
                 if torrent is not None:
                     torrent.shutdown()
+            self.multitorrent.shutdown()
         except:
             data = StringIO()
             print_exc(file = data)
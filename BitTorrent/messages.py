@@ -0,0 +1,104 @@
+# The contents of this file are subject to the BitTorrent Open Source License
+# Version 1.0 (the License).  You may not copy or use this file, in either
+# source code or executable form, except in compliance with the License.  You
+# may obtain a copy of the License at http://www.bittorrent.com/license/.
+#
+# Software distributed under the License is distributed on an AS IS basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied.  See the License
+# for the specific language governing rights and limitations under the
+# License.
+
+# Encoding and decoding of the length prefixed peer wire messages. All the
+# integers on the wire are 4 byte big-endian, packed with precompiled
+# Structs. The decoders take a string or anything with the buffer
+# interface, so they work on the memoryviews Connection gets.
+
+from struct import Struct
+
+CHOKE = chr(0)
+UNCHOKE = chr(1)
+INTERESTED = chr(2)
+NOT_INTERESTED = chr(3)
+# index
+HAVE = chr(4)
+# index, bitfield
+BITFIELD = chr(5)
+# index, begin, length
+REQUEST = chr(6)
+# index, begin, piece
+PIECE = chr(7)
+# index, begin, piece
+CANCEL = chr(8)
+
+_uint32 = Struct('>I')
+_have = Struct('>IcI')
+_request = Struct('>IcIII')
+_piece_header = Struct('>IcII')
+_index_begin = Struct('>II')
+_index_begin_length = Struct('>III')
+
+REQUEST_LENGTH = _request.size
+
+def toint(s):
+    return _uint32.unpack(s)[0]
+
+def tobinary(i):
+    return _uint32.pack(i)
+
+# messages without arguments, length prefix included
+CHOKE_MESSAGE = tobinary(1) + CHOKE
+UNCHOKE_MESSAGE = tobinary(1) + UNCHOKE
+INTERESTED_MESSAGE = tobinary(1) + INTERESTED
+NOT_INTERESTED_MESSAGE = tobinary(1) + NOT_INTERESTED
+KEEPALIVE_MESSAGE = tobinary(0)
+
+def have(index):
+    return _have.pack(5, HAVE, index)
+
+def bitfield(bits):
+    return tobinary(len(bits) + 1) + BITFIELD + bits
+
+def request(index, begin, length):
+    return _request.pack(13, REQUEST, index, begin, length)
+
+def cancel(index, begin, length):
+    return _request.pack(13, CANCEL, index, begin, length)
+
+# everything of a PIECE message except the block itself
+def piece_header(index, begin, length):
+    return _piece_header.pack(length + 9, PIECE, index, begin)
+
+# encodes a list of (index, begin, length) as back to back REQUEST
+# messages in a single string
+def requests(reqs):
+    buf = bytearray(REQUEST_LENGTH * len(reqs))
+    pack_into = _request.pack_into
+    pos = 0
+    for index, begin, length in reqs:
+        pack_into(buf, pos, 13, REQUEST, index, begin, length)
+        pos += REQUEST_LENGTH
+    return str(buf)
+
+# back to back HAVE messages for all the indices in a single string
+def haves(indices):
+    buf = bytearray(_have.size * len(indices))
+    pack_into = _have.pack_into
+    pos = 0
+    for index in indices:
+        pack_into(buf, pos, 5, HAVE, index)
+        pos += _have.size
+    return str(buf)
+
+# the decoders take a message with its length prefix already removed and
+# do no length checking, that's up to the caller
+
+def decode_have(message):
+    return _uint32.unpack_from(message, 1)[0]
+
+# REQUEST and CANCEL
+def decode_request(message):
+    return _index_begin_length.unpack_from(message, 1)
+
+# index and begin of a PIECE, the block is message[9:]
+def decode_piece(message):
+    return _index_begin.unpack_from(message, 1)
@@ -8,6 +8,7 @@
 # for the specific language governing rights and limitations under the
 # License.
 
+import os
 import sys
 import time
 
@@ -15,3 +16,32 @@ if sys.platform == 'win32':
     bttime = time.clock
 else:
     bttime = time.time
+
+# sendfile(out_fd, in_fd, offset, count) copies from a file to a socket
+# inside the kernel. python 2 has no os.sendfile, so on Linux call the libc
+# one through ctypes. None where neither is available.
+try:
+    from os import sendfile
+except ImportError:
+    sendfile = None
+    if sys.platform.startswith('linux'):
+        try:
+            import ctypes
+            import ctypes.util
+            _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            _sendfile64 = _libc.sendfile64
+        except (ImportError, OSError, AttributeError):
+            pass
+        else:
+            _sendfile64.argtypes = [ctypes.c_int, ctypes.c_int,
+                                    ctypes.POINTER(ctypes.c_int64),
+                                    ctypes.c_size_t]
+            _sendfile64.restype = ctypes.c_ssize_t
+
+            def sendfile(out_fd, in_fd, offset, count):
+                offset = ctypes.c_int64(offset)
+                sent = _sendfile64(out_fd, in_fd, ctypes.byref(offset), count)
+                if sent < 0:
+                    errno = ctypes.get_errno()
+                    raise OSError(errno, os.strerror(errno))
+                return sent
@@ -47,6 +47,14 @@ defaults = [
     ('response_size', 50, 'default number of peers to send in an info message if the client does not specify a number'),
     ('timeout_check_interval', 5,
         'time to wait between checking if any connections have timed out'),
+    ('poll_backend', 'auto',
+        "socket readiness mechanism to use: 'epoll' (Linux), 'poll' or 'select'. 'auto' picks the best one available"),
+    ('epoll_edge_triggered', 1,
+        'use edge-triggered notification with the epoll backend'),
+    ('read_buffer_size', 65536,
+        'size of the buffer that data is received into, the most that is read from a connection in one call'),
+    ('max_read_per_event', 262144,
+        'maximum number of bytes to read from one connection before serving the others'),
     ('nat_check', 3,
         "how many times to check if a downloader is behind a NAT (0 = don't check)"),
     ('log_nat_checks', 0,
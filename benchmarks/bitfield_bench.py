@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+
+# The contents of this file are subject to the BitTorrent Open Source License
+# Version 1.0 (the License).  You may not copy or use this file, in either
+# source code or executable form, except in compliance with the License.  You
+# may obtain a copy of the License at http://www.bittorrent.com/license/.
+#
+# Software distributed under the License is distributed on an AS IS basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied.  See the License
+# for the specific language governing rights and limitations under the
+# License.
+
+# Times what a peer connecting with a bitfield and disconnecting again costs
+# the picker, the way SingleDownload.got_have_bitfield and disconnected do
+# it: once a piece at a time with got_have/lost_have and the log string
+# built by concatenation, as they used to, and once with got_bitfield/
+# lost_bitfield on PiecePicker and BitsetPiecePicker. PEERS peers with a
+# random half of the pieces are connected already. Reports milliseconds
+# per connect and disconnect for a seed and for a peer with half the
+# pieces, at 10k, 50k and 200k pieces.
+
+import os
+import sys
+from random import Random, seed
+from time import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from BitTorrent.PiecePicker import PiecePicker, BitsetPiecePicker
+from BitTorrent.bitfield import Bitfield
+from BitTorrent.defaultargs import get_defaults
+
+PEERS = 20
+ROUNDS = 5
+
+
+class Peer(object):
+
+    def __init__(self, numpieces, pieces):
+        self.have = Bitfield(numpieces)
+        for i in pieces:
+            self.have[i] = True
+
+
+def old_connect(picker, peer):
+    bitfield = ''
+    for i in xrange(len(peer.have)):
+        if peer.have[i]:
+            bitfield += str(i) + ' '
+            picker.got_have(i, peer)
+    return bitfield
+
+
+def old_disconnect(picker, peer):
+    for i in xrange(len(peer.have)):
+        if peer.have[i]:
+            picker.lost_have(i, peer)
+    picker.lost_peer(peer)
+
+
+def new_connect(picker, peer):
+    indices = peer.have.indices()
+    picker.got_bitfield(peer.have, peer)
+    return ' '.join(map(str, indices)) + ' '
+
+
+def new_disconnect(picker, peer):
+    picker.lost_bitfield(peer.have, peer)
+    picker.lost_peer(peer)
+
+
+def setup(picker_class, numpieces, rand):
+    config = dict([(o[0], o[1]) for o in get_defaults('btlaunchmany')])
+    picker = picker_class(numpieces, config)
+    for i in rand.sample(xrange(numpieces), numpieces // 4):
+        picker.complete(i)
+    for j in xrange(PEERS):
+        peer = Peer(numpieces, rand.sample(xrange(numpieces), numpieces // 2))
+        picker.got_bitfield(peer.have, peer)
+    return picker
+
+
+def run(picker_class, connect, disconnect, numpieces, peer):
+    seed(1)
+    picker = setup(picker_class, numpieces, Random(0))
+    start = time()
+    for i in xrange(ROUNDS):
+        connect(picker, peer)
+        disconnect(picker, peer)
+    return (time() - start) * 1000 / ROUNDS
+
+
+def main():
+    print '%-8s %-6s %12s %12s %12s' % ('pieces', 'peer', 'per piece ms',
+                                        'bulk ms', 'bitset ms')
+    for numpieces in (10000, 50000, 200000):
+        rand = Random(2)
+        for name, peer in (
+            ('seed', Peer(numpieces, xrange(numpieces))),
+            ('half', Peer(numpieces, rand.sample(xrange(numpieces),
+                                                 numpieces // 2)))):
+            print '%-8d %-6s %12.2f %12.2f %12.2f' % (numpieces, name,
+                run(PiecePicker, old_connect, old_disconnect, numpieces, peer),
+                run(PiecePicker, new_connect, new_disconnect, numpieces, peer),
+                run(BitsetPiecePicker, new_connect, new_disconnect, numpieces,
+                    peer))
+
+
+if __name__ == '__main__':
+    main()
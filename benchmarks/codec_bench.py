@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+
+# The contents of this file are subject to the BitTorrent Open Source License
+# Version 1.0 (the License).  You may not copy or use this file, in either
+# source code or executable form, except in compliance with the License.  You
+# may obtain a copy of the License at http://www.bittorrent.com/license/.
+#
+# Software distributed under the License is distributed on an AS IS basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied.  See the License
+# for the specific language governing rights and limitations under the
+# License.
+
+# Encodes and decodes REQUEST, HAVE and PIECE header messages with the old
+# toint/tobinary helpers and with BitTorrent.messages, and reports messages
+# per second for each. Also compares sending a backlog of REQUESTs one
+# message at a time with the batch encoder.
+
+import os
+import sys
+from binascii import b2a_hex
+from time import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from BitTorrent import messages
+from BitTorrent.messages import REQUEST, HAVE, PIECE
+
+N = 200000
+BACKLOG = 10
+
+
+def toint(s):
+    return int(b2a_hex(s), 16)
+
+def tobinary(i):
+    return (chr(i >> 24) + chr((i >> 16) & 0xFF) +
+        chr((i >> 8) & 0xFF) + chr(i & 0xFF))
+
+
+def old_request(index, begin, length):
+    message = REQUEST + tobinary(index) + tobinary(begin) + tobinary(length)
+    return tobinary(len(message)) + message
+
+def old_have(index):
+    message = HAVE + tobinary(index)
+    return tobinary(len(message)) + message
+
+def old_piece_header(index, begin, length):
+    return ''.join((tobinary(length + 9), PIECE, tobinary(index),
+                    tobinary(begin)))
+
+def old_decode_request(m):
+    return toint(m[1:5]), toint(m[5:9]), toint(m[9:])
+
+def old_decode_have(m):
+    return toint(m[1:])
+
+def old_decode_piece(m):
+    return toint(m[1:5]), toint(m[5:9])
+
+def old_requests(reqs):
+    return [old_request(*r) for r in reqs]
+
+def new_requests(reqs):
+    return [messages.requests(reqs)]
+
+
+def encode(request, have, piece_header):
+    start = time()
+    for i in xrange(N):
+        request(i, 16384, 16384)
+        have(i)
+        piece_header(i, 16384, 16384)
+    return 3 * N / (time() - start)
+
+
+def decode(decode_request, decode_have, decode_piece):
+    r = messages.request(1234, 16384, 16384)[4:]
+    h = messages.have(1234)[4:]
+    p = messages.piece_header(1234, 16384, 16384)[4:]
+    start = time()
+    for i in xrange(N):
+        decode_request(r)
+        decode_have(h)
+        decode_piece(p)
+    return 3 * N / (time() - start)
+
+
+def batch(f):
+    reqs = [(i, j * 16384, 16384) for i in xrange(2) for j in
+            xrange(BACKLOG // 2)]
+    start = time()
+    for i in xrange(N // BACKLOG):
+        f(reqs)
+    return N / (time() - start)
+
+
+def main():
+    print '%-22s %14s %14s' % ('', 'old msgs/s', 'new msgs/s')
+    print '%-22s %14.0f %14.0f' % ('encode', encode(old_request, old_have,
+        old_piece_header), encode(messages.request, messages.have,
+        messages.piece_header))
+    print '%-22s %14.0f %14.0f' % ('decode', decode(old_decode_request,
+        old_decode_have, old_decode_piece), decode(messages.decode_request,
+        messages.decode_have, messages.decode_piece))
+    print '%-22s %14.0f %14.0f' % ('%d requests, batched' % BACKLOG,
+        batch(old_requests), batch(new_requests))
+    assert ''.join(old_requests([(1, 2, 3), (4, 5, 6)])) == \
+           messages.requests([(1, 2, 3), (4, 5, 6)])
+    assert old_piece_header(1, 2, 3) == messages.piece_header(1, 2, 3)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+
+# The contents of this file are subject to the BitTorrent Open Source License
+# Version 1.0 (the License).  You may not copy or use this file, in either
+# source code or executable form, except in compliance with the License.  You
+# may obtain a copy of the License at http://www.bittorrent.com/license/.
+#
+# Software distributed under the License is distributed on an AS IS basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied.  See the License
+# for the specific language governing rights and limitations under the
+# License.
+
+# Downloads a SIZE MiB torrent through StorageWrapper while serving UPLOADS
+# block requests for the pieces it has, on a Storage that sleeps DELAY
+# seconds on every read and write like a slow disk. Each block coming in and
+# each request is an event of the main loop, as they are for RawServer.
+# Reports how long the events held up the main loop on average, for the
+# slowest 1% and at worst, and the time taken until everything is on disk,
+# with the disk I/O done on the main loop and on threads.
+
+import os
+import sys
+import shutil
+import tempfile
+from random import Random
+from sha import sha
+from threading import Event, Lock
+from time import time, sleep
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from BitTorrent.Storage import Storage, FilePool
+from BitTorrent.StorageWrapper import StorageWrapper
+from BitTorrent.DiskIO import DiskIO
+from BitTorrent.defaultargs import get_defaults
+
+SIZE = 16
+PIECE_SIZE = 2 ** 18
+BLOCK = 2 ** 14
+UPLOADS = 2000
+DELAY = .004
+
+
+class Log(object):
+
+    def log(self, *args):
+        pass
+
+
+class SlowStorage(Storage):
+
+    def read(self, pos, amount):
+        sleep(DELAY)
+        return Storage.read(self, pos, amount)
+
+    def write(self, pos, s):
+        sleep(DELAY)
+        return Storage.write(self, pos, s)
+
+
+#stands in for RawServer: runs the events and the tasks the disk I/O threads
+#add, timing each
+class Loop(object):
+
+    def __init__(self):
+        self.lock = Lock()
+        self.tasks = []
+        self.times = []
+
+    def external_add_task(self, func, delay, context):
+        self.lock.acquire()
+        self.tasks.append(func)
+        self.lock.release()
+
+    def got_exception(self, e):
+        raise e
+
+    def run(self, func):
+        start = time()
+        func()
+        self.times.append(time() - start)
+
+    def run_tasks(self):
+        self.lock.acquire()
+        tasks = self.tasks
+        self.tasks = []
+        self.lock.release()
+        for func in tasks:
+            self.run(func)
+        return tasks
+
+    #like RawServer polling while the peers wait for the disk, or with drain
+    #until the disk is done
+    def wait(self, diskqueue, drain = False):
+        while diskqueue is not None and (diskqueue.full() or
+                                         drain and diskqueue.pending) \
+                  or self.tasks:
+            if not self.run_tasks():
+                sleep(.001)
+
+
+def run(work, data, hashes, threads):
+    config = dict([(o[0], o[1]) for o in get_defaults('btlaunchmany')])
+    config['write_cache_size'] = 0
+    config['read_cache_size'] = 0
+    name = os.path.join(work, 'out')
+    storage = SlowStorage(config, FilePool(config['max_files_open']),
+                          [(name, len(data))])
+    loop = Loop()
+    diskio = diskqueue = None
+    if threads:
+        diskio = DiskIO(loop.external_add_task, threads)
+        diskqueue = diskio.queue(loop, config['disk_io_queue'])
+    done = Event()
+    sw = StorageWrapper(storage, config, hashes, PIECE_SIZE, done.set,
+                        lambda *args, **kws: None, Event(), None, 'x' * 20,
+                        None, None, Log(), None, diskqueue)
+    rand = Random(1)
+    requests = []
+    for index in xrange(len(hashes)):
+        while sw.do_I_have_requests(index):
+            requests.append((index,) + sw.new_request(index))
+    uploads = [0]
+    def upload():
+        have = [i for i in xrange(len(hashes)) if sw.do_I_have(i)]
+        if not have:
+            return
+        index = rand.choice(have)
+        begin = rand.randrange(sw._piecelen(index) // BLOCK) * BLOCK
+        def sent(data):
+            uploads[0] += 1
+        if diskqueue is None:
+            sent(sw.get_piece(index, begin, BLOCK))
+        else:
+            sw.read_piece(index, begin, BLOCK, sent)
+    events = []
+    for index, begin, length in requests:
+        p = index * PIECE_SIZE + begin
+        def came_in(index = index, begin = begin, piece = data[p:p + length]):
+            sw.piece_came_in(index, begin, piece)
+        events.append(came_in)
+        events.append(upload)
+    start = time()
+    for func in events:
+        loop.wait(diskqueue)
+        loop.run(func)
+    while uploads[0] < UPLOADS:
+        loop.wait(diskqueue)
+        loop.run(upload)
+    sw.flush()
+    loop.wait(diskqueue, True)
+    elapsed = time() - start
+    storage.close()
+    f = open(name, 'rb')
+    ok = done.isSet() and f.read() == data
+    f.close()
+    os.remove(name)
+    times = loop.times
+    times.sort()
+    return ok, sum(times) / len(times) * 1000, \
+           times[len(times) * 99 // 100] * 1000, times[-1] * 1000, elapsed
+
+
+def main():
+    work = tempfile.mkdtemp()
+    try:
+        data = os.urandom(SIZE * 2 ** 20)
+        hashes = [sha(data[i:i + PIECE_SIZE]).digest()
+                  for i in xrange(0, len(data), PIECE_SIZE)]
+        print '%d MiB, %d uploads, %d ms per read and write' % (
+            SIZE, UPLOADS, DELAY * 1000)
+        print '%-8s %4s %10s %10s %10s %8s' % ('threads', 'ok', 'mean ms',
+                                               '99% ms', 'max ms', 's')
+        for threads in (0, 1, 2, 4):
+            ok, mean, p99, worst, t = run(work, data, hashes, threads)
+            print '%-8d %4s %10.3f %10.3f %10.3f %8.2f' % (threads,
+                ok and 'yes' or 'NO', mean, p99, worst, t)
+    finally:
+        shutil.rmtree(work)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+
+# The contents of this file are subject to the BitTorrent Open Source License
+# Version 1.0 (the License).  You may not copy or use this file, in either
+# source code or executable form, except in compliance with the License.  You
+# may obtain a copy of the License at http://www.bittorrent.com/license/.
+#
+# Software distributed under the License is distributed on an AS IS basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied.  See the License
+# for the specific language governing rights and limitations under the
+# License.
+
+# TORRENTS torrents of SIZE MiB on one simulated spinning disk, which takes
+# SEEK plus up to STROKE seconds, by the distance, to move to data not right
+# after the last read or write and RATE bytes a second to transfer it. Each
+# torrent downloads the pieces of the second half of its file ACTIVE at a
+# time, their blocks coming in interleaved and written as they come, and
+# PEERS peers each fetch a piece of the first half block by block. EVENTS
+# blocks in all, of random torrents, are written or read directly on the
+# main loop or through DiskIO, which puts the jobs queued in order of their
+# position, without and with merging them and collecting them for a window.
+# Reports the disk throughput, the operations the disk did and how long
+# the reads took, which through DiskIO includes the wait in the queue.
+
+import os
+import sys
+import shutil
+import tempfile
+from random import Random
+from threading import Lock
+from time import time, sleep
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from BitTorrent.Storage import Storage, FilePool
+from BitTorrent.DiskIO import DiskIO
+from BitTorrent.defaultargs import get_defaults
+
+TORRENTS = 4
+SIZE = 16
+PIECE_SIZE = 2 ** 18
+BLOCK = 2 ** 14
+ACTIVE = 4
+PEERS = 3
+EVENTS = 2000
+SEEK = .002
+STROKE = .008
+RATE = 80 * 2 ** 20
+
+
+class Disk(object):
+
+    def __init__(self):
+        self.lock = Lock()
+        self.head = 0
+        self.operations = 0
+
+    def access(self, pos, amount):
+        self.lock.acquire()
+        try:
+            delay = amount / float(RATE)
+            if pos != self.head:
+                delay += SEEK + STROKE * abs(pos - self.head) / \
+                         float(TORRENTS * SIZE * 2 ** 20)
+            sleep(delay)
+            self.head = pos + amount
+            self.operations += 1
+        finally:
+            self.lock.release()
+
+
+class DiskStorage(Storage):
+
+    def __init__(self, disk, base, *args):
+        Storage.__init__(self, *args)
+        self.disk = disk
+        self.base = base
+
+    def read(self, pos, amount):
+        self.disk.access(self.base + pos, amount)
+        return Storage.read(self, pos, amount)
+
+    def write(self, pos, s):
+        self.disk.access(self.base + pos, len(s))
+        return Storage.write(self, pos, s)
+
+
+#stands in for RawServer, running the tasks the disk I/O threads add
+class Loop(object):
+
+    def __init__(self):
+        self.lock = Lock()
+        self.tasks = []
+
+    def external_add_task(self, func, delay, context):
+        self.lock.acquire()
+        self.tasks.append(func)
+        self.lock.release()
+
+    def got_exception(self, e):
+        raise e
+
+    def run_tasks(self):
+        self.lock.acquire()
+        tasks = self.tasks
+        self.tasks = []
+        self.lock.release()
+        for func in tasks:
+            func()
+        return tasks
+
+
+#(torrent, is a read, position) of each block in the order they come
+def make_events():
+    rand = Random(1)
+    half = SIZE * 2 ** 20 // 2
+    pieces = half // PIECE_SIZE
+    writes = []
+    reads = []
+    for t in xrange(TORRENTS):
+        order = range(pieces, 2 * pieces)
+        rand.shuffle(order)
+        writes.append([[p * PIECE_SIZE, (p + 1) * PIECE_SIZE]
+                       for p in order[:ACTIVE]] + [order[ACTIVE:]])
+        reads.append([[0, 0] for i in xrange(PEERS)])
+    events = []
+    while len(events) < EVENTS:
+        t = rand.randrange(TORRENTS)
+        if rand.random() < .5:
+            active = writes[t]
+            w = rand.randrange(ACTIVE)
+            pos, end = active[w]
+            events.append((t, False, pos))
+            if pos + BLOCK < end:
+                active[w][0] = pos + BLOCK
+            else:
+                p = active[-1].pop()
+                active[w] = [p * PIECE_SIZE, (p + 1) * PIECE_SIZE]
+        else:
+            r = reads[t][rand.randrange(PEERS)]
+            if r[0] == r[1]:
+                r[0] = rand.randrange(half // PIECE_SIZE) * PIECE_SIZE
+                r[1] = r[0] + PIECE_SIZE
+            events.append((t, True, r[0]))
+            r[0] += BLOCK
+    return events
+
+
+def run(work, events, threads, window, merge):
+    config = dict([(o[0], o[1]) for o in get_defaults('btlaunchmany')])
+    disk = Disk()
+    filepool = FilePool(config['max_files_open'])
+    size = SIZE * 2 ** 20
+    storages = []
+    for t in xrange(TORRENTS):
+        name = os.path.join(work, str(t))
+        storages.append(DiskStorage(disk, t * size, config, filepool,
+                                    [(name, size)]))
+    block = 'x' * BLOCK
+    loop = Loop()
+    latencies = []
+    start = time()
+    if not threads:
+        for t, read, pos in events:
+            if read:
+                submitted = time()
+                storages[t].read(pos, BLOCK)
+                latencies.append(time() - submitted)
+            else:
+                storages[t].write(pos, block)
+    else:
+        diskio = DiskIO(loop.external_add_task, threads, window, merge)
+        queues = [diskio.queue(loop, config['disk_io_queue'])
+                  for t in xrange(TORRENTS)]
+        for t, read, pos in events:
+            #the peers wait while the torrent's queue is full
+            while queues[t].full():
+                if not loop.run_tasks():
+                    sleep(.001)
+            if read:
+                def got(data, submitted = time()):
+                    latencies.append(time() - submitted)
+                queues[t].read(storages[t], pos, BLOCK, got)
+            else:
+                queues[t].write(storages[t], pos, block)
+        for queue in queues:
+            queue.wait()
+        loop.run_tasks()
+    elapsed = time() - start
+    for storage in storages:
+        storage.close()
+    latencies.sort()
+    return (len(events) * BLOCK / elapsed / 2 ** 20, disk.operations,
+            sum(latencies) / len(latencies) * 1000,
+            latencies[len(latencies) * 99 // 100] * 1000, elapsed)
+
+
+def main():
+    work = tempfile.mkdtemp()
+    try:
+        for t in xrange(TORRENTS):
+            f = open(os.path.join(work, str(t)), 'wb')
+            f.write(os.urandom(SIZE * 2 ** 20))
+            f.close()
+        events = make_events()
+        print '%d torrents of %d MiB, %d blocks, %d ms + up to %d ms seeks' \
+              % (TORRENTS, SIZE, EVENTS, SEEK * 1000, STROKE * 1000)
+        print '%-26s %8s %6s %10s %10s %8s' % ('', 'MiB/s', 'ops',
+            'read ms', '99% ms', 's')
+        for name, threads, window, merge in (
+                ('direct', 0, 0, 0),
+                ('threads, no merging', 2, 0, 0),
+                ('threads, merging', 2, 0, 2 ** 20),
+                ('threads, 10 ms window', 2, .01, 2 ** 20)):
+            print '%-26s %8.2f %6d %10.2f %10.2f %8.2f' % ((name,) +
+                run(work, events, threads, window, merge))
+    finally:
+        shutil.rmtree(work)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+
+# The contents of this file are subject to the BitTorrent Open Source License
+# Version 1.0 (the License).  You may not copy or use this file, in either
+# source code or executable form, except in compliance with the License.  You
+# may obtain a copy of the License at http://www.bittorrent.com/license/.
+#
+# Software distributed under the License is distributed on an AS IS basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied.  See the License
+# for the specific language governing rights and limitations under the
+# License.
+
+# Plays out the endgame of a 4 GiB torrent (256 KiB pieces, 16 KiB blocks)
+# with 200 unchoked peers: with the old list based request tracking, with
+# RequestRegistry, and with RequestRegistry and the capped endgame policy.
+# Every peer starts with a backlog of the blocks still missing, then blocks
+# arrive from random holders until none are missing. Reports the time
+# taken, the CANCELs and REQUESTs sent and the bytes of blocks requested
+# more than once.
+
+import os
+import sys
+from random import Random, shuffle, seed
+from time import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from BitTorrent.Downloader import Downloader, SingleDownload, PerIPStats, \
+     BlockSet
+from BitTorrent.bitfield import Bitfield
+from BitTorrent.CurrentRateMeasure import Measure
+from BitTorrent.defaultargs import get_defaults
+
+PEERS = 200
+PIECE_SIZE = 2 ** 18
+BLOCK = 2 ** 14
+NUMPIECES = 4 * 2 ** 30 // PIECE_SIZE
+# pieces the endgame is still missing blocks from
+MISSING_PIECES = 200
+# the backlog normally follows the download rate, which here would depend
+# on how fast the run is, so both runs use the same fixed one
+BACKLOG = 20
+
+
+class Log(object):
+
+    def log(self, *args):
+        pass
+
+
+class Connection(object):
+
+    def __init__(self, ip):
+        self.ip = ip
+        self.id = ip
+        self.cancels = self.requests = 0
+
+    def send_interested(self):
+        pass
+
+    def send_not_interested(self):
+        pass
+
+    def send_cancel(self, index, begin, length):
+        self.cancels += 1
+
+    def send_requests(self, reqs):
+        self.requests += len(reqs)
+
+    def cork(self):
+        pass
+
+    def uncork(self):
+        return 1
+
+    def close(self):
+        pass
+
+
+class Storage(object):
+    piece_size = PIECE_SIZE
+    endgame = True
+
+    def piece_came_in(self, index, begin, piece, source):
+        return True
+
+    def do_I_have(self, index):
+        return False
+
+    def do_I_have_requests(self, index):
+        return False
+
+    def disk_full(self, func):
+        return False
+
+
+class Picker(object):
+
+    def am_I_complete(self):
+        return False
+
+
+class FixedBacklogDownload(SingleDownload):
+
+    def _backlog(self):
+        self.backlog = BACKLOG
+        return BACKLOG
+
+
+class OldSingleDownload(FixedBacklogDownload):
+    # active_requests and all_requests as lists, as before RequestRegistry;
+    # got_piece reduced to its endgame path
+
+    def __init__(self, *args):
+        FixedBacklogDownload.__init__(self, *args)
+        self.active_requests = []
+
+    def got_piece(self, index, begin, piece):
+        try:
+            self.active_requests.remove((index, begin, len(piece)))
+        except ValueError:
+            self.downloader.discarded_bytes += len(piece)
+            return False
+        self.downloader.all_requests.remove((index, begin, len(piece)))
+        self.measure.update_rate(len(piece))
+        for d in self.downloader.downloads:
+            if d is not self and d.interested:
+                if d.choked:
+                    d.fix_download_endgame()
+                else:
+                    try:
+                        d.active_requests.remove((index, begin, len(piece)))
+                    except ValueError:
+                        continue
+                    d.connection.send_cancel(index, begin, len(piece))
+                    d.fix_download_endgame()
+        self.fix_download_endgame()
+        return False
+
+    def fix_download_endgame(self):
+        want = [a for a in self.downloader.all_requests if self.have[a[0]] and a not in self.active_requests]
+        if self.interested and not self.active_requests and not want:
+            self.interested = False
+            return
+        if not self.interested and want:
+            self.interested = True
+        if not self.choked and len(self.active_requests) < self._backlog():
+            shuffle(want)
+            del want[self.backlog - len(self.active_requests):]
+            self.active_requests.extend(want)
+            if want:
+                self.connection.send_requests(want)
+
+
+def setup(download_class, policy):
+    config = dict([(o[0], o[1]) for o in get_defaults('btlaunchmany')])
+    config['endgame_policy'] = policy
+    rand = Random(0)
+    downloader = Downloader(config, Storage(), Picker(), NUMPIECES,
+                            Measure(20), lambda amount: None, None, None,
+                            Log())
+    pieces = rand.sample(xrange(NUMPIECES), MISSING_PIECES)
+    blocks = [(i, b, BLOCK) for i in pieces
+              for b in xrange(0, PIECE_SIZE, BLOCK)]
+    for i in xrange(PEERS):
+        ip = '10.0.%d.%d' % (i // 256, i % 256)
+        downloader.perip[ip] = PerIPStats()
+        d = download_class(downloader, Connection(ip), Log())
+        have = Bitfield(NUMPIECES)
+        for p in pieces:
+            if rand.random() < .9:
+                have[p] = True
+        d.have = have
+        d.choked = False
+        d.interested = True
+        downloader.downloads.append(d)
+    if download_class is OldSingleDownload:
+        downloader.all_requests = list(blocks)
+    else:
+        downloader.all_requests = BlockSet(blocks)
+        if downloader.endgame_capped:
+            downloader.requests.track_open(
+                downloader.endgame_max_duplicates, blocks)
+        downloader.endgame_pieces = dict.fromkeys(pieces,
+                                                  PIECE_SIZE // BLOCK)
+        for d in downloader.downloads:
+            d.needed = downloader.count_endgame_needed(d.have)
+    return downloader
+
+
+def run(download_class, policy):
+    seed(1)
+    downloader = setup(download_class, policy)
+    rand = Random(2)
+    piece = 'x' * BLOCK
+    start = time()
+    for d in downloader.downloads:
+        d.fix_download_endgame()
+    received = 0
+    while downloader.all_requests:
+        d = rand.choice(downloader.downloads)
+        if not d.active_requests:
+            d.fix_download_endgame()
+            continue
+        index, begin, length = rand.choice(list(d.active_requests))
+        d.got_piece(index, begin, piece)
+        received += 1
+    elapsed = time() - start
+    cancels = requests = 0
+    for d in downloader.downloads:
+        cancels += d.connection.cancels
+        requests += d.connection.requests
+    return elapsed, received, cancels, requests, (requests - received) * BLOCK
+
+
+def main():
+    print '%d peers, %d pieces, %d blocks missing' % (
+        PEERS, NUMPIECES, MISSING_PIECES * PIECE_SIZE // BLOCK)
+    print '%-10s %10s %10s %10s %10s %12s' % ('', 'seconds', 'received',
+        'cancels', 'requests', 'dup bytes')
+    for name, cls, policy in (('lists', OldSingleDownload, 'all'),
+                              ('registry', FixedBacklogDownload, 'all'),
+                              ('capped', FixedBacklogDownload, 'capped')):
+        print '%-10s %10.2f %10d %10d %10d %12d' % ((name,) +
+                                                    run(cls, policy))
+
+
+if __name__ == '__main__':
+    main()
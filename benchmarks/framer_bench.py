@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+
+# The contents of this file are subject to the BitTorrent Open Source License
+# Version 1.0 (the License).  You may not copy or use this file, in either
+# source code or executable form, except in compliance with the License.  You
+# may obtain a copy of the License at http://www.bittorrent.com/license/.
+#
+# Software distributed under the License is distributed on an AS IS basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied.  See the License
+# for the specific language governing rights and limitations under the
+# License.
+
+# Replays a peer wire byte stream through the old string based message
+# parser and through Connection.data_came_in, cut into reads the way
+# RawServer delivers them. The stream is either a capture of what a remote
+# peer sent (handshake included) given on the command line, or a generated
+# one: handshake, bitfield, then PIECE messages mixed with HAVEs and
+# REQUESTs. Reports the time per MiB and checks both parsers saw the same
+# messages.
+
+import os
+import sys
+from binascii import b2a_hex
+from random import Random
+from struct import pack
+from time import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from BitTorrent.Connecter import Connection, protocol_name
+from BitTorrent.messages import BITFIELD, HAVE, REQUEST, PIECE, UNCHOKE
+
+NUMPIECES = 1024
+BLOCK = 2 ** 14
+TOTAL = 64 * 2 ** 20
+DOWNLOAD_ID = 'i' * 20
+READ_SIZE = 65536
+
+
+class Log(object):
+
+    def log(self, *args):
+        pass
+
+
+class Socket(object):
+    ip = '127.0.0.1'
+
+    def write(self, s):
+        pass
+
+    def close(self):
+        pass
+
+
+class Peer(object):
+    # stands in for both the Download and the Upload of a connection;
+    # got_piece stores the block the way Storage.write would
+
+    def __init__(self):
+        self.store = bytearray(BLOCK * 64)
+        self.messages = 0
+        self.piece_bytes = 0
+
+    def got_piece(self, index, begin, piece):
+        self.messages += 1
+        self.piece_bytes += len(piece)
+        begin = (index % 64) * BLOCK + begin % BLOCK
+        self.store[begin:begin + len(piece)] = piece
+        return False
+
+    def got_have(self, index):
+        self.messages += 1
+
+    def got_request(self, index, begin, length):
+        self.messages += 1
+
+    def got_have_bitfield(self, b):
+        self.messages += 1
+
+    def got_unchoke(self):
+        self.messages += 1
+
+
+class Encoder(object):
+
+    def __init__(self):
+        self.download_id = DOWNLOAD_ID
+        self.my_id = 'm' * 20
+        self.numpieces = NUMPIECES
+        self.config = {'max_message_length': 2 ** 23,
+                       'one_connection_per_ip': False}
+        self.connections = {}
+        self.complete_connections = {}
+
+    def connection_completed(self, c):
+        c.upload = c.download = Peer()
+        self.complete_connections[c] = None
+
+
+def toint(s):
+    return int(b2a_hex(s), 16)
+
+
+class OldConnection(Connection):
+    # the string based parser Connection used before the framer
+
+    accepts_buffer = False
+
+    def __init__(self, *args):
+        self._buffer = []
+        self._buffer_len = 0
+        Connection.__init__(self, *args)
+
+    def _read_messages(self):
+        yield 1
+        if ord(self._message) != len(protocol_name):
+            return
+        yield len(protocol_name)
+        if self._message != protocol_name:
+            return
+        yield 8
+        yield 20
+        if self._message != self.encoder.download_id:
+            return
+        yield 20
+        self.id = self._message
+        self.complete = True
+        self.encoder.connection_completed(self)
+        while True:
+            yield 4
+            l = toint(self._message)
+            if l > self.encoder.config['max_message_length']:
+                return
+            if l > 0:
+                yield l
+                self._got_message(self._message)
+
+    def _got_message(self, message):
+        t = message[0]
+        if t == UNCHOKE:
+            self.download.got_unchoke()
+        elif t == HAVE:
+            self.download.got_have(toint(message[1:]))
+        elif t == BITFIELD:
+            self.download.got_have_bitfield(message[1:])
+        elif t == REQUEST:
+            self.upload.got_request(toint(message[1:5]), toint(message[5:9]),
+                                    toint(message[9:]))
+        elif t == PIECE:
+            self.download.got_piece(toint(message[1:5]), toint(message[5:9]),
+                                    message[9:])
+
+    def data_came_in(self, conn, s):
+        while True:
+            if self.closed:
+                return
+            i = self._next_len - self._buffer_len
+            if i > len(s):
+                self._buffer.append(s)
+                self._buffer_len += len(s)
+                return
+            m = s[:i]
+            if self._buffer_len > 0:
+                self._buffer.append(m)
+                m = ''.join(self._buffer)
+                self._buffer = []
+                self._buffer_len = 0
+            s = s[i:]
+            self._message = m
+            try:
+                self._next_len = self._reader.next()
+            except StopIteration:
+                self.close()
+                return
+
+
+def message(s):
+    return pack('>I', len(s)) + s
+
+
+def make_stream():
+    rand = Random(0)
+    parts = [chr(len(protocol_name)), protocol_name, chr(0) * 8,
+             DOWNLOAD_ID, 'p' * 20,
+             message(BITFIELD + chr(0xff) * (NUMPIECES // 8)),
+             message(UNCHOKE)]
+    block = ''.join([chr(rand.randrange(256)) for i in xrange(BLOCK)])
+    size = 0
+    while size < TOTAL:
+        index = rand.randrange(NUMPIECES)
+        parts.append(message(PIECE + pack('>II', index, 0) + block))
+        size += BLOCK
+        if rand.random() < .3:
+            parts.append(message(HAVE + pack('>I', index)))
+        if rand.random() < .1:
+            parts.append(message(REQUEST + pack('>III', index, 0, BLOCK)))
+    return ''.join(parts)
+
+
+def read_sizes(length):
+    # reads end wherever the network put them, mostly short of a full
+    # buffer, so messages often span two of them
+    rand = Random(1)
+    sizes = []
+    while length > 0:
+        n = min(length, rand.choice((READ_SIZE, READ_SIZE,
+                                     rand.randrange(1, READ_SIZE))))
+        sizes.append(n)
+        length -= n
+    return sizes
+
+
+def replay(connection_class, chunks):
+    c = connection_class(Encoder(), Socket(), None, True, Log())
+    start = time()
+    for chunk in chunks:
+        c.data_came_in(None, chunk)
+    elapsed = time() - start
+    assert c.complete and not c.closed
+    return elapsed, c.download
+
+
+def main():
+    if len(sys.argv) > 1:
+        stream = open(sys.argv[1], 'rb').read()
+    else:
+        stream = make_stream()
+    sizes = read_sizes(len(stream))
+    # the old path got a new string from every recv(), the new one gets
+    # views of the RawServer buffer
+    strings = []
+    views = []
+    data = bytearray(stream)
+    pos = 0
+    for n in sizes:
+        strings.append(stream[pos:pos + n])
+        views.append(memoryview(data)[pos:pos + n])
+        pos += n
+    mib = len(stream) / 2. ** 20
+    print '%d bytes in %d reads' % (len(stream), len(sizes))
+    print '%-10s %10s %10s %10s' % ('parser', 'messages', 'ms/MiB', 'MiB/s')
+    results = []
+    for name, cls, chunks in (('old', OldConnection, strings),
+                              ('framer', Connection, views)):
+        elapsed, peer = replay(cls, chunks)
+        results.append((peer.messages, peer.piece_bytes, str(peer.store)))
+        print '%-10s %10d %10.2f %10.1f' % (name, peer.messages,
+                                            elapsed * 1000 / mib,
+                                            mib / elapsed)
+    assert results[0] == results[1]
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+
+# The contents of this file are subject to the BitTorrent Open Source License
+# Version 1.0 (the License).  You may not copy or use this file, in either
+# source code or executable form, except in compliance with the License.  You
+# may obtain a copy of the License at http://www.bittorrent.com/license/.
+#
+# Software distributed under the License is distributed on an AS IS basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied.  See the License
+# for the specific language governing rights and limitations under the
+# License.
+
+# Times the check of the existing data StorageWrapper does when a torrent
+# is started without fastresume info, on a SIZE MiB torrent of FILES files
+# of uneven sizes: once the way it used to be done, reading and hashing a
+# piece at a time, and once through PieceHasher with 1, 2 and 4 hash
+# workers. All the data is there, so every piece is found in place. The
+# files are read once first so all runs read from the page cache; the
+# numbers are the hashing, not the disk. Reports GB/s.
+
+import os
+import sys
+import shutil
+import tempfile
+from random import Random
+from sha import sha
+from threading import Event
+from time import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from BitTorrent.Storage import Storage, FilePool
+from BitTorrent.StorageWrapper import StorageWrapper
+from BitTorrent.defaultargs import get_defaults
+
+SIZE = 256
+FILES = 7
+PIECE_SIZE = 2 ** 18
+ROUNDS = 3
+
+
+def make_files(work):
+    rand = Random(0)
+    total = SIZE * 2 ** 20
+    cuts = sorted(rand.sample(xrange(1, total), FILES - 1))
+    files = []
+    hashes = []
+    pending = ''
+    for i, (begin, end) in enumerate(zip([0] + cuts, cuts + [total])):
+        name = os.path.join(work, 'f%d' % i)
+        data = os.urandom(end - begin)
+        f = open(name, 'wb')
+        f.write(data)
+        f.close()
+        files.append((name, end - begin))
+        pending += data
+        while len(pending) >= PIECE_SIZE:
+            hashes.append(sha(pending[:PIECE_SIZE]).digest())
+            pending = pending[PIECE_SIZE:]
+    if pending:
+        hashes.append(sha(pending).digest())
+    return files, hashes
+
+
+# the hashing loop of StorageWrapper.__init__ as it used to be, for a
+# torrent with all its data in place
+def old_check(storage, hashes):
+    numpieces = len(hashes)
+    total = storage.get_total_length()
+    lastlen = total - (numpieces - 1) * PIECE_SIZE
+    found = 0
+    for i in xrange(numpieces):
+        data = storage.read(PIECE_SIZE * i, min(PIECE_SIZE,
+                                                total - PIECE_SIZE * i))
+        sh = sha(buffer(data, 0, lastlen))
+        sp = sh.digest()
+        sh.update(buffer(data, lastlen))
+        s = sh.digest()
+        if s == hashes[i]:
+            found += 1
+    return found
+
+
+def new_check(storage, config, hashes):
+    sw = StorageWrapper(storage, config, hashes, PIECE_SIZE, None,
+                        lambda *args, **kws: None, Event(), None, 'x' * 20,
+                        None, None, None)
+    return sw.stat_numfound
+
+
+def timed(f, *args):
+    best = None
+    for i in xrange(ROUNDS):
+        start = time()
+        found = f(*args)
+        t = time() - start
+        if best is None or t < best:
+            best = t
+    return found, best
+
+
+def main():
+    work = tempfile.mkdtemp()
+    try:
+        files, hashes = make_files(work)
+        defaults = dict([(o[0], o[1]) for o in get_defaults('btlaunchmany')])
+        filepool = FilePool(defaults['max_files_open'])
+        storage = Storage(defaults, filepool, files)
+        old_check(storage, hashes)
+        print '%d MiB in %d files, %d pieces' % (SIZE, FILES, len(hashes))
+        print '%-10s %8s %8s %8s' % ('', 'found', 's', 'GB/s')
+        runs = [('serial', old_check, (storage, hashes))]
+        for workers in (1, 2, 4):
+            config = defaults.copy()
+            config['hash_workers'] = workers
+            runs.append(('%d workers' % workers, new_check,
+                         (storage, config, hashes)))
+        for name, f, args in runs:
+            found, t = timed(f, *args)
+            print '%-10s %8d %8.2f %8.2f' % (name, found, t,
+                                             SIZE * 2 ** 20 / t / 1e9)
+        storage.close()
+    finally:
+        shutil.rmtree(work)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,321 @@
+#!/usr/bin/env python
+
+# The contents of this file are subject to the BitTorrent Open Source License
+# Version 1.0 (the License).  You may not copy or use this file, in either
+# source code or executable form, except in compliance with the License.  You
+# may obtain a copy of the License at http://www.bittorrent.com/license/.
+#
+# Software distributed under the License is distributed on an AS IS basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied.  See the License
+# for the specific language governing rights and limitations under the
+# License.
+
+# Plays a swarm of PEERS peers through Downloader, with the interest
+# decisions made by scanning as they used to be and with the per peer
+# needed counts. Half the pieces are downloaded already. The peers connect
+# with bitfields of a random 0.1% to 2% of the pieces, UNCHOKED of them are
+# unchoked, then blocks come in from the unchoked peers, peers send HAVEs
+# and now and then one is choked for another, until EVENTS have happened
+# or endgame starts. Reports the time taken for the bitfields and for the
+# rest, the INTERESTED and NOT_INTERESTED sent, and at the end how many
+# peers we are interested in with nothing to request from them ('stale')
+# or not interested in although they have pieces we need ('missed').
+
+import os
+import sys
+from random import Random, shuffle, seed
+from time import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from BitTorrent.Downloader import Downloader, SingleDownload, PerIPStats, \
+     BlockSet
+from BitTorrent.PiecePicker import PiecePicker
+from BitTorrent.bitfield import Bitfield
+from BitTorrent.CurrentRateMeasure import Measure
+from BitTorrent.defaultargs import get_defaults
+
+PEERS = 500
+UNCHOKED = 40
+NUMPIECES = 20000
+BLOCKS = 16
+BLOCK = 2 ** 14
+EVENTS = 100000
+# as in endgame_bench, a backlog that doesn't depend on the run's speed
+BACKLOG = 10
+
+
+class Log(object):
+
+    def log(self, *args):
+        pass
+
+
+class Connection(object):
+
+    def __init__(self, ip):
+        self.ip = ip
+        self.id = ip
+        self.interested = self.not_interested = 0
+
+    def send_interested(self):
+        self.interested += 1
+
+    def send_not_interested(self):
+        self.not_interested += 1
+
+    def send_cancel(self, index, begin, length):
+        pass
+
+    def send_requests(self, reqs):
+        pass
+
+    def cork(self):
+        pass
+
+    def uncork(self):
+        return 1
+
+    def close(self):
+        pass
+
+
+# StorageWrapper's request bookkeeping without the disk
+class Storage(object):
+    piece_size = BLOCKS * BLOCK
+    total_length = NUMPIECES * BLOCKS * BLOCK
+
+    def __init__(self, done):
+        self.endgame = False
+        self.have = [False] * NUMPIECES
+        self.numactive = [0] * NUMPIECES
+        self.inactive_requests = [None] * NUMPIECES
+        for i in xrange(NUMPIECES):
+            if i in done:
+                self.have[i] = True
+            else:
+                self.inactive_requests[i] = [(b, BLOCK) for b in
+                                             xrange(0, self.piece_size, BLOCK)]
+        self.amount_inactive = (NUMPIECES - len(done)) * self.piece_size
+
+    def do_I_have(self, index):
+        return self.have[index]
+
+    def do_I_have_requests(self, index):
+        return not not self.inactive_requests[index]
+
+    def new_request(self, index):
+        self.numactive[index] += 1
+        rs = self.inactive_requests[index]
+        r = min(rs)
+        rs.remove(r)
+        self.amount_inactive -= r[1]
+        if self.amount_inactive == 0:
+            self.endgame = True
+        return r
+
+    def request_lost(self, index, begin, length):
+        self.inactive_requests[index].append((begin, length))
+        self.amount_inactive += length
+        self.numactive[index] -= 1
+
+    def piece_came_in(self, index, begin, piece, source = None):
+        self.numactive[index] -= 1
+        if not self.inactive_requests[index] and not self.numactive[index]:
+            self.have[index] = True
+            self.inactive_requests[index] = None
+        return True
+
+    def disk_full(self, func):
+        return False
+
+
+class FixedBacklogDownload(SingleDownload):
+
+    def _backlog(self):
+        self.backlog = BACKLOG
+        return BACKLOG
+
+
+class OldSingleDownload(FixedBacklogDownload):
+    # interest decided by scanning, as before the needed counts
+
+    def __init__(self, *args):
+        FixedBacklogDownload.__init__(self, *args)
+        self.example_interest = None
+
+    def _letgo(self):
+        if not self.active_requests:
+            return
+        blocks = self.downloader.requests.drop(self)
+        lost = []
+        for index, begin, length in blocks:
+            self.downloader.storage.request_lost(index, begin, length)
+            if index not in lost:
+                lost.append(index)
+        ds = [d for d in self.downloader.downloads if not d.choked]
+        shuffle(ds)
+        for d in ds:
+            d._request_more(lost)
+        for d in self.downloader.downloads:
+            if d.choked and not d.interested:
+                for l in lost:
+                    if d.have[l] and self.downloader.storage.do_I_have_requests(l):
+                        d.interested = True
+                        d.connection.send_interested()
+                        break
+
+    def _request_more(self, indices = None):
+        assert not self.choked
+        if len(self.active_requests) >= self._backlog():
+            return
+        if self.downloader.storage.endgame:
+            return
+        lost_interests = []
+        while len(self.active_requests) < self.backlog:
+            if indices is None:
+                interest = self.downloader.picker.next(self._want,
+                                        self.have.numfalse == 0, self)
+            else:
+                interest = None
+                for i in indices:
+                    if self.have[i] and self.downloader.storage.do_I_have_requests(i):
+                        interest = i
+                        break
+            if interest is None:
+                break
+            if not self.interested:
+                self.interested = True
+                self.connection.send_interested()
+            self.example_interest = interest
+            self.downloader.picker.requested(interest, self.have.numfalse == 0)
+            reqs = []
+            while len(self.active_requests) < (self.backlog-2) * 5 + 2:
+                begin, length = self.downloader.storage.new_request(interest)
+                self.downloader.requests.add(self, (interest, begin, length))
+                reqs.append((interest, begin, length))
+                if not self.downloader.storage.do_I_have_requests(interest):
+                    lost_interests.append(interest)
+                    break
+            if reqs:
+                self._send_requests(reqs)
+        if not self.active_requests and self.interested:
+            self.interested = False
+            self.connection.send_not_interested()
+        if lost_interests:
+            for d in self.downloader.downloads:
+                if d.active_requests or not d.interested:
+                    continue
+                if d.example_interest is not None and self.downloader.storage.do_I_have_requests(d.example_interest):
+                    continue
+                for lost in lost_interests:
+                    if d.have[lost]:
+                        break
+                else:
+                    continue
+                interest = self.downloader.picker.next(d._want,
+                                                d.have.numfalse == 0, d)
+                if interest is None:
+                    d.interested = False
+                    d.connection.send_not_interested()
+                else:
+                    d.example_interest = interest
+
+    def got_have_bitfield(self, have):
+        self.have = have
+        indices = have.indices()
+        self.downloader.picker.got_bitfield(have, self)
+        bitfield = ' '.join(map(str, indices)) + ' '
+        self.logcollector.log(None, 'R BF ' + str(self.connection.ip) + ' ' + bitfield)
+        for i in indices:
+            if self.downloader.storage.do_I_have_requests(i):
+                self.interested = True
+                self.connection.send_interested()
+                return
+
+
+def setup(download_class):
+    config = dict([(o[0], o[1]) for o in get_defaults('btlaunchmany')])
+    rand = Random(0)
+    done = dict.fromkeys(rand.sample(xrange(NUMPIECES), NUMPIECES // 2))
+    storage = Storage(done)
+    picker = PiecePicker(NUMPIECES, config)
+    for i in done:
+        picker.complete(i)
+    downloader = Downloader(config, storage, picker, NUMPIECES, Measure(20),
+                            lambda amount: None, None, None, Log())
+    bitfields = []
+    for i in xrange(PEERS):
+        ip = '10.0.%d.%d' % (i // 256, i % 256)
+        downloader.perip[ip] = PerIPStats()
+        d = download_class(downloader, Connection(ip), Log())
+        downloader.downloads.append(d)
+        have = Bitfield(NUMPIECES)
+        for p in rand.sample(xrange(NUMPIECES),
+                             int(NUMPIECES * rand.uniform(.001, .02))):
+            have[p] = True
+        bitfields.append(have)
+    return downloader, bitfields
+
+
+def run(download_class):
+    seed(1)
+    downloader, bitfields = setup(download_class)
+    storage = downloader.storage
+    downloads = downloader.downloads
+    rand = Random(2)
+    start = time()
+    for d, have in zip(downloads, bitfields):
+        d.got_have_bitfield(have)
+    connected = time() - start
+    unchoked = rand.sample(downloads, UNCHOKED)
+    piece = 'x' * BLOCK
+    start = time()
+    for d in unchoked:
+        d.got_unchoke()
+    events = 0
+    while events < EVENTS and not storage.endgame:
+        events += 1
+        r = rand.random()
+        if r < .9:
+            d = rand.choice(unchoked)
+            if d.active_requests:
+                index, begin, length = rand.choice(list(d.active_requests))
+                d.got_piece(index, begin, piece)
+        elif r < .99:
+            d = rand.choice(downloads)
+            d.got_have(rand.randrange(NUMPIECES))
+        else:
+            j = rand.randrange(UNCHOKED)
+            unchoked[j].got_choke()
+            d = rand.choice(downloads)
+            while not d.choked:
+                d = rand.choice(downloads)
+            unchoked[j] = d
+            d.got_unchoke()
+    elapsed = time() - start
+    interested = not_interested = stale = missed = 0
+    for d in downloads:
+        interested += d.connection.interested
+        not_interested += d.connection.not_interested
+        needed = [i for i in d.have.indices()
+                  if storage.do_I_have_requests(i)]
+        if d.interested and not needed and not d.active_requests:
+            stale += 1
+        if not d.interested and needed:
+            missed += 1
+    return connected, elapsed, events, interested, not_interested, stale, missed
+
+
+def main():
+    print '%d peers, %d pieces, %d unchoked' % (PEERS, NUMPIECES, UNCHOKED)
+    print '%-8s %10s %10s %8s %10s %10s %6s %6s' % ('', 'connect s',
+        'events s', 'events', 'interest', 'not int', 'stale', 'missed')
+    for name, cls in (('scans', OldSingleDownload),
+                      ('counts', FixedBacklogDownload)):
+        print '%-8s %10.3f %10.2f %8d %10d %10d %6d %6d' % ((name,) +
+                                                            run(cls))
+
+
+if __name__ == '__main__':
+    main()
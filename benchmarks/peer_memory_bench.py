@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+
+# The contents of this file are subject to the BitTorrent Open Source License
+# Version 1.0 (the License).  You may not copy or use this file, in either
+# source code or executable form, except in compliance with the License.  You
+# may obtain a copy of the License at http://www.bittorrent.com/license/.
+#
+# Software distributed under the License is distributed on an AS IS basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied.  See the License
+# for the specific language governing rights and limitations under the
+# License.
+
+# Builds the objects a connected peer costs -- SingleSocket, Connection,
+# SingleDownload with its Measures, Bitfield and BadDataGuard, and Upload --
+# for 1k and 10k fake peers of one torrent, and reports the resident memory
+# and the number of python objects added per peer. Run it once per
+# scheduling_algorithm to see the cost of the PFS dicts:
+#   peer_memory_bench.py [BT|PFS|EPFS] [numpieces]
+
+import os
+import sys
+import gc
+from threading import Event
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from BitTorrent.RawServer import RawServer, SingleSocket
+from BitTorrent.Connecter import Connection
+from BitTorrent.Downloader import Downloader
+from BitTorrent.Uploader import Upload
+from BitTorrent.Choker import Choker
+from BitTorrent.CurrentRateMeasure import Measure
+from BitTorrent.defaultargs import get_defaults
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+
+class Log(object):
+
+    def log(self, *args):
+        pass
+
+
+class Socket(object):
+    # enough of a socket for SingleSocket.__init__
+
+    def __init__(self, fileno):
+        self._fileno = fileno
+
+    def fileno(self):
+        return self._fileno
+
+    def getpeername(self):
+        return ('10.%d.%d.%d' % (self._fileno >> 16, (self._fileno >> 8) &
+                                 255, self._fileno & 255), 6881)
+
+
+class Storage(object):
+    piece_size = 2 ** 18
+    diskqueue = None
+
+    def do_I_have_anything(self):
+        return False
+
+    def do_I_have_requests(self, index):
+        return True
+
+
+class Encoder(object):
+
+    def __init__(self, config, numpieces, downloader, choker):
+        self.config = config
+        self.numpieces = numpieces
+        self.downloader = downloader
+        self.choker = choker
+        self.download_id = 'i' * 20
+        self.my_id = 'm' * 20
+        self.connections = {}
+        self.complete_connections = {}
+        self.upmeasure = Measure(config['max_rate_period'])
+        self.log = Log()
+
+    def make_upload(self, c):
+        return Upload(c, None, self.upmeasure, self.upmeasure, self.choker,
+                      Storage(), self.config['max_slice_length'],
+                      self.config['max_rate_period'], self.log)
+
+    def connect(self, rawserver, fileno):
+        s = SingleSocket(rawserver, Socket(fileno), None, None)
+        c = Connection(self, s, None, False, self.log)
+        s.handler = c
+        self.connections[s] = c
+        # what Encoder.connection_completed does after the handshake
+        c.id = '%020d' % fileno
+        c.complete = True
+        self.complete_connections[c] = 1
+        c.upload = self.make_upload(c)
+        c.download = self.downloader.make_download(c)
+        return s
+
+
+def rss():
+    return int(open('/proc/self/statm').read().split()[1]) * PAGE_SIZE
+
+
+def measure(config, numpieces, peers):
+    rawserver = RawServer(Event(), config)
+    storage = Storage()
+    storage.endgame = False
+    downloader = Downloader(config, storage, None, numpieces,
+                            Measure(config['max_rate_period']), None, None,
+                            None, Log())
+    choker = Choker(config, lambda func, delay: None, Log())
+    encoder = Encoder(config, numpieces, downloader, choker)
+    gc.collect()
+    objects = len(gc.get_objects())
+    before = rss()
+    sockets = [encoder.connect(rawserver, i + 1000) for i in xrange(peers)]
+    gc.collect()
+    return ((rss() - before) / float(peers),
+            (len(gc.get_objects()) - objects) / float(peers))
+
+
+def main():
+    config = dict([(o[0], o[1]) for o in get_defaults('btlaunchmany')])
+    if len(sys.argv) > 1:
+        config['scheduling_algorithm'] = sys.argv[1]
+    numpieces = 1000
+    if len(sys.argv) > 2:
+        numpieces = int(sys.argv[2])
+    print 'scheduling_algorithm %s, %d pieces' % (
+        config['scheduling_algorithm'], numpieces)
+    print '%8s %14s %16s' % ('peers', 'bytes/peer', 'gc objects/peer')
+    for peers in (1000, 10000):
+        size, objects = measure(config, numpieces, peers)
+        print '%8d %14.0f %16.1f' % (peers, size, objects)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+
+# The contents of this file are subject to the BitTorrent Open Source License
+# Version 1.0 (the License).  You may not copy or use this file, in either
+# source code or executable form, except in compliance with the License.  You
+# may obtain a copy of the License at http://www.bittorrent.com/license/.
+#
+# Software distributed under the License is distributed on an AS IS basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied.  See the License
+# for the specific language governing rights and limitations under the
+# License.
+
+# Calls next() on PiecePicker and BitsetPiecePicker for torrents of 10k,
+# 100k and 1M pieces, half of which are already downloaded, with PEERS
+# peers that each have a random half of the pieces. Reports next() calls
+# per second for a peer like those ('half') and for one that has only
+# FEW of the missing pieces ('few'), and checks every pick is a piece the
+# peer has and that can still be requested.
+
+import os
+import sys
+from random import Random, seed
+from time import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from BitTorrent.PiecePicker import PiecePicker, BitsetPiecePicker
+from BitTorrent.bitfield import Bitfield
+from BitTorrent.defaultargs import get_defaults
+
+PEERS = 8
+FEW = 20
+# how long to keep calling next() for each case
+SECONDS = 1.0
+
+
+class Peer(object):
+
+    def __init__(self, numpieces, pieces):
+        self.have = Bitfield(numpieces)
+        for i in pieces:
+            self.have[i] = True
+
+
+def setup(picker_class, numpieces, rand):
+    config = dict([(o[0], o[1]) for o in get_defaults('btlaunchmany')])
+    picker = picker_class(numpieces, config)
+    pieces = range(numpieces)
+    rand.shuffle(pieces)
+    for i in pieces[:numpieces // 2]:
+        picker.complete(i)
+    missing = pieces[numpieces // 2:]
+    peers = []
+    for j in xrange(PEERS):
+        peer = Peer(numpieces, rand.sample(xrange(numpieces), numpieces // 2))
+        peers.append(peer)
+    few = Peer(numpieces, rand.sample(missing, FEW))
+    peers.append(few)
+    for peer in peers:
+        for i in xrange(numpieces):
+            if peer.have[i]:
+                picker.got_have(i, peer)
+    return picker, peers[0], few
+
+
+def calls(picker, peer):
+    def want(i):
+        return peer.have[i] and not picker.have[i]
+    start = time()
+    n = 0
+    while time() - start < SECONDS:
+        for k in xrange(10):
+            i = picker.next(want, False, peer)
+            assert i is not None and want(i)
+        n += 10
+    return n / (time() - start)
+
+
+def main():
+    print '%-10s %-6s %14s %14s' % ('pieces', 'peer', 'list next/s',
+                                    'bitset next/s')
+    for numpieces in (10000, 100000, 1000000):
+        results = {}
+        for picker_class in (PiecePicker, BitsetPiecePicker):
+            seed(1)
+            picker, half, few = setup(picker_class, numpieces, Random(0))
+            results[picker_class] = (calls(picker, half), calls(picker, few))
+        for j, name in ((0, 'half'), (1, 'few')):
+            print '%-10d %-6s %14.0f %14.0f' % (numpieces, name,
+                results[PiecePicker][j], results[BitsetPiecePicker][j])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+
+# The contents of this file are subject to the BitTorrent Open Source License
+# Version 1.0 (the License).  You may not copy or use this file, in either
+# source code or executable form, except in compliance with the License.  You
+# may obtain a copy of the License at http://www.bittorrent.com/license/.
+#
+# Software distributed under the License is distributed on an AS IS basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied.  See the License
+# for the specific language governing rights and limitations under the
+# License.
+
+# Compares the RawServer pollers on a simulated upload loop: every round a
+# tenth of the sockets get a 1380 byte write followed by the register() call
+# SingleSocket.try_write makes (with write interest for a quarter of them),
+# then the loop polls and reads what arrived.
+# Reports calls that reached the OS poll object and events handled per second.
+
+import os
+import sys
+import socket
+from time import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from BitTorrent.RawServer import PollPoller, EpollPoller, epoll
+
+ROUNDS = 20
+BLOCK = 'x' * 1380
+
+
+class LegacyPoller(PollPoller):
+    # what RawServer did before: every register() goes to the kernel
+    def register(self, fd, mask):
+        self.masks[fd] = mask
+        self.syscalls += 1
+        self._poll.register(fd, mask)
+
+
+def run(poller, n):
+    pairs = [socket.socketpair() for i in xrange(n // 2)]
+    socks = {}
+    for a, b in pairs:
+        for s in (a, b):
+            s.setblocking(0)
+            socks[s.fileno()] = s
+            poller.register(s.fileno(), poller.socket_mask(False))
+    peers = {}
+    for a, b in pairs:
+        peers[a.fileno()] = b
+        peers[b.fileno()] = a
+    active = socks.keys()[::10]
+    poller.syscalls = 0
+    handled = 0
+    t = time()
+    for r in xrange(ROUNDS):
+        for fd in active:
+            # every fourth socket finds its send buffer full and has to
+            # wait for POLLOUT for one round
+            blocked = (fd + r) % 4 == 0
+            socks[fd].send(BLOCK)
+            poller.register(fd, poller.socket_mask(blocked))
+        for fd, event in poller.poll(0):
+            handled += 1
+            try:
+                while socks[fd].recv(100000):
+                    pass
+            except socket.error:
+                pass
+    t = time() - t
+    for a, b in pairs:
+        a.close()
+        b.close()
+    return poller.syscalls, handled / t
+
+
+def main():
+    makers = [('legacy poll', LegacyPoller), ('poll', PollPoller)]
+    if epoll is not None:
+        makers.append(('epoll', lambda: EpollPoller(False)))
+        makers.append(('epoll ET', lambda: EpollPoller(True)))
+    print '%8s %-12s %10s %14s' % ('sockets', 'poller', 'syscalls', 'events/sec')
+    for n in (1000, 5000, 10000):
+        for name, maker in makers:
+            calls, rate = run(maker(), n)
+            print '%8d %-12s %10d %14.0f' % (n, name, calls, rate)
+
+
+if __name__ == '__main__':
+    main()
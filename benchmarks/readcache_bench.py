@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+
+# The contents of this file are subject to the BitTorrent Open Source License
+# Version 1.0 (the License).  You may not copy or use this file, in either
+# source code or executable form, except in compliance with the License.  You
+# may obtain a copy of the License at http://www.bittorrent.com/license/.
+#
+# Software distributed under the License is distributed on an AS IS basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied.  See the License
+# for the specific language governing rights and limitations under the
+# License.
+
+# Serves a flash crowd from a seed of a SIZE MiB torrent through
+# StorageWrapper.get_piece: PEERS peers at a time each fetch a piece block
+# by block, interleaved with the others, HOT_SHARE of them one of HOT
+# popular pieces and the rest any piece, until PIECES pieces were served.
+# The seed either checked its data on start-up or, as with fastresume, has
+# every piece checked when it's first uploaded. Counts the reads Storage
+# does and their bytes, with the read cache off and on, and reports them
+# per uploaded byte with the hit rate and the time taken.
+
+import os
+import sys
+import shutil
+import tempfile
+from random import Random
+from sha import sha
+from threading import Event
+from time import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from BitTorrent.Storage import Storage, FilePool, ReadCache
+from BitTorrent.StorageWrapper import StorageWrapper
+from BitTorrent.defaultargs import get_defaults
+
+SIZE = 64
+PIECE_SIZE = 2 ** 18
+BLOCK = 2 ** 14
+PEERS = 40
+PIECES = 2000
+HOT = 8
+HOT_SHARE = .8
+
+
+class CountingStorage(Storage):
+
+    def __init__(self, *args):
+        Storage.__init__(self, *args)
+        self.reads = self.bytes_read = 0
+
+    def read(self, pos, amount):
+        self.reads += 1
+        self.bytes_read += amount
+        return Storage.read(self, pos, amount)
+
+
+def run(name, hashes, check_hashes, cache_size):
+    config = dict([(o[0], o[1]) for o in get_defaults('btlaunchmany')])
+    config['check_hashes'] = check_hashes
+    storage = CountingStorage(config, FilePool(config['max_files_open']),
+                              [(name, SIZE * 2 ** 20)])
+    sw = StorageWrapper(storage, config, hashes, PIECE_SIZE, None,
+                        lambda *args, **kws: None, Event(), None, 'x' * 20,
+                        None, None, None, ReadCache(cache_size))
+    storage.reads = storage.bytes_read = 0
+    rand = Random(1)
+    hot = rand.sample(xrange(len(hashes)), HOT)
+    def pick():
+        if rand.random() < HOT_SHARE:
+            return rand.choice(hot)
+        return rand.randrange(len(hashes))
+    fetching = [[pick(), 0] for i in xrange(PEERS)]
+    served = uploaded = 0
+    start = time()
+    while served < PIECES:
+        for f in fetching:
+            index, begin = f
+            uploaded += len(sw.get_piece(index, begin, BLOCK))
+            if begin + BLOCK < PIECE_SIZE:
+                f[1] += BLOCK
+            else:
+                served += 1
+                f[:] = [pick(), 0]
+    elapsed = time() - start
+    lookups = sw.stat_cache_hits + sw.stat_cache_misses
+    storage.close()
+    return (storage.reads / float(uploaded) * BLOCK,
+            storage.bytes_read / float(uploaded),
+            sw.stat_cache_hits / float(lookups), elapsed)
+
+
+def main():
+    work = tempfile.mkdtemp()
+    try:
+        data = os.urandom(SIZE * 2 ** 20)
+        name = os.path.join(work, 'f')
+        f = open(name, 'wb')
+        f.write(data)
+        f.close()
+        hashes = [sha(data[i:i + PIECE_SIZE]).digest()
+                  for i in xrange(0, len(data), PIECE_SIZE)]
+        print '%d MiB, %d peers, %d pieces served, %d%% of them from %d ' \
+              'pieces' % (SIZE, PEERS, PIECES, HOT_SHARE * 100, HOT)
+        print '%-10s %-10s %10s %8s %6s %8s' % ('check', 'cache',
+            'reads/blk', 'read/B', 'hits', 's')
+        for check_hashes, check in ((1, 'start-up'), (0, 'lazy')):
+            for cache_size in (0, 16 * 2 ** 20):
+                print '%-10s %-10s %10.3f %8.3f %6.2f %8.2f' % ((check,
+                    '%d MiB' % (cache_size // 2 ** 20)) +
+                    run(name, hashes, check_hashes, cache_size))
+    finally:
+        shutil.rmtree(work)
+
+
+if __name__ == '__main__':
+    main()
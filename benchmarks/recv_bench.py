@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+
+# The contents of this file are subject to the BitTorrent Open Source License
+# Version 1.0 (the License).  You may not copy or use this file, in either
+# source code or executable form, except in compliance with the License.  You
+# may obtain a copy of the License at http://www.bittorrent.com/license/.
+#
+# Software distributed under the License is distributed on an AS IS basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied.  See the License
+# for the specific language governing rights and limitations under the
+# License.
+
+# Receives the same stream with the old recv(100000) loop and with
+# RawServer._read_socket, once for a handler that takes a string and once
+# for one that accepts the memoryview. Reports recv calls, string objects
+# allocated by the receive path and bytes allocated per MiB received.
+
+import os
+import sys
+import socket
+import threading
+from errno import EWOULDBLOCK
+from threading import Event
+from time import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from BitTorrent.RawServer import RawServer
+from BitTorrent.defaultargs import get_defaults
+
+TOTAL = 128 * 2 ** 20
+
+
+class Handler(object):
+
+    def __init__(self):
+        self.got = 0
+
+    def data_came_in(self, conn, data):
+        self.got += len(data)
+
+    def connection_lost(self, conn):
+        pass
+
+
+class BufferHandler(Handler):
+    accepts_buffer = True
+
+
+def writer(sock):
+    block = 'x' * 16397
+    sent = 0
+    while sent < TOTAL:
+        sock.sendall(block)
+        sent += len(block)
+    sock.shutdown(socket.SHUT_WR)
+
+
+def old_path(a, handler):
+    calls = allocated = 0
+    while True:
+        try:
+            data = a.recv(100000)
+        except socket.error, e:
+            if e[0] != EWOULDBLOCK:
+                raise
+            continue
+        calls += 1
+        allocated += len(data)
+        if data == '':
+            return calls, calls, allocated
+        handler.data_came_in(a, data)
+
+
+def new_path(rawserver, a, handler):
+    s = rawserver.wrap_socket(a, handler)
+    before = rawserver.get_stats()
+    while s.socket is not None:
+        rawserver._read_socket(s)
+    after = rawserver.get_stats()
+    calls = after['recv_calls'] - before['recv_calls']
+    copies = after['recv_copies'] - before['recv_copies']
+    if copies:
+        allocated = after['recv_bytes'] - before['recv_bytes']
+    else:
+        allocated = 0
+    return calls, copies, allocated
+
+
+def run(f, handler):
+    a, b = socket.socketpair()
+    a.setblocking(0)
+    t = threading.Thread(target=writer, args=(b,))
+    t.setDaemon(True)
+    t.start()
+    start = time()
+    calls, allocs, allocated = f(a, handler)
+    elapsed = time() - start
+    t.join()
+    b.close()
+    mib = handler.got / 2 ** 20
+    return calls / mib, allocs / mib, allocated / mib, mib / elapsed
+
+
+def main():
+    config = dict([(o[0], o[1]) for o in get_defaults('btlaunchmany')])
+    rawserver = RawServer(Event(), config)
+    def new(a, handler):
+        return new_path(rawserver, a, handler)
+    print '%-18s %12s %12s %14s %8s' % ('path', 'recv/MiB', 'allocs/MiB',
+                                        'alloc B/MiB', 'MiB/s')
+    for name, f, handler in (('recv(100000)', old_path, Handler()),
+                             ('recv_into, str', new, Handler()),
+                             ('recv_into, view', new, BufferHandler())):
+        r = run(f, handler)
+        print '%-18s %12.1f %12.1f %14.0f %8.1f' % ((name,) + r)
+
+
+if __name__ == '__main__':
+    main()
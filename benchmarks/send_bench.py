@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+
+# The contents of this file are subject to the BitTorrent Open Source License
+# Version 1.0 (the License).  You may not copy or use this file, in either
+# source code or executable form, except in compliance with the License.  You
+# may obtain a copy of the License at http://www.bittorrent.com/license/.
+#
+# Software distributed under the License is distributed on an AS IS basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied.  See the License
+# for the specific language governing rights and limitations under the
+# License.
+
+# Pushes the same upload through the old list-based SingleSocket output path
+# and the current deque one: upload_unit_size writes of PIECE data like
+# Connection.send_partial makes, mixed with small control messages, to a
+# reader thread on the other end of a socketpair. Both register the
+# socket's poll mask after each attempt, as SingleSocket does. The deque
+# path is run as is and with each piece's writes corked, the way
+# send_partial queues the parts of a message. Reports send() calls and the
+# best throughput of RUNS runs.
+
+import os
+import sys
+import socket
+import threading
+from errno import EWOULDBLOCK
+from threading import Event
+from time import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from BitTorrent.RawServer import RawServer, make_poller
+from BitTorrent.defaultargs import get_defaults
+
+TOTAL = 64 * 2 ** 20
+UNIT = 1380
+RUNS = 3
+
+
+class OldSocket(object):
+    # output path of SingleSocket before the deque
+
+    def __init__(self, sock):
+        self.socket = sock
+        self.buffer = []
+        self.send_calls = 0
+        self.poll = make_poller()
+        self.fileno = sock.fileno()
+
+    def cork(self):
+        pass
+
+    def uncork(self):
+        pass
+
+    def is_flushed(self):
+        return len(self.buffer) == 0
+
+    def write(self, s):
+        self.buffer.append(s)
+        if len(self.buffer) == 1:
+            self.try_write()
+
+    def try_write(self):
+        try:
+            while self.buffer != []:
+                self.send_calls += 1
+                amount = self.socket.send(self.buffer[0])
+                if amount != len(self.buffer[0]):
+                    if amount != 0:
+                        self.buffer[0] = self.buffer[0][amount:]
+                    break
+                del self.buffer[0]
+        except socket.error, e:
+            if e[0] != EWOULDBLOCK:
+                raise
+        self.poll.register(self.fileno,
+                           self.poll.socket_mask(len(self.buffer) > 0))
+
+
+class Handler(object):
+
+    def connection_lost(self, s):
+        pass
+
+
+def reader(sock, done):
+    got = 0
+    while got < TOTAL:
+        got += len(sock.recv(262144))
+    done.set()
+
+
+def run(make, corked):
+    a, b = socket.socketpair()
+    a.setblocking(0)
+    s = make(a)
+    done = Event()
+    t = threading.Thread(target=reader, args=(b, done))
+    t.start()
+    piece = 'x' * 16384
+    start = time()
+    sent = 0
+    while sent < TOTAL:
+        if corked:
+            s.cork()
+        for i in xrange(0, len(piece), UNIT):
+            s.write(buffer(piece, i, UNIT))
+            sent += len(piece[i:i + UNIT])
+        # HAVE / REQUEST sized control messages
+        s.write('h' * 9)
+        s.write('r' * 17)
+        sent += 26
+        if corked:
+            s.uncork()
+        while len(s.buffer) > 200:
+            s.try_write()
+    while not s.is_flushed():
+        s.try_write()
+    done.wait()
+    elapsed = time() - start
+    t.join()
+    a.close()
+    b.close()
+    return s.send_calls, sent / elapsed / 2 ** 20
+
+
+def main():
+    config = dict([(o[0], o[1]) for o in get_defaults('btlaunchmany')])
+    rawserver = RawServer(Event(), config)
+    def new(sock):
+        s = rawserver.wrap_socket(sock, Handler())
+        s.connected = True
+        return s
+    paths = (('list', OldSocket, False), ('deque', new, False),
+             ('corked', new, True))
+    results = dict([(name, (0, 0.0)) for name, make, corked in paths])
+    # interleaved, so that changes in machine load hit all of them
+    for i in xrange(RUNS):
+        for name, make, corked in paths:
+            calls, rate = run(make, corked)
+            results[name] = (calls, max(rate, results[name][1]))
+    print '%-8s %12s %10s' % ('path', 'send calls', 'MiB/s')
+    for name, make, corked in paths:
+        print '%-8s %12d %10.1f' % ((name,) + results[name])
+
+
+if __name__ == '__main__':
+    main()
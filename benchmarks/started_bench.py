@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+
+# The contents of this file are subject to the BitTorrent Open Source License
+# Version 1.0 (the License).  You may not copy or use this file, in either
+# source code or executable form, except in compliance with the License.  You
+# may obtain a copy of the License at http://www.bittorrent.com/license/.
+#
+# Software distributed under the License is distributed on an AS IS basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied.  See the License
+# for the specific language governing rights and limitations under the
+# License.
+
+# Compares PiecePicker with the list based started/seedstarted and bump it
+# used to have. First times a resume of a 100k piece torrent with DIRTY
+# partial pieces replayed through requested(), which then get completed
+# or bumped. Then plays TRIALS random small swarms with started, completed
+# and bumped pieces through both and compares how often next() picks each
+# piece: the total variation distance between the two should be down at
+# the level of the sampling noise, which is printed for reference.
+
+import os
+import sys
+from random import Random, seed
+from time import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from BitTorrent.PiecePicker import PiecePicker
+from BitTorrent.defaultargs import get_defaults
+
+NUMPIECES = 100000
+DIRTY = 5000
+TRIALS = 20000
+SMALL = 24
+
+
+class OldPiecePicker(PiecePicker):
+
+    def __init__(self, numpieces, config):
+        PiecePicker.__init__(self, numpieces, config)
+        self.started = []
+        self.seedstarted = []
+
+    def requested(self, piece, seed = False):
+        if piece not in self.started:
+            self.started.append(piece)
+        if seed and piece not in self.seedstarted:
+            self.seedstarted.append(piece)
+
+    def complete(self, piece):
+        assert not self.have[piece]
+        self.have[piece] = True
+        self.crosscount[self.numinterests[piece]] -= 1
+        try:
+            self.crosscount[self.numinterests[piece] + 1] += 1
+        except IndexError:
+            self.crosscount.append(1)
+        self.numgot += 1
+        l = self.interests[self.numinterests[piece]]
+        p = self.pos_in_interests[piece]
+        l[p] = l[-1]
+        self.pos_in_interests[l[-1]] = p
+        del l[-1]
+        try:
+            self.started.remove(piece)
+            self.seedstarted.remove(piece)
+        except ValueError:
+            pass
+
+    def bump(self, piece):
+        l = self.interests[self.numinterests[piece]]
+        pos = self.pos_in_interests[piece]
+        del l[pos]
+        l.append(piece)
+        for i in range(pos,len(l)):
+            self.pos_in_interests[l[i]] = i
+        try:
+            self.started.remove(piece)
+            self.seedstarted.remove(piece)
+        except ValueError:
+            pass
+
+
+def config():
+    return dict([(o[0], o[1]) for o in get_defaults('btlaunchmany')])
+
+
+def resume(picker_class):
+    rand = Random(0)
+    picker = picker_class(NUMPIECES, config())
+    for i in xrange(NUMPIECES):
+        picker.got_have(i)
+    dirty = rand.sample(xrange(NUMPIECES), DIRTY)
+    start = time()
+    for i in dirty:
+        picker.requested(i)
+    for i in dirty:
+        picker.requested(i)
+    rand.shuffle(dirty)
+    for i in dirty[:DIRTY // 2]:
+        picker.complete(i)
+    for i in dirty[DIRTY // 2:]:
+        picker.bump(i)
+    return time() - start
+
+
+def trial(picker_class, rand):
+    picker = picker_class(SMALL, config())
+    have = [[rand.random() < .5 for i in xrange(SMALL)] for j in xrange(3)]
+    for h in have:
+        for i in xrange(SMALL):
+            if h[i]:
+                picker.got_have(i)
+    for i in xrange(SMALL):
+        r = rand.random()
+        if r < .2:
+            picker.complete(i)
+        elif r < .5:
+            picker.requested(i, rand.random() < .5)
+            if rand.random() < .5:
+                picker.bump(i)
+    peer = have[0]
+    def want(i):
+        return peer[i] and not picker.have[i] and (i not in picker.started
+                                                   or rand.random() < .5)
+    return picker.next(want, rand.random() < .3)
+
+
+def distribution(picker_class, rand):
+    counts = {}
+    for j in xrange(TRIALS):
+        i = trial(picker_class, rand)
+        counts[i] = counts.get(i, 0) + 1
+    return counts
+
+
+def distance(a, b):
+    keys = dict.fromkeys(a.keys() + b.keys())
+    return sum([abs(a.get(k, 0) - b.get(k, 0)) for k in keys]) / 2. / TRIALS
+
+
+def main():
+    print '%d pieces, %d dirty' % (NUMPIECES, DIRTY)
+    print '%-8s %10s' % ('', 'seconds')
+    for name, cls in (('lists', OldPiecePicker), ('dicts', PiecePicker)):
+        seed(1)
+        print '%-8s %10.3f' % (name, resume(cls))
+    seed(2)
+    old = distribution(OldPiecePicker, Random(3))
+    new = distribution(PiecePicker, Random(3))
+    noise = distribution(OldPiecePicker, Random(4))
+    print 'next() picks over %d trials, total variation distance' % TRIALS
+    print '%-18s %8.4f' % ('lists vs dicts', distance(old, new))
+    print '%-18s %8.4f' % ('lists vs lists', distance(old, noise))
+
+
+if __name__ == '__main__':
+    main()
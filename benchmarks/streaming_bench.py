@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+
+# The contents of this file are subject to the BitTorrent Open Source License
+# Version 1.0 (the License).  You may not copy or use this file, in either
+# source code or executable form, except in compliance with the License.  You
+# may obtain a copy of the License at http://www.bittorrent.com/license/.
+#
+# Software distributed under the License is distributed on an AS IS basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied.  See the License
+# for the specific language governing rights and limitations under the
+# License.
+
+# Runs a loopback swarm of a tracker, SEEDS upload rate limited seeds and
+# one slower one, and downloads a SIZE MiB file from them with
+# btdownloadheadless.py: once with the default picker, once with
+# --streaming, and once with --streaming and the read cursor moved to the
+# middle of the file through the control socket right away ('seek').
+# Reports the seconds until the first FIRST MiB of the file, the FIRST MiB
+# from the middle on and the whole file were downloaded.
+
+import os
+import sys
+import shutil
+import tempfile
+from random import Random
+from subprocess import Popen
+from time import time, sleep
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from BitTorrent.controlsocket import ControlSocket
+from BitTorrent import BTFailure
+
+SIZE = 32
+FIRST = 4
+SEEDS = 2
+# kB/s
+SEED_RATE = 1000
+SLOW_SEED_RATE = 50
+PIECE_SIZE_POW2 = 18
+TRACKER_PORT = 16979
+TIMEOUT = 180
+
+root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+devnull = open(os.devnull, 'w')
+
+
+def script(name):
+    return [sys.executable, os.path.join(root, name)]
+
+
+def start(args, cwd):
+    return Popen(args, cwd = cwd, stdout = devnull, stderr = devnull)
+
+
+def client(work, name, port, torrent, save_as, options):
+    d = os.path.join(work, name)
+    os.mkdir(d)
+    return start(script('btdownloadheadless.py') + [
+        '--data_dir', os.path.join(d, 'data'), '--minport', str(port),
+        '--maxport', str(port), '--save_as', save_as,
+        '--one_connection_per_ip', '0', '--display_interval', '5'] +
+        options + [torrent], d)
+
+
+def ready(path, data, begin, end):
+    try:
+        f = open(path, 'rb')
+    except IOError:
+        return False
+    try:
+        f.seek(begin)
+        return f.read(end - begin) == data[begin:end]
+    finally:
+        f.close()
+
+
+def send_cursor(datadir, pos, deadline):
+    controlsocket = ControlSocket({'data_dir': datadir})
+    while time() < deadline:
+        try:
+            controlsocket.send_command('set_cursor', str(pos))
+            return
+        except BTFailure:
+            sleep(.05)
+
+
+def run(work, torrent, data, options, seek):
+    mid = len(data) // 2
+    first = FIRST * 2 ** 20
+    regions = {'first': (0, first), 'middle': (mid, mid + first),
+               'all': (0, len(data))}
+    save_as = os.path.join(work, 'leech.bin')
+    leech = client(work, 'leech', 17420, torrent, save_as, options)
+    begin = time()
+    if seek:
+        send_cursor(os.path.join(work, 'leech', 'data'), mid,
+                    begin + TIMEOUT)
+    times = {}
+    try:
+        while len(times) < len(regions) and time() - begin < TIMEOUT:
+            for name, (a, b) in regions.items():
+                if name not in times and ready(save_as, data, a, b):
+                    times[name] = time() - begin
+            sleep(.1)
+    finally:
+        leech.terminate()
+        leech.wait()
+    shutil.rmtree(os.path.join(work, 'leech'))
+    os.remove(save_as)
+    return [times.get(name) for name in ('first', 'middle', 'all')]
+
+
+def fmt(t):
+    if t is None:
+        return '%10s' % 'timeout'
+    return '%10.2f' % t
+
+
+def main():
+    work = tempfile.mkdtemp()
+    procs = []
+    try:
+        rand = Random(0)
+        data = ''.join([chr(rand.randrange(256))
+                        for i in xrange(SIZE * 2 ** 20)])
+        source = os.path.join(work, 'f.bin')
+        f = open(source, 'wb')
+        f.write(data)
+        f.close()
+        start(script('btmaketorrent.py') + ['--piece_size_pow2',
+            str(PIECE_SIZE_POW2), 'http://127.0.0.1:%d/announce' %
+            TRACKER_PORT, source], work).wait()
+        torrent = source + '.torrent'
+        procs.append(start(script('bttrack.py') + ['--port',
+            str(TRACKER_PORT), '--dfile', os.path.join(work, 'dfile'),
+            '--nat_check', '0'], work))
+        sleep(.5)
+        rates = [SEED_RATE] * SEEDS + [SLOW_SEED_RATE]
+        for i, rate in enumerate(rates):
+            procs.append(client(work, 'seed%d' % i, 17400 + i, torrent,
+                                source, ['--max_upload_rate', str(rate),
+                                '--unchoke_interval', '1',
+                                '--shutdown_after_seed', '0']))
+        sleep(2)
+        print '%d MiB, %d seeds at %d kB/s and one at %d kB/s' % (
+            SIZE, SEEDS, SEED_RATE, SLOW_SEED_RATE)
+        print '%-10s %10s %10s %10s' % ('', 'first s', 'middle s', 'all s')
+        for name, options, seek in (('rarest', [], False),
+                                    ('streaming', ['--streaming', '1'], False),
+                                    ('seek', ['--streaming', '1'], True)):
+            print '%-10s %s %s %s' % ((name,) + tuple(map(fmt,
+                run(work, torrent, data, options, seek))))
+    finally:
+        for p in procs:
+            p.terminate()
+            p.wait()
+        shutil.rmtree(work)
+
+
+if __name__ == '__main__':
+    main()
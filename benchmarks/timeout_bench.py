@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+
+# The contents of this file are subject to the BitTorrent Open Source License
+# Version 1.0 (the License).  You may not copy or use this file, in either
+# source code or executable form, except in compliance with the License.  You
+# may obtain a copy of the License at http://www.bittorrent.com/license/.
+#
+# Software distributed under the License is distributed on an AS IS basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied.  See the License
+# for the specific language governing rights and limitations under the
+# License.
+
+# Tracker load test for idle connection expiry: 50k mostly idle connections
+# with the tracker's socket_timeout and timeout_check_interval, which only
+# send data shortly before they would time out. A small fraction of them
+# goes away and has to be expired. Compares the old full scan of
+# single_sockets with the TimeoutWheel, using simulated time. Activity is
+# timed on its own: the last_hit update for the full scan, and for the
+# wheel the same update plus the move of sockets whose bucket is close to
+# coming due, as RawServer does it. Every socket here is active just before it would
+# time out, so nearly every touch is such a move.
+
+import os
+import sys
+from random import random, seed
+from time import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from BitTorrent.RawServer import TimeoutWheel
+from BitTorrent.track import defaults
+
+CONNECTIONS = 50000
+DEAD_FRACTION = .01
+SCANS = 60
+
+
+class FakeSocket(object):
+
+    def __init__(self, t):
+        self.last_hit = t
+        self.idle_tick = None
+
+
+def main():
+    config = dict([(o[0], o[1]) for o in defaults])
+    timeout = config['socket_timeout']
+    interval = config['timeout_check_interval']
+    seed(0)
+    now = 1000000.0
+    socks = [FakeSocket(now - timeout * random()) for i in xrange(CONNECTIONS)]
+    wheel = TimeoutWheel(timeout, interval)
+    wheel.oldest = int((now - 2 * timeout) // interval)
+    wheel.soon = wheel.oldest + 1
+    for s in socks:
+        wheel.add(s)
+    single_sockets = dict([(id(s), s) for s in socks])
+
+    scan_old = scan_new = touch_old = touch_new = 0.0
+    killed_old = killed_new = 0
+    for i in xrange(SCANS):
+        now += interval
+        # connections send something just before they would time out,
+        # except for a few that have gone away
+        limit = now - timeout + interval
+        active = [s for s in socks if s.last_hit < limit and
+                  random() > DEAD_FRACTION]
+        t = time()
+        for s in active:
+            s.last_hit = now
+        touch_old += time() - t
+        t = time()
+        for s in active:
+            s.last_hit = now
+            if s.idle_tick <= wheel.soon:
+                wheel.touch(s)
+        touch_new += time() - t
+
+        t = time()
+        limit = now - timeout
+        tokill = []
+        for s in single_sockets.values():
+            if s.last_hit < limit:
+                tokill.append(s)
+        scan_old += time() - t
+        killed_old += len(tokill)
+
+        t = time()
+        expired = wheel.expire(now)
+        scan_new += time() - t
+        killed_new += len(expired)
+
+        for s in tokill:
+            del single_sockets[id(s)]
+        for s in expired:
+            if id(s) in single_sockets:
+                del single_sockets[id(s)]
+        dead = dict([(id(s), None) for s in expired + tokill])
+        socks = [s for s in socks if id(s) not in dead]
+        for j in xrange(len(dead)):
+            s = FakeSocket(now)
+            socks.append(s)
+            single_sockets[id(s)] = s
+            wheel.add(s)
+
+    print '%d connections, %d scans every %ss, timeout %ss' % (
+        CONNECTIONS, SCANS, interval, timeout)
+    print '%-12s %14s %18s %14s' % ('', 'ms per scan',
+                                    'activity ms/scan', 'expired')
+    print '%-12s %14.3f %18.3f %14d' % ('full scan', scan_old / SCANS * 1000,
+                                        touch_old / SCANS * 1000, killed_old)
+    print '%-12s %14.3f %18.3f %14d' % ('wheel', scan_new / SCANS * 1000,
+                                        touch_new / SCANS * 1000, killed_new)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+
+# The contents of this file are subject to the BitTorrent Open Source License
+# Version 1.0 (the License).  You may not copy or use this file, in either
+# source code or executable form, except in compliance with the License.  You
+# may obtain a copy of the License at http://www.bittorrent.com/license/.
+#
+# Software distributed under the License is distributed on an AS IS basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied.  See the License
+# for the specific language governing rights and limitations under the
+# License.
+
+# Compares the old sorted-list task scheduler with the RawServer heap: time
+# to schedule a batch of tasks for many torrents, to run them all, and to
+# remove a tenth of the torrents while their tasks are still pending.
+
+import os
+import sys
+from bisect import insort
+from random import random, seed
+from threading import Event
+from time import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from BitTorrent.RawServer import RawServer
+from BitTorrent.defaultargs import get_defaults
+from BitTorrent.platform import bttime
+
+TASKS_PER_TORRENT = 6
+
+
+class ListScheduler(object):
+    # the scheduler RawServer used before the heap
+
+    def __init__(self):
+        self.funcs = []
+        self.live_contexts = {None: True}
+
+    def add_context(self, context):
+        self.live_contexts[context] = True
+
+    def remove_context(self, context):
+        del self.live_contexts[context]
+        self.funcs = [x for x in self.funcs if x[2] != context]
+
+    def add_task(self, func, delay, context=None):
+        if context in self.live_contexts:
+            insort(self.funcs, (bttime() + delay, func, context))
+
+    def _run_due_tasks(self):
+        while self.funcs and self.funcs[0][0] <= bttime():
+            garbage, func, context = self.funcs.pop(0)
+            try:
+                func()
+            except Exception:
+                pass
+
+
+def noop():
+    pass
+
+
+def fill(sched, torrents, delay):
+    for t in torrents:
+        for i in xrange(TASKS_PER_TORRENT):
+            sched.add_task(noop, delay * random(), t)
+
+
+def run(sched, numtorrents):
+    seed(0)
+    torrents = [object() for i in xrange(numtorrents)]
+    for t in torrents:
+        sched.add_context(t)
+    t0 = time()
+    fill(sched, torrents, -1)
+    t1 = time()
+    sched._run_due_tasks()
+    t2 = time()
+    fill(sched, torrents, 60)
+    t3 = time()
+    for t in torrents[::10]:
+        sched.remove_context(t)
+    t4 = time()
+    n = numtorrents * TASKS_PER_TORRENT
+    return (t1 - t0) / n * 1e6, (t2 - t1) / n * 1e6, \
+           (t4 - t3) / len(torrents[::10]) * 1e6
+
+
+def main():
+    config = dict([(o[0], o[1]) for o in get_defaults('btlaunchmany')])
+    print '%8s %-6s %12s %12s %16s' % ('torrents', 'sched', 'add (us)',
+                                       'pop+run (us)', 'remove ctx (us)')
+    for n in (100, 1000, 5000, 20000):
+        for name, sched in (('list', ListScheduler()),
+                            ('heap', RawServer(Event(), config))):
+            add, pop, remove = run(sched, n)
+            print '%8d %-6s %12.2f %12.2f %16.2f' % (n, name, add, pop,
+                                                     remove)
+        sched.get_stats()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+
+# The contents of this file are subject to the BitTorrent Open Source License
+# Version 1.0 (the License).  You may not copy or use this file, in either
+# source code or executable form, except in compliance with the License.  You
+# may obtain a copy of the License at http://www.bittorrent.com/license/.
+#
+# Software distributed under the License is distributed on an AS IS basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied.  See the License
+# for the specific language governing rights and limitations under the
+# License.
+
+# Downloads a SIZE MiB torrent into an empty file through StorageWrapper,
+# the pieces in random order with ACTIVE of them in progress at a time and
+# their blocks coming in interleaved in random order, as from several
+# peers. Counts the bytes Storage reads and writes, with the write cache
+# off and at a few sizes, and reports them per downloaded byte along with
+# the pieces checked without reading them back and the time taken.
+
+import os
+import sys
+import shutil
+import tempfile
+from random import Random
+from sha import sha
+from threading import Event
+from time import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from BitTorrent.Storage import Storage, FilePool
+from BitTorrent.StorageWrapper import StorageWrapper
+from BitTorrent.defaultargs import get_defaults
+
+SIZE = 64
+PIECE_SIZE = 2 ** 18
+ACTIVE = 10
+
+
+class Log(object):
+
+    def log(self, *args):
+        pass
+
+
+class CountingStorage(Storage):
+
+    def __init__(self, *args):
+        Storage.__init__(self, *args)
+        self.bytes_read = self.bytes_written = 0
+
+    def read(self, pos, amount):
+        self.bytes_read += amount
+        return Storage.read(self, pos, amount)
+
+    def write(self, pos, s):
+        self.bytes_written += len(s)
+        return Storage.write(self, pos, s)
+
+
+def run(work, data, hashes, cache_size):
+    config = dict([(o[0], o[1]) for o in get_defaults('btlaunchmany')])
+    config['write_cache_size'] = cache_size
+    name = os.path.join(work, 'out')
+    storage = CountingStorage(config, FilePool(config['max_files_open']),
+                              [(name, len(data))])
+    done = Event()
+    sw = StorageWrapper(storage, config, hashes, PIECE_SIZE, done.set,
+                        lambda *args, **kws: None, Event(), None, 'x' * 20,
+                        None, None, Log())
+    rand = Random(1)
+    order = range(len(hashes))
+    rand.shuffle(order)
+    start = time()
+    requested = []
+    while order or requested:
+        while order and len(set([r[0] for r in requested])) < ACTIVE:
+            index = order.pop()
+            while sw.do_I_have_requests(index):
+                requested.append((index,) + sw.new_request(index))
+        index, begin, length = requested.pop(rand.randrange(len(requested)))
+        p = index * PIECE_SIZE + begin
+        sw.piece_came_in(index, begin, data[p:p + length])
+    sw.flush()
+    storage.close()
+    elapsed = time() - start
+    f = open(name, 'rb')
+    ok = done.isSet() and f.read() == data
+    f.close()
+    os.remove(name)
+    return ok, storage.bytes_read, storage.bytes_written, sw.stat_numhashed, \
+           elapsed
+
+
+def main():
+    work = tempfile.mkdtemp()
+    try:
+        data = os.urandom(SIZE * 2 ** 20)
+        hashes = [sha(data[i:i + PIECE_SIZE]).digest()
+                  for i in xrange(0, len(data), PIECE_SIZE)]
+        print '%d MiB, %d KiB pieces, %d pieces in progress' % (
+            SIZE, PIECE_SIZE // 1024, ACTIVE)
+        print '%-12s %4s %8s %8s %8s %8s' % ('cache', 'ok', 'read/B',
+                                             'write/B', 'hashed', 's')
+        for cache_size in (0, 2 ** 20, 4 * 2 ** 20, 16 * 2 ** 20):
+            ok, r, w, hashed, t = run(work, data, hashes, cache_size)
+            print '%-12s %4s %8.3f %8.3f %8d %8.2f' % ('%d KiB' % (
+                cache_size // 1024), ok and 'yes' or 'NO',
+                r / float(len(data)), w / float(len(data)), hashed, t)
+    finally:
+        shutil.rmtree(work)
+
+
+if __name__ == '__main__':
+    main()
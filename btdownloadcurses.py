@@ -348,6 +348,7 @@ class DL(Feedback):
         self.multitorrent.rawserver.listen_forever()
         self.d.display({'activity':'shutting down', 'fractionDone':0})
         self.torrent.shutdown()
+        self.multitorrent.shutdown()
 
     def reread_config(self):
         try:
@@ -28,6 +28,7 @@ from BitTorrent.parseargs import parseargs, printHelp
 from BitTorrent.zurllib import urlopen
 from BitTorrent.bencode import bdecode
 from BitTorrent.ConvertedMetainfo import ConvertedMetainfo
+from BitTorrent.controlsocket import ControlSocket
 from BitTorrent import configfile
 from BitTorrent import BTFailure
 from BitTorrent import version
@@ -184,6 +185,16 @@ class HeadlessDisplayer(object):
                          ' NL ' + str(statistics.get('numPeers',0)) +\
                          ' SR ' + str( self.shareRating)\
                          )
+        if 'tasks' in statistics:
+            logcollector.log(None, 'RS ' + \
+                             ' T ' + str(statistics['tasks']) + \
+                             ' DT ' + str(statistics['dead_tasks']) + \
+                             ' TR ' + str(statistics['tasks_run']) + \
+                             ' TL ' + str(int(statistics['task_pop_latency'] * 1000000)) + \
+                             ' SC ' + str(statistics['send_calls']) + \
+                             ' RC ' + str(statistics['recv_calls']) + \
+                             ' PS ' + str(statistics['poll_syscalls']) + \
+                             ' PE ' + str(statistics['poll_events']))
                                   
 
     def print_spew(self, spew):
@@ -232,6 +243,13 @@ class HeadlessDisplayer(object):
                 s += ' s '
             else:
                 s += '   ' 
+
+            #round trip time in ms and requests wanted/outstanding
+            if c['rtt'] is not None:
+                s += ' %6d ' % (c['rtt'] * 1000)
+            else:
+                s += '      - '
+            s += ' %3d/%-3d ' % c['pipeline']
             logcollector.log(s)
 
 
@@ -241,6 +259,7 @@ class DL(Feedback):
         self.doneflag = threading.Event()
         self.metainfo = metainfo
         self.config = config
+        self.controlsocket = None
         self.init_logfile()
         self.show_config()
 
@@ -272,6 +291,9 @@ class DL(Feedback):
         on the session. The peer has completed <percent> % of the content, the aggregate download rate is <downrate> Bytes/s,\
         the aggregate upload rate is <uprate> Bytes/s, the number of seeds (handshake done) is <ns>,\
         the number of leechers (handshake done) is <nl>, and the sharing rate is <sharerate>')        
+        logcollector.log(None,'L   (btdownloadheadless.py) RS T <tasks> DT <dead> TR <run> TL <late> SC <sends> RC <recvs> PS <polls> PE <events>: RawServer\
+        statistics of the process. <tasks> tasks are scheduled, <dead> dead ones, cancelled or of stopped torrents, wait to be dropped, <run> were run so far, on average <late> microseconds after they came due,\
+        <sends> send() and <recvs> recv() calls were made, and <polls> poll calls returned <events> events')
         logcollector.log(None,'L   (btdownloadheadless.py) FN <name> FZ <size> NP <numpieces> PL <piecelength>: The torrent file name is <name> with a size <size> and a number of pieces <numpieces> of length <piecelength>')
         logcollector.log(None,'L   (btdownloadheadless.py) CF: Important config parameters')
         
@@ -419,13 +441,42 @@ class DL(Feedback):
         except BTFailure, e:
             print str(e)
             return
+        if self.config['streaming']:
+            self.start_controlsocket()
         self.get_status()
         #It only returns when the application is stopped
         self.multitorrent.rawserver.listen_forever()
 
         #graceful shutdown. We reach this section when the listen_forever() is stopped.
         self.d.display({'activity':'shutting down', 'fractionDone':0})
+        if self.controlsocket is not None:
+            self.controlsocket.close_socket()
         self.torrent.shutdown()
+        self.multitorrent.shutdown()
+
+    #lets the consumer of a streamed download move the read cursor, with
+    #a 'set_cursor' command and the byte offset as data
+    def start_controlsocket(self):
+        controlsocket = ControlSocket(self.config)
+        try:
+            controlsocket.create_socket()
+        except BTFailure, e:
+            self.d.error(str(e))
+            return
+        controlsocket.set_rawserver(self.multitorrent.rawserver)
+        controlsocket.start_listening(self.external_command)
+        self.controlsocket = controlsocket
+
+    def external_command(self, action, data):
+        if action == 'set_cursor':
+            try:
+                pos = int(data)
+            except ValueError:
+                self.d.error('bad set_cursor position: ' + data)
+                return
+            self.torrent.set_cursor(pos)
+        elif action == 'no-op':
+            pass
 
     def reread_config(self):
         try:
@@ -447,6 +498,7 @@ class DL(Feedback):
         self.multitorrent.rawserver.add_task(self.get_status,
                                              self.config['display_interval'])
         status = self.torrent.get_status(self.config['spew'])
+        status.update(self.multitorrent.rawserver.get_stats())
         self.d.display(status)
 
     def global_error(self, level, text):